@@ -0,0 +1,154 @@
+"""Benchmark the cold-start time of CLI commands.
+
+Runs each command in a fresh interpreter against a temporary database and
+reports wall-clock times next to a bare `python -c pass` baseline. It also
+reports the modules each command imports beyond the baseline, from
+`python -X importtime`. Results are written as JSON.
+
+    python benchmarks/bench_cli_startup.py --runs 20 --max-overhead-ms 40
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS_DIR)
+
+# Commands timed by default; json-list and json-list-all are the ones the UI polls
+DEFAULT_COMMANDS = 'json-list-all,json-list,list'
+
+# Command whose overhead --max-overhead-ms checks
+GATED_COMMAND = 'json-list-all'
+
+
+def populate(db_path: str, targets: int):
+    """Create the database with a mix of static and dynamic targets"""
+    from mitm_modular.database import TargetDatabase
+    db = TargetDatabase(db_path)
+    db.import_targets([
+        {'url': f'https://api.example.com/v1/item/{i}', 'modification_type': 'static',
+         'static_response': json.dumps({'id': i, 'plan': 'premium'})}
+        if i % 2 else
+        {'url': f'item/{i}', 'modification_type': 'dynamic',
+         'dynamic_code': f"response_data['id'] = {i}"}
+        for i in range(targets)
+    ])
+    db.close()
+
+
+def command_line(command: Optional[str], db_path: str, importtime: bool = False) -> List[str]:
+    """Interpreter command line for a CLI command, or the bare baseline if command is None"""
+    argv = [sys.executable]
+    if importtime:
+        argv += ['-X', 'importtime']
+    if command is None:
+        return argv + ['-c', 'pass']
+    return argv + ['-m', 'mitm_modular.cli', '--db', db_path] + command.split()
+
+
+def time_runs(argv: List[str], runs: int) -> List[float]:
+    """Wall-clock seconds of each run of argv"""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(argv, cwd=TOOLS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        samples.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(argv)} failed: {result.stderr.decode(errors='replace')}")
+    return samples
+
+
+def import_times(argv: List[str]) -> Dict[str, Tuple[int, int]]:
+    """Map each imported module to (nesting depth, cumulative microseconds)"""
+    result = subprocess.run(argv, cwd=TOOLS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (depth, int(cumulative))
+    return modules
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': samples[0] * 1e3,
+        'median_ms': statistics.median(samples) * 1e3,
+        'p90_ms': samples[min(len(samples) - 1, int(len(samples) * 0.9))] * 1e3,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the cold-start time of CLI commands')
+    parser.add_argument('--runs', type=int, default=20, help='Runs per command')
+    parser.add_argument('--targets', type=int, default=200, help='Targets in the temporary database')
+    parser.add_argument('--commands', default=DEFAULT_COMMANDS, help='Comma-separated CLI commands to time')
+    parser.add_argument('--top', type=int, default=10, help='Slowest extra imports to report per command')
+    parser.add_argument('--max-overhead-ms', type=float,
+                        help=f'Exit with status 1 if the median {GATED_COMMAND} time exceeds the baseline by more')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    commands = [c.strip() for c in args.commands.split(',') if c.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'targets.db')
+        populate(db_path, args.targets)
+
+        baseline = summarize(time_runs(command_line(None, db_path), args.runs))
+        baseline_modules = import_times(command_line(None, db_path, importtime=True))
+
+        results = []
+        for command in commands:
+            timing = summarize(time_runs(command_line(command, db_path), args.runs))
+            modules = import_times(command_line(command, db_path, importtime=True))
+            extra = {name: info for name, info in modules.items() if name not in baseline_modules}
+            top_level = sorted(((name, us) for name, (depth, us) in extra.items() if depth <= 1),
+                               key=lambda item: -item[1])
+            results.append(dict(
+                command=command,
+                overhead_ms=timing['median_ms'] - baseline['median_ms'],
+                extra_modules=len(extra),
+                slowest_imports=[{'module': name, 'cumulative_ms': us / 1e3} for name, us in top_level[:args.top]],
+                **timing,
+            ))
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'targets': args.targets,
+        },
+        'baseline': baseline,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.max_overhead_ms is not None:
+        for result in results:
+            if result['command'] == GATED_COMMAND and result['overhead_ms'] > args.max_overhead_ms:
+                print(f"{GATED_COMMAND} startup overhead {result['overhead_ms']:.1f} ms exceeds "
+                      f"{args.max_overhead_ms:.1f} ms", file=sys.stderr)
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
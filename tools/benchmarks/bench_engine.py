@@ -0,0 +1,275 @@
+"""Benchmark the matching and modification engine with synthetic flows.
+
+Populates a temporary target database with the rule kinds the chosen engine
+supports (exact, endpoint, and query or regex), then times target matching
+with and without the match cache, static replacement, dynamic modification
+and declarative patches on flows built with mitmproxy's test helpers, using
+the chosen JSON codec. Results are written as JSON.
+
+    python benchmarks/bench_engine.py --rules 1000 --sizes 1KB,1MB,50MB --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Callable, Optional, Sequence
+
+from mitmproxy import version as mitmproxy_version
+from mitmproxy.test import tflow
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS_DIR)
+
+# Keep the addon quiet while it is imported and exercised
+os.environ.setdefault('MITM_MODULAR_LOG_LEVEL', 'WARNING')
+
+# Rule kinds each engine can match: run_mitm.py has no regular expressions, and mitm_core compiles
+# any URL containing '?' as one, so query rules would only measure misses there
+ENGINE_RULE_KINDS = {
+    'run_mitm': ('exact', 'endpoint', 'query'),
+    'core': ('exact', 'endpoint', 'regex'),
+}
+
+DEFAULT_SIZES = '1KB,10KB,100KB,1MB,10MB,50MB'
+
+# Total payload bytes processed per size, bounding the iterations of large payloads
+BYTES_BUDGET = 200 * 1024 * 1024
+
+STATIC_URL = 'https://static.bench.test/v1/profile'
+DYNAMIC_URL = 'https://dynamic.bench.test/v1/profile'
+PATCH_URL = 'https://patch.bench.test/v1/profile'
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 512, 1KB or 50MB into bytes"""
+    text = text.strip().upper()
+    for suffix, factor in (('KB', 1024), ('MB', 1024 * 1024), ('B', 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def rule_url(kind: str, i: int) -> str:
+    """Target URL of the i-th rule of a kind"""
+    if kind == 'exact':
+        return f'https://api{i}.bench.test/v1/resource/{i}'
+    if kind == 'endpoint':
+        return f'endpoint{i}.json'
+    if kind == 'query':
+        return f'search?q=term{i}'
+    return rf'^https://regex{i}\.bench\.test/items/\d+$'
+
+
+def flow_url(kind: str, i: int) -> str:
+    """A flow URL matched by the i-th rule of a kind"""
+    if kind == 'exact':
+        return f'https://api{i}.bench.test/v1/resource/{i}'
+    if kind == 'endpoint':
+        return f'https://cdn.bench.test/data/endpoint{i}.json'
+    if kind == 'query':
+        return f'https://www.bench.test/search?q=term{i}&page=2'
+    return f'https://regex{i}.bench.test/items/{i * 7}'
+
+
+def populate(db, rules: int, kinds: Sequence[str]):
+    """Add rules spread evenly over kinds, plus the static, dynamic and patch targets"""
+    per_kind = max(1, rules // len(kinds))
+    for kind in kinds:
+        for i in range(per_kind):
+            db.add_target(url=rule_url(kind, i), modification_type='none', target_status_code=200)
+    db.add_target(url=STATIC_URL, modification_type='static',
+                  static_response=json.dumps({'plan': 'premium', 'expiresAt': '2099-12-31'}))
+    db.add_target(url=DYNAMIC_URL, modification_type='dynamic',
+                  dynamic_code="response_data['plan'] = 'premium'\nresponse_data['seen'] = len(response_data['items'])")
+    db.add_target(url=PATCH_URL, modification_type='patch',
+                  patch_operations=json.dumps([{'op': 'replace', 'path': '$.plan', 'value': 'premium'},
+                                               {'op': 'add', 'path': '/seen', 'value': True}]))
+    return per_kind
+
+
+def make_payload(size: int) -> bytes:
+    """Build a JSON document of roughly size bytes"""
+    item = {'id': 0, 'name': 'item', 'tags': ['a', 'b', 'c'], 'price': 12.5, 'active': True}
+    item_size = len(json.dumps(item)) + 2
+    count = max(1, size // item_size)
+    items = [dict(item, id=i) for i in range(count)]
+    return json.dumps({'plan': 'free', 'items': items}).encode('utf-8')
+
+
+def make_flow(url: str, content: bytes = b'{}'):
+    """Build a completed JSON flow for url"""
+    flow = tflow.tflow(resp=True)
+    flow.request.url = url
+    flow.response.status_code = 200
+    flow.response.headers['Content-Type'] = 'application/json'
+    flow.response.content = content
+    return flow
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted samples"""
+    index = min(len(sorted_samples) - 1, max(0, int(round(q * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(name: str, samples: List[float], **extra) -> Dict[str, Any]:
+    """Summarize per-operation durations in seconds"""
+    samples = sorted(samples)
+    total = sum(samples)
+    result = {
+        'name': name,
+        'iterations': len(samples),
+        'ops_per_sec': len(samples) / total if total else None,
+        'mean_us': statistics.fmean(samples) * 1e6,
+        'p50_us': percentile(samples, 0.50) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+    result.update(extra)
+    return result
+
+
+def time_each(setup: Callable[[], Any], run: Callable[[Any], None], iterations: int) -> List[float]:
+    """Time run(setup()) iterations times, excluding the setup"""
+    samples = []
+    for _ in range(iterations):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_matching(modifier, flows: List[Any], iterations: int):
+    """Return the durations of _find_matching_targets over flows and the share of them that matched"""
+    rules = modifier.rules
+    samples = []
+    matched = 0
+    for n in range(iterations):
+        flow = flows[n % len(flows)]
+        # Without recorded candidates, as in the response hook of a fresh flow
+        flow.metadata.clear()
+        start = time.perf_counter()
+        found = modifier._find_matching_targets(flow, rules)
+        samples.append(time.perf_counter() - start)
+        matched += bool(found)
+    return samples, matched / iterations
+
+
+def bench_matching(modifier, kinds: Sequence[str], per_kind: int, iterations: int) -> List[Dict[str, Any]]:
+    """Time matching for hits of each rule kind and for misses.
+
+    The match series disables the match cache so every lookup runs the rule
+    index; match_cached repeats the same flows with the cache warmed up.
+    """
+    results = []
+    urls = {kind: [flow_url(kind, i % per_kind) for i in range(64)] for kind in kinds}
+    urls['miss'] = [f'https://unrelated{i}.example.org/assets/app.js' for i in range(64)]
+    cache_size = modifier.match_cache.maxsize
+
+    for kind, kind_urls in urls.items():
+        flows = [make_flow(url) for url in kind_urls]
+
+        modifier.match_cache.resize(0)
+        samples, hit_rate = time_matching(modifier, flows, iterations)
+        if kind != 'miss' and hit_rate < 1:
+            print(f"warning: {kind} rules matched only {hit_rate:.0%} of their flows, "
+                  f"the timings include misses", file=sys.stderr)
+        results.append(summarize('match', samples, kind=kind, hit_rate=hit_rate))
+
+        modifier.match_cache.resize(cache_size)
+        time_matching(modifier, flows, len(flows))
+        samples, hit_rate = time_matching(modifier, flows, iterations)
+        results.append(summarize('match_cached', samples, kind=kind, hit_rate=hit_rate))
+    return results
+
+
+def bench_modification(modifier, name: str, url: str, size: int, iterations: int) -> Dict[str, Any]:
+    """Time the response hook for a flow of url carrying a payload of size bytes"""
+    payload = make_payload(size)
+    iterations = max(3, min(iterations, BYTES_BUDGET // max(len(payload), 1)))
+    samples = time_each(lambda: make_flow(url, payload), modifier.response, iterations)
+    return summarize(name, samples, payload_bytes=len(payload),
+                     mb_per_sec=len(payload) * len(samples) / sum(samples) / 1e6)
+
+
+def load_engine(engine: str):
+    """Import the ResponseModifier of the chosen addon.
+
+    Importing an addon creates its module-level instance, so MITM_MODULAR_DB
+    must point at the temporary database first.
+    """
+    if engine == 'core':
+        from mitm_modular.mitm_core import ResponseModifier
+    else:
+        from run_mitm import ResponseModifier
+    return ResponseModifier
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the MITM matching and modification engine')
+    parser.add_argument('--rules', type=int, default=1000,
+                        help="Number of rules, spread over the rule kinds of the engine")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma-separated payload sizes (e.g. 1KB,1MB,50MB)')
+    parser.add_argument('--iterations', type=int, default=2000, help='Iterations per benchmark (fewer for large payloads)')
+    parser.add_argument('--engine', choices=['run_mitm', 'core'], default='run_mitm',
+                        help='Addon to benchmark: run_mitm.py (used by the app) or mitm_modular.mitm_core')
+    parser.add_argument('--json', default='auto', help='JSON codec backend: auto, orjson or stdlib')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes.split(',') if s.strip()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'targets.db')
+        os.environ['MITM_MODULAR_DB'] = db_path
+        from mitm_modular import codec
+        from mitm_modular.database import TargetDatabase
+        codec.set_backend(args.json)
+        ResponseModifier = load_engine(args.engine)
+
+        db = TargetDatabase(db_path)
+        kinds = ENGINE_RULE_KINDS[args.engine]
+        per_kind = populate(db, args.rules, kinds)
+        db.close()
+
+        start = time.perf_counter()
+        modifier = ResponseModifier(db_path)
+        load_seconds = time.perf_counter() - start
+
+        results = bench_matching(modifier, kinds, per_kind, args.iterations)
+        for size in sizes:
+            results.append(bench_modification(modifier, 'static', STATIC_URL, size, args.iterations))
+            results.append(bench_modification(modifier, 'dynamic', DYNAMIC_URL, size, args.iterations))
+            results.append(bench_modification(modifier, 'patch', PATCH_URL, size, args.iterations))
+        modifier.watcher.stop()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'mitmproxy': mitmproxy_version.VERSION,
+            'engine': args.engine,
+            'json_codec': codec.backend,
+            'rules': per_kind * len(kinds) + 3,
+            'load_ms': load_seconds * 1e3,
+        },
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,17 @@
-from mitm_modular.database import TargetDatabase
-from mitm_modular.mitm_core import MITMAddon, ResponseModifier
+__version__ = '0.1.0'
 
-__version__ = '0.1.0' 
\ No newline at end of file
+# Exported lazily: importing mitm_core loads mitmproxy and creates the addon,
+# which submodules such as the CLI must not pay for
+_EXPORTS = {
+    'TargetDatabase': 'mitm_modular.database',
+    'MITMAddon': 'mitm_modular.mitm_core',
+    'ResponseModifier': 'mitm_modular.mitm_core',
+}
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    return getattr(importlib.import_module(module_name), name)
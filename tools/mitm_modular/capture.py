@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger('mitm_modular.capture')
+
+# Retention defaults; 0 disables a limit
+DEFAULT_MAX_ROWS = 10000
+DEFAULT_MAX_AGE = 24 * 3600  # seconds
+DEFAULT_MAX_MB = 256
+
+# Bodies are cut to this size before they are queued
+MAX_BODY_BYTES = 1024 * 1024
+# Memory the queued captures may take up; captures beyond it are dropped, never waited for
+MAX_QUEUE_BYTES = 64 * 1024 * 1024
+# Fixed per-capture cost counted against MAX_QUEUE_BYTES besides the bodies and URL
+ROW_OVERHEAD = 256
+# Rows written per transaction
+BATCH_SIZE = 200
+# Seconds between retention passes
+RETENTION_INTERVAL = 30.0
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS captures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        captured_at REAL NOT NULL,
+        method TEXT,
+        url TEXT,
+        original_status INTEGER,
+        status_code INTEGER,
+        target_ids TEXT,
+        original_body BLOB,
+        modified_body BLOB,
+        truncated INTEGER DEFAULT 0,
+        timings TEXT
+    )
+'''
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_captures_time ON captures (captured_at)",
+)
+
+INSERT_CAPTURE = '''
+    INSERT INTO captures (captured_at, method, url, original_status, status_code, target_ids,
+                          original_body, modified_body, truncated, timings)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+LIST_FIELDS = ('id', 'captured_at', 'method', 'url', 'original_status', 'status_code', 'target_ids',
+               'length(original_body) AS original_size', 'length(modified_body) AS modified_size', 'truncated')
+
+# Queued in place of a capture to stop the writer
+_STOP = object()
+
+
+def capture_path(db_path: str) -> str:
+    """The capture file kept next to a target database, e.g. targets-captures.db for targets.db"""
+    root, _ = os.path.splitext(db_path)
+    return root + '-captures.db'
+
+
+class CaptureStore:
+    """Records the flows the proxy modified into a SQLite file of their own.
+
+    record() only hands the capture to a background writer, which inserts
+    them in batches. The queue is bounded by the bytes it holds, and
+    captures that do not fit are counted and dropped rather than waited
+    for. The writer also enforces the row, age and size limits and returns
+    the pages it frees to the file system.
+
+    Captures live in their own file because every commit to the target
+    database would wake its watcher into reloading the rule set.
+    """
+
+    def __init__(self, path: str, max_rows: int = DEFAULT_MAX_ROWS, max_age: float = DEFAULT_MAX_AGE,
+                 max_mb: int = DEFAULT_MAX_MB):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_bytes = max_mb * 1024 * 1024
+        self.written = 0
+        self.dropped = 0
+        self._queue: 'queue.SimpleQueue' = queue.SimpleQueue()
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Open the capture file and start the writer thread"""
+        if self._thread is not None:
+            return
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            logger.warning("Cannot open capture file %s, not capturing: %s", self.path, e)
+            return
+        self._thread = threading.Thread(target=self._run, args=(conn,), name='mitm_modular-capture', daemon=True)
+        self._thread.start()
+        logger.info("Capturing modified flows to %s", self.path)
+
+    def stop(self, timeout: float = 10.0):
+        """Write what is queued, then stop the writer, waiting up to timeout seconds for it (0 to return at once)"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        if timeout:
+            thread.join(timeout)
+
+    def record(self, method: str, url: str, original_status: Optional[int], status_code: Optional[int],
+               target_ids: Sequence[int], original: Optional[bytes], modified: Optional[bytes],
+               timings: Optional[Dict[str, float]] = None) -> bool:
+        """Queue a capture without blocking; returns False if it was dropped"""
+        truncated = 0
+        if original is not None and len(original) > MAX_BODY_BYTES:
+            original, truncated = original[:MAX_BODY_BYTES], 1
+        if modified is not None and len(modified) > MAX_BODY_BYTES:
+            modified, truncated = modified[:MAX_BODY_BYTES], 1
+        size = ROW_OVERHEAD + len(url) + len(original or b'') + len(modified or b'')
+        with self._lock:
+            if self._thread is None:
+                return False
+            if self._queued_bytes + size > MAX_QUEUE_BYTES:
+                self.dropped += 1
+                return False
+            self._queued_bytes += size
+        self._queue.put((size, (time.time(), method, url, original_status, status_code,
+                                ','.join(str(target_id) for target_id in target_ids),
+                                original, modified, truncated, timings)))
+        return True
+
+    def stats(self) -> Dict[str, Tuple[str, float]]:
+        """Writer counters in the form Metrics collectors return"""
+        return {
+            'written': ('counter', self.written),
+            'dropped': ('counter', self.dropped),
+            'queued_bytes': ('gauge', self._queued_bytes),
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        # Only takes effect on a new file, before the table exists; lets retention give pages back
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SCHEMA)
+        for statement in INDEXES:
+            conn.execute(statement)
+        return conn
+
+    def _run(self, conn: sqlite3.Connection):
+        last_retention = time.monotonic()
+        stopping = False
+        try:
+            while not stopping:
+                batch = []
+                try:
+                    item = self._queue.get(timeout=RETENTION_INTERVAL)
+                except queue.Empty:
+                    item = None
+                while item is not None:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= BATCH_SIZE:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+                if batch:
+                    self._write(conn, batch)
+                if stopping or time.monotonic() - last_retention >= RETENTION_INTERVAL:
+                    self._retain(conn)
+                    last_retention = time.monotonic()
+        except Exception:
+            logger.exception("Capture writer failed, capturing stopped")
+            with self._lock:
+                self._thread = None
+        finally:
+            conn.close()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Tuple[int, tuple]]):
+        rows = [row[:-1] + (json.dumps(row[-1]) if row[-1] else None,) for _, row in batch]
+        written = 0
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(INSERT_CAPTURE, rows)
+            conn.execute("COMMIT")
+            written = len(rows)
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.warning("Error writing %d captures: %s", len(rows), e)
+        with self._lock:
+            self._queued_bytes -= sum(size for size, _ in batch)
+            self.written += written
+            self.dropped += len(rows) - written
+
+    def _retain(self, conn: sqlite3.Connection):
+        """Delete captures past the age, row and size limits, then compact the file"""
+        try:
+            deleted = 0
+            if self.max_age > 0:
+                deleted += conn.execute("DELETE FROM captures WHERE captured_at < ?",
+                                        (time.time() - self.max_age,)).rowcount
+            if self.max_rows > 0:
+                deleted += conn.execute("DELETE FROM captures WHERE id <= "
+                                        "(SELECT id FROM captures ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                        (self.max_rows,)).rowcount
+            if self.max_bytes > 0:
+                used = self._used_bytes(conn)
+                if used > self.max_bytes:
+                    # Drop the oldest share of rows matching the excess, and a tenth more to leave room
+                    count = conn.execute("SELECT COUNT(*) FROM captures").fetchone()[0]
+                    excess = int(count * ((used - self.max_bytes) / used + 0.1)) + 1
+                    deleted += conn.execute("DELETE FROM captures WHERE id IN "
+                                            "(SELECT id FROM captures ORDER BY id LIMIT ?)", (excess,)).rowcount
+            if deleted:
+                # executescript runs the pragma to completion; execute() would free a single page
+                conn.executescript("PRAGMA incremental_vacuum;")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                logger.debug("Retention removed %d captures", deleted)
+        except sqlite3.Error as e:
+            logger.warning("Error applying capture retention: %s", e)
+
+    @staticmethod
+    def _used_bytes(conn: sqlite3.Connection) -> int:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free) * page_size
+
+
+def _read(path: str) -> sqlite3.Connection:
+    """A read-only connection to a capture file, which the proxy may be writing"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No captures at {path}")
+    conn = sqlite3.connect(pathlib.Path(os.path.abspath(path)).as_uri() + '?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def list_captures(path: str, limit: int = 20, target_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """The most recent captures without their bodies, newest first"""
+    conn = _read(path)
+    try:
+        query = f"SELECT {', '.join(LIST_FIELDS)} FROM captures"
+        params: list = []
+        if target_id is not None:
+            query += " WHERE ',' || target_ids || ',' LIKE ?"
+            params.append(f"%,{target_id},%")
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in conn.execute(query, params)]
+    finally:
+        conn.close()
+
+
+def get_capture(path: str, capture_id: int) -> Optional[Dict[str, Any]]:
+    """One capture with its bodies, or None"""
+    conn = _read(path)
+    try:
+        row = conn.execute("SELECT * FROM captures WHERE id = ?", (capture_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def clear_captures(path: str) -> int:
+    """Delete every capture and compact the file; returns how many were deleted"""
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    try:
+        deleted = conn.execute("DELETE FROM captures").rowcount
+        conn.executescript("PRAGMA incremental_vacuum;")
+        return deleted
+    finally:
+        conn.close()
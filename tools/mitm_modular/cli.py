@@ -1,35 +1,83 @@
-import argparse
 import json
 import os
+import sqlite3
 import sys
-from tabulate import tabulate
-
-# Fix imports to work whether run directly or as a module
-try:
-    # Try direct import first (when running directly from the module directory)
-    from database import TargetDatabase
-except ImportError:
-    # Try package import (when installed or parent dir is in path)
+
+# Machine-facing commands polled by the UI, mapped to the query answering them
+FAST_COMMANDS = {
+    'json-list': "SELECT * FROM targets WHERE is_enabled = 1 ORDER BY priority, id",
+    'json-list-all': "SELECT * FROM targets ORDER BY id",
+}
+
+def fast_json_list(argv):
+    """Answer json-list/json-list-all straight from SQLite, importing nothing beyond sqlite3 and json.
+
+    Returns False for any other command line, or if the database cannot be
+    read this way, so that the full CLI handles it instead.
+    """
+    db_path = 'targets.db'
+    command = None
+    args = iter(argv)
+    for arg in args:
+        if arg == '--db':
+            db_path = next(args, None)
+        elif arg.startswith('--db='):
+            db_path = arg[len('--db='):]
+        elif arg == '--local':
+            continue
+        elif command is None and arg in FAST_COMMANDS:
+            command = arg
+        else:
+            return False
+    if command is None or not db_path:
+        return False
+    
+    # Same resolution as database.resolve_db_path
+    if not os.path.isabs(db_path):
+        db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), db_path)
+    if not os.path.exists(db_path):
+        # The full CLI creates the database
+        return False
+    
     try:
-        from mitm_modular.database import TargetDatabase
-    except ImportError:
-        # Add parent directory to Python path to find module
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        parent_dir = os.path.dirname(current_dir)
-        if parent_dir not in sys.path:
-            sys.path.insert(0, parent_dir)
-        
-        # Try both import styles again
+        conn = sqlite3.connect(db_path, timeout=5.0)
+        try:
+            conn.row_factory = sqlite3.Row
+            targets = [dict(row) for row in conn.execute(FAST_COMMANDS[command])]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    print(json.dumps(targets))
+    return True
+
+# Skip the imports below entirely for the fast path
+if __name__ == '__main__' and fast_json_list(sys.argv[1:]):
+    sys.exit(0)
+
+import argparse
+import time
+
+# Make the mitm_modular package importable when this file is run directly
+tools_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if tools_dir not in sys.path:
+    sys.path.insert(0, tools_dir)
+
+from mitm_modular.database import TargetDatabase, resolve_db_path
+from mitm_modular.matching import normalize_headers, normalize_methods
+from mitm_modular.headers import HeaderPatch
+
+def open_database(db_path, local=False):
+    """Use the control server of a proxy running on db_path if there is one, else open the database directly"""
+    resolved = resolve_db_path(db_path)
+    # Same file as control.control_file_path; without it there is no proxy to import the client for
+    if not local and os.path.exists(resolved + '-control.json'):
+        from mitm_modular.control import ControlClient, ControlUnavailable
         try:
-            from database import TargetDatabase
-        except ImportError:
-            try:
-                from mitm_modular.database import TargetDatabase
-            except ImportError as e:
-                print(f"ERROR: Failed to import TargetDatabase: {e}")
-                print(f"Python path: {sys.path}")
-                print(f"Current directory: {os.getcwd()}")
-                sys.exit(1)
+            return ControlClient.discover(resolved)
+        except ControlUnavailable:
+            pass
+    return TargetDatabase(db_path)
 
 def json_list_targets(db):
     """List all targets in JSON format for machine consumption"""
@@ -60,18 +108,73 @@ def list_targets(db):
             t['id'],
             t['url'],
             t['status_code'] or 'Any',
+            t.get('methods') or 'Any',
             t['target_status_code'] or 'No change',
             t['modification_type'],
+            t.get('priority') or 0,
             dynamic_code,
             static_response,
             'Enabled' if t['is_enabled'] else 'Disabled'
         ])
     
-    headers = ['ID', 'URL', 'Match Status', 'Target Status', 'Type', 'Dynamic Code', 'Static Response', 'Status']
+    headers = ['ID', 'URL', 'Match Status', 'Methods', 'Target Status', 'Type', 'Priority', 'Dynamic Code', 'Static Response', 'Status']
+    from tabulate import tabulate
     print(tabulate(table_data, headers=headers, tablefmt='grid'))
 
+def _parse_header_args(values):
+    """Turn --header arguments (NAME=VALUE, NAME~REGEX, NAME or !NAME) into request header predicates"""
+    predicates = {}
+    for value in values or ():
+        if value.startswith('!'):
+            predicates[value[1:].strip()] = False
+            continue
+        separators = [i for i in (value.find('='), value.find('~')) if i > 0]
+        if not separators:
+            predicates[value.strip()] = True
+            continue
+        split = min(separators)
+        name, expected = value[:split].strip(), value[split + 1:]
+        predicates[name] = expected if value[split] == '=' else {'regex': expected}
+    return predicates or None
+
+def _header_operations(args):
+    """Header edits from --header-ops/--header-ops-file followed by the --*-header shorthands, as JSON or None"""
+    from mitm_modular import codec
+    operations = []
+    if args.header_ops_file:
+        with open(args.header_ops_file, 'r') as f:
+            operations = codec.loads(f.read())
+    elif args.header_ops:
+        operations = codec.loads(args.header_ops)
+    if not isinstance(operations, list):
+        raise ValueError("header edits must be a JSON list")
+    for op, value in args.header_edits or ():
+        name, _, header_value = value.partition('=')
+        operation = {'op': op, 'name': name.strip(), 'phase': args.header_phase}
+        if op != 'remove':
+            operation['value'] = header_value
+        operations.append(operation)
+    return json.dumps(operations) if operations else None
+
 def add_target(db, args):
     """Add a new target to the database"""
+    if args.mock and args.type != 'static':
+        print("Error: --mock is only supported for static modifications")
+        return False
+        
+    # Request predicates and header edits shared by every modification type
+    try:
+        match = {
+            'methods': normalize_methods(args.method),
+            'request_headers': normalize_headers(_parse_header_args(args.header)),
+            'header_operations': _header_operations(args),
+        }
+        if match['header_operations'] and HeaderPatch(match['header_operations']).request and args.status is not None:
+            raise ValueError("request header edits cannot be combined with --status, requests are sent before it is known")
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+        
     # For dynamic modification
     if args.type == 'dynamic':
         if args.code_file:
@@ -88,7 +191,9 @@ def add_target(db, args):
             status_code=args.status,
             target_status_code=args.target_status,
             modification_type='dynamic',
-            dynamic_code=dynamic_code
+            dynamic_code=dynamic_code,
+            priority=args.priority,
+            **match
         )
         
     # For static modification
@@ -103,31 +208,66 @@ def add_target(db, args):
             return False
             
         # Validate JSON
+        from mitm_modular import codec
         try:
-            json.loads(static_response)
-        except json.JSONDecodeError as e:
+            codec.loads(static_response)
+        except ValueError as e:
             print(f"Error: Invalid JSON in static response: {e}")
             return False
             
+        if args.mock and args.status is not None:
+            print("Error: --mock cannot be combined with --status, the upstream response is never fetched")
+            return False
+            
         target_id = db.add_target(
             url=args.url,
             status_code=args.status,
             target_status_code=args.target_status,
             modification_type='static',
-            static_response=static_response
+            static_response=static_response,
+            is_mock=args.mock,
+            priority=args.priority,
+            **match
         )
         
+    # For patch modification
+    elif args.type == 'patch':
+        if args.patch_file:
+            with open(args.patch_file, 'r') as f:
+                patch_operations = f.read()
+        elif args.patch:
+            patch_operations = args.patch
+        else:
+            print("Error: For patch modifications, you must provide --patch or --patch-file")
+            return False
+            
+        try:
+            target_id = db.add_target(
+                url=args.url,
+                status_code=args.status,
+                target_status_code=args.target_status,
+                modification_type='patch',
+                patch_operations=patch_operations,
+                priority=args.priority,
+                **match
+            )
+        except ValueError as e:
+            print(f"Error: Invalid patch: {e}")
+            return False
+        
     # For none modification (status code only)
     elif args.type == 'none':
-        if not args.target_status:
-            print("Error: For 'none' modification type, you must provide --target-status")
+        if not args.target_status and not match['header_operations']:
+            print("Error: For 'none' modification type, you must provide --target-status or header edits")
             return False
             
         target_id = db.add_target(
             url=args.url,
             status_code=args.status,
             target_status_code=args.target_status,
-            modification_type='none'
+            modification_type='none',
+            priority=args.priority,
+            **match
         )
     
     print(f"Target added with ID: {target_id}")
@@ -142,11 +282,28 @@ def delete_target(db, target_id):
 
 def enable_disable_target(db, target_id, enable=True):
     """Enable or disable a target"""
-    if db.update_target(target_id, is_enabled=1 if enable else 0):
+    try:
+        updated = db.update_target(target_id, is_enabled=1 if enable else 0)
+    except ValueError as e:
+        print(f"Error: Target {target_id} is invalid: {e}")
+        return
+    if updated:
         print(f"Target {target_id} {'enabled' if enable else 'disabled'} successfully")
     else:
         print(f"Error: Target {target_id} not found")
 
+def set_priority(db, target_id, priority):
+    """Change the order in which a target is applied"""
+    try:
+        updated = db.update_target(target_id, priority=priority)
+    except ValueError as e:
+        print(f"Error: Target {target_id} is invalid: {e}")
+        return
+    if updated:
+        print(f"Target {target_id} priority set to {priority}")
+    else:
+        print(f"Error: Target {target_id} not found")
+
 def view_target(db, target_id):
     """View details of a specific target"""
     target = db.get_target(target_id)
@@ -157,9 +314,16 @@ def view_target(db, target_id):
     print(f"Target ID: {target['id']}")
     print(f"URL: {target['url']}")
     print(f"Match Status Code: {target['status_code'] or 'Any'}")
+    print(f"Match Methods: {target.get('methods') or 'Any'}")
+    if target.get('request_headers'):
+        print(f"Match Request Headers: {target['request_headers']}")
+    if target.get('header_operations'):
+        print(f"Header Edits: {target['header_operations']}")
     print(f"Target Status Code: {target['target_status_code'] or 'No change'}")
     print(f"Modification Type: {target['modification_type']}")
     print(f"Enabled: {'Yes' if target['is_enabled'] else 'No'}")
+    print(f"Mock: {'Yes' if target.get('is_mock') else 'No'}")
+    print(f"Priority: {target.get('priority') or 0}")
     
     if target['modification_type'] == 'dynamic':
         print("\nDynamic Code:")
@@ -169,36 +333,295 @@ def view_target(db, target_id):
         print("\nStatic Response:")
         print("---------------")
         print(target['static_response'])
+    elif target['modification_type'] == 'patch':
+        print("\nPatch Operations:")
+        print("----------------")
+        print(target.get('patch_operations'))
     elif target['modification_type'] == 'none':
         print("\nNo content modification (status code only)")
 
 def reload_targets(db):
     """Reload targets in the proxy"""
-    print("Reload command received. Targets will be reloaded on next request.")
-    # In a real implementation, this would signal the proxy to reload
+    # A running proxy watches the database and reloads on any change
+    db.touch()
+    print("Reload signalled. A running proxy picks up target changes automatically.")
 
 def delete_all_targets(db):
     """Delete all targets from the database"""
-    # Get all targets including disabled ones
-    targets = db.get_all_targets_including_disabled()
+    deleted = db.delete_all_targets()
     
-    if not targets:
+    if not deleted:
         print("No targets found to delete.")
         return
     
-    # Delete each target one by one
-    success_count = 0
-    for target in targets:
-        target_id = target['id']
-        if db.delete_target(target_id):
-            success_count += 1
-            print(f"Target {target_id} deleted successfully")
-        else:
-            print(f"Error: Failed to delete target {target_id}")
+    print(f"Deleted {deleted} targets")
+
+def _read_targets_file(path):
+    """Read targets from a JSON array or JSON Lines file ('-' for stdin)"""
+    from mitm_modular import codec
+    if path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        return codec.loads(stripped)
     
-    print(f"Deleted {success_count} out of {len(targets)} targets")
+    targets = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            targets.append(codec.loads(line))
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}") from None
+    return targets
+
+def import_targets(db, args):
+    """Import targets from a JSON array or JSON Lines file in one transaction"""
+    try:
+        targets = _read_targets_file(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read targets from {args.file}: {e}")
+        return False
+    
+    if not isinstance(targets, list):
+        print("Error: Expected a JSON array or one JSON object per line")
+        return False
+    
+    try:
+        counts = db.import_targets(targets, replace=args.replace)
+    except ValueError as e:
+        print(f"Error: Nothing imported, invalid {e}")
+        return False
+    
+    summary = f"Imported {len(targets)} targets ({counts['inserted']} added, {counts['updated']} updated"
+    if args.replace:
+        summary += f", {counts['deleted']} replaced"
+    print(summary + ")")
+    return True
+
+def export_targets(db, args):
+    """Export targets as JSON Lines or a JSON array"""
+    targets = db.export_targets(include_disabled=not args.enabled_only)
+    
+    if args.format == 'json':
+        output = json.dumps(targets, indent=2) + '\n'
+    else:
+        output = ''.join(json.dumps(target) + '\n' for target in targets)
+    
+    if args.file and args.file != '-':
+        with open(args.file, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"Exported {len(targets)} targets to {args.file}")
+    else:
+        sys.stdout.write(output)
+    return True
+
+def _ms(seconds):
+    """Format a duration in seconds as milliseconds"""
+    return '-' if seconds is None else f"{seconds * 1000:.3f}"
+
+def _print_metrics(stats):
+    """Print the stage, target, cache and capture tables of a metrics snapshot"""
+    from tabulate import tabulate
+    stage_rows = []
+    for s in stats['stages']:
+        stage_rows.append([
+            s['stage'],
+            'All' if s['target_id'] is None else s['target_id'],
+            s['count'],
+            _ms(s['sum'] / s['count'] if s['count'] else None),
+            _ms(s['p50']),
+            _ms(s['p99']),
+            _ms(s['sum']),
+        ])
+    if stage_rows:
+        headers = ['Stage', 'Target', 'Count', 'Mean (ms)', 'p50 (ms)', 'p99 (ms)', 'Total (ms)']
+        print(tabulate(stage_rows, headers=headers, tablefmt='grid'))
+    else:
+        print("No responses processed yet.")
+        
+    target_rows = []
+    for t in stats['targets']:
+        errors = ', '.join(f"{stage}: {n}" for stage, n in sorted(t['errors'].items())) or '-'
+        target_rows.append([t['target_id'], t['applied'], errors])
+    if target_rows:
+        print(tabulate(target_rows, headers=['Target', 'Applied', 'Errors'], tablefmt='grid'))
+
+    cache = stats.get('collectors', {}).get('match_cache')
+    if cache:
+        lookups = cache['hits'] + cache['misses']
+        hit_rate = f"{100.0 * cache['hits'] / lookups:.1f}%" if lookups else '-'
+        print(f"Match cache: {cache['hits']} hits, {cache['misses']} misses (hit rate {hit_rate}), "
+              f"{cache['size']}/{cache['maxsize']} entries")
+
+    capture = stats.get('collectors', {}).get('capture')
+    if capture:
+        print(f"Captures: {capture['written']} written, {capture['dropped']} dropped, "
+              f"{capture['queued_bytes'] / 1024:.0f} KB queued")
+
+    workers = stats.get('workers')
+    if workers:
+        print(f"Workers: {sum(w['alive'] for w in workers)}/{len(workers)} running, "
+              f"{sum(w['connections'] for w in workers)} connections, {sum(w['restarts'] for w in workers)} restarts")
+
+def show_stats(db, args):
+    """Show the metrics of a running proxy"""
+    from mitm_modular.control import ControlUnavailable, fetch_stats
+    remote = not isinstance(db, TargetDatabase)
+    if args.reset and not (args.port is None and remote):
+        # Clearing the metrics takes the token of the control file
+        print("Error: --reset needs the running proxy announced for the database, not --port or --local")
+        return False
+    try:
+        if args.port is None and remote:
+            stats = db.stats(reset=args.reset)
+        elif args.port is None:
+            stats = fetch_stats(reset=args.reset)
+        else:
+            stats = fetch_stats(port=args.port, reset=args.reset)
+    except (OSError, ControlUnavailable) as e:
+        print(f"Error: Could not reach the proxy metrics endpoint: {e}")
+        return False
+        
+    if args.json:
+        print(json.dumps(stats))
+        return True
+        
+    print(f"Uptime: {stats['uptime']:.0f}s")
+    _print_metrics(stats)
+    return True
+
+def show_log(db):
+    """Print the recent log records kept in memory by the running proxy"""
+    if isinstance(db, TargetDatabase):
+        print("Error: No running proxy found for this database; the log buffer is kept by the proxy process")
+        return False
+    for line in db.dump_log():
+        print(line)
+    return True
+
+def _body_text(body):
+    if body is None:
+        return '(none)'
+    return body.decode('utf-8', errors='replace')
+
+def show_captures(args):
+    """List recent captures, or show one with its bodies, or clear them"""
+    from mitm_modular.capture import capture_path, list_captures, get_capture, clear_captures
+    path = capture_path(resolve_db_path(args.db))
+    if args.clear:
+        print(f"Deleted {clear_captures(path)} captures")
+        return True
+    try:
+        if args.show is not None:
+            capture = get_capture(path, args.show)
+            if capture is None:
+                print(f"Capture with ID {args.show} not found")
+                return False
+            print(f"ID: {capture['id']}")
+            print(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(capture['captured_at']))}")
+            print(f"Request: {capture['method']} {capture['url']}")
+            original_status = capture['original_status'] if capture['original_status'] is not None else 'mocked'
+            print(f"Status: {original_status} -> {capture['status_code']}")
+            print(f"Targets: {capture['target_ids'] or '-'}")
+            if capture['timings']:
+                timings = json.loads(capture['timings'])
+                print("Timings: " + ', '.join(f"{stage} {ms:.3f} ms" for stage, ms in timings.items()))
+            if capture['truncated']:
+                print("(bodies truncated)")
+            print("\nOriginal body:")
+            print(_body_text(capture['original_body']))
+            print("\nModified body:")
+            print(_body_text(capture['modified_body']))
+            return True
+        captures = list_captures(path, limit=args.limit, target_id=args.target)
+    except (FileNotFoundError, sqlite3.Error) as e:
+        print(f"Error: Could not read captures: {e}")
+        return False
+
+    if not captures:
+        print("No captures found.")
+        return True
+    from tabulate import tabulate
+    rows = []
+    for c in captures:
+        original_status = c['original_status'] if c['original_status'] is not None else 'mock'
+        rows.append([
+            c['id'],
+            time.strftime('%H:%M:%S', time.localtime(c['captured_at'])),
+            c['method'],
+            c['url'][:60] + ('...' if len(c['url']) > 60 else ''),
+            f"{original_status} -> {c['status_code']}",
+            c['target_ids'] or '-',
+            '-' if c['original_size'] is None else c['original_size'],
+            '-' if c['modified_size'] is None else c['modified_size'],
+        ])
+    headers = ['ID', 'Time', 'Method', 'URL', 'Status', 'Targets', 'Original (B)', 'Modified (B)']
+    print(tabulate(rows, headers=headers, tablefmt='grid'))
+    return True
+
+def replay_flows(args):
+    """Replay recorded flows through the modifier offline; False if they failed or differ from the baseline"""
+    db_path = resolve_db_path(args.db)
+    if not os.path.exists(db_path):
+        print(f"Error: No target database at {db_path}")
+        return False
+    from mitm_modular.replay import load_exchanges, load_baseline, save_baseline, compare_outputs, replay
+    try:
+        exchanges = load_exchanges(args.files)
+        baseline = load_baseline(args.baseline) if args.baseline else None
+        report = replay(db_path, exchanges, processes=args.processes, repeat=args.repeat, engine=args.engine,
+                        compression=args.compression, json_backend=args.codec,
+                        record_outputs=bool(args.baseline or args.save_baseline))
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not replay flows: {e}")
+        return False
+
+    outputs = report.pop('outputs')
+    differences = compare_outputs(baseline, outputs) if baseline is not None else []
+    if args.save_baseline:
+        save_baseline(args.save_baseline, outputs)
+
+    if args.json:
+        report['differences'] = differences
+        print(json.dumps(report))
+        return not differences
+
+    from tabulate import tabulate
+    throughput = f"{report['throughput']:.1f}" if report['throughput'] else '-'
+    print(f"Replayed {report['flows']} flows ({report['exchanges']} recorded x {report['repeat']}) "
+          f"on {report['processes']} process(es) in {report['seconds']:.3f}s: {throughput} flows/s")
+    latency = report['latency']
+    print(f"Per flow: mean {_ms(latency['mean'])} ms, p50 {_ms(latency['p50'])} ms, "
+          f"p99 {_ms(latency['p99'])} ms, max {_ms(latency['max'])} ms")
+    rows = [['None' if t['target_id'] is None else t['target_id'], t['flows'], _ms(t['mean']), _ms(t['p50']),
+             _ms(t['p99']), _ms(t['max'])] for t in report['targets']]
+    print(tabulate(rows, headers=['Target', 'Flows', 'Mean (ms)', 'p50 (ms)', 'p99 (ms)', 'Max (ms)'],
+                   tablefmt='grid'))
+    _print_metrics(report['metrics'])
+
+    if args.save_baseline:
+        print(f"Saved the outputs of {len(outputs)} flows to {args.save_baseline}")
+    if baseline is not None:
+        if not differences:
+            print(f"No differences from the baseline {args.baseline}")
+        else:
+            print(f"{len(differences)} differences from the baseline {args.baseline}:")
+            rows = [[d['index'], d['url'][:60] + ('...' if len(d['url']) > 60 else ''), d['field'],
+                     d['baseline'], d['current']] for d in differences[:50]]
+            print(tabulate(rows, headers=['Flow', 'URL', 'Field', 'Baseline', 'Current'], tablefmt='grid'))
+            if len(differences) > 50:
+                print(f"... and {len(differences) - 50} more")
+    return not differences
 
 def main():
+    if fast_json_list(sys.argv[1:]):
+        return
+        
     parser = argparse.ArgumentParser(description='MITM Response Modifier CLI')
     subparsers = parser.add_subparsers(dest='command', help='Command to execute')
     
@@ -214,7 +637,7 @@ def main():
     add_parser.add_argument('url', help='Target URL or URL pattern')
     add_parser.add_argument('--status', type=int, help='HTTP status code to match (optional)')
     add_parser.add_argument('--target-status', type=int, help='Target HTTP status code to set (optional)')
-    add_parser.add_argument('--type', choices=['dynamic', 'static', 'none'], required=True, 
+    add_parser.add_argument('--type', choices=['dynamic', 'static', 'patch', 'none'], required=True, 
                            help='Modification type (none = status code only)')
     
     # Dynamic code options
@@ -224,6 +647,33 @@ def main():
     # Static response options
     add_parser.add_argument('--response', help='Static JSON response')
     add_parser.add_argument('--response-file', help='File containing static JSON response')
+    # Patch options
+    add_parser.add_argument('--patch', help='JSON patch operations, or a JSON merge patch object')
+    add_parser.add_argument('--patch-file', help='File containing JSON patch operations')
+    
+    add_parser.add_argument('--mock', action='store_true',
+                           help='Answer matching requests directly without contacting the upstream server (static only)')
+    add_parser.add_argument('--priority', type=int, default=0,
+                           help='Order in which matching targets are applied, lowest first (default 0)')
+    # Request predicates
+    add_parser.add_argument('--method', action='append',
+                           help='Only match requests with this method; repeat or comma-separate for several')
+    add_parser.add_argument('--header', action='append', metavar='PREDICATE',
+                           help='Only match requests whose headers satisfy NAME=VALUE (exact), NAME~REGEX, '
+                                'NAME (present) or !NAME (absent); repeatable')
+    # Header edits
+    add_parser.add_argument('--header-ops', help='JSON list of header edits ({"op", "name", "value", "phase"})')
+    add_parser.add_argument('--header-ops-file', help='File containing a JSON list of header edits')
+    for op, help_text in (('set', 'Set header NAME to VALUE, replacing any values (VALUE may use placeholders '
+                                  'such as {request.host})'),
+                          ('add', 'Add a NAME header with VALUE, keeping existing ones'),
+                          ('replace', 'Replace the values of header NAME with VALUE, only if it is present'),
+                          ('remove', 'Remove header NAME')):
+        add_parser.add_argument(f'--{op}-header', action='append', dest='header_edits',
+                               metavar='NAME' if op == 'remove' else 'NAME=VALUE',
+                               type=lambda value, op=op: (op, value), help=help_text + '; repeatable')
+    add_parser.add_argument('--header-phase', choices=['request', 'response'], default='response',
+                           help='Headers the --*-header edits apply to (default response)')
     
     # Delete command
     delete_parser = subparsers.add_parser('delete', help='Delete a target')
@@ -232,6 +682,16 @@ def main():
     # Delete All command
     delete_all_parser = subparsers.add_parser('delete-all', help='Delete all targets')
     
+    # Import/export commands
+    import_parser = subparsers.add_parser('import', help='Add or update targets from a JSON Lines file or JSON array')
+    import_parser.add_argument('file', help="File to read ('-' for stdin)")
+    import_parser.add_argument('--replace', action='store_true', help='Delete all existing targets first')
+    
+    export_parser = subparsers.add_parser('export', help='Write targets as JSON Lines or a JSON array')
+    export_parser.add_argument('file', nargs='?', help='File to write (stdout if omitted)')
+    export_parser.add_argument('--format', choices=['jsonl', 'json'], default='jsonl', help='Output format')
+    export_parser.add_argument('--enabled-only', action='store_true', help='Only export enabled targets')
+    
     # Enable command
     enable_parser = subparsers.add_parser('enable', help='Enable a target')
     enable_parser.add_argument('id', type=int, help='Target ID to enable')
@@ -240,6 +700,11 @@ def main():
     disable_parser = subparsers.add_parser('disable', help='Disable a target')
     disable_parser.add_argument('id', type=int, help='Target ID to disable')
     
+    # Priority command
+    priority_parser = subparsers.add_parser('priority', help='Set the order in which a target is applied')
+    priority_parser.add_argument('id', type=int, help='Target ID')
+    priority_parser.add_argument('priority', type=int, help='New priority, lower values are applied first')
+    
     # View command
     view_parser = subparsers.add_parser('view', help='View target details')
     view_parser.add_argument('id', type=int, help='Target ID to view')
@@ -247,8 +712,40 @@ def main():
     # Reload command
     reload_parser = subparsers.add_parser('reload', help='Tell the proxy to reload targets')
     
+    # Log command
+    subparsers.add_parser('log', help="Print the recent log records kept in the running proxy's ring buffer")
+    
+    # Stats command
+    stats_parser = subparsers.add_parser('stats', help='Show per-target and per-stage metrics of the running proxy')
+    stats_parser.add_argument('--port', type=int, help='Control port of the proxy (found automatically by default)')
+    stats_parser.add_argument('--json', action='store_true', help='Output the raw metrics as JSON')
+    stats_parser.add_argument('--reset', action='store_true', help='Clear the metrics after reading them')
+    
+    # Captures command
+    captures_parser = subparsers.add_parser('captures', help='List the flows recorded by the proxy (see modular_capture)')
+    captures_parser.add_argument('--limit', type=int, default=20, help='Number of captures to list, newest first')
+    captures_parser.add_argument('--target', type=int, help='Only list captures of this target ID')
+    captures_parser.add_argument('--show', type=int, metavar='ID', help='Show one capture with its bodies')
+    captures_parser.add_argument('--clear', action='store_true', help='Delete all captures')
+    
+    # Replay command
+    replay_parser = subparsers.add_parser('replay', help='Replay HAR files or mitmproxy flow dumps through the modifier offline')
+    replay_parser.add_argument('files', nargs='+', help='HAR files (.har) or flow files written by mitmdump -w')
+    replay_parser.add_argument('--processes', type=int, default=1, help='Number of processes to spread the flows over')
+    replay_parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay every flow')
+    # The keys of replay.ENGINES, spelled out so that building the parser does not import mitmproxy
+    replay_parser.add_argument('--engine', choices=['run_mitm', 'core'], default='run_mitm',
+                               help='Addon to replay through: run_mitm.py (used by the app) or mitm_modular.mitm_core')
+    replay_parser.add_argument('--compression', help='Compression policy of modified bodies (default: preserve)')
+    replay_parser.add_argument('--codec', default='auto', help='JSON codec backend: auto, orjson or stdlib')
+    replay_parser.add_argument('--save-baseline', metavar='FILE', help='Write the output of every flow to FILE')
+    replay_parser.add_argument('--baseline', metavar='FILE', help='Report flows whose output differs from FILE')
+    replay_parser.add_argument('--json', action='store_true', help='Output the report as JSON')
+    
     # Database option
     parser.add_argument('--db', default='targets.db', help='Database file path')
+    parser.add_argument('--local', action='store_true',
+                        help="Access the database directly even if a running proxy's control server is available")
     
     args = parser.parse_args()
     
@@ -256,7 +753,23 @@ def main():
         parser.print_help()
         return
         
-    db = TargetDatabase(args.db)
+    if args.command == 'captures':
+        # Captures are read from their own file, without the target database
+        show_captures(args)
+        return
+        
+    if args.command == 'replay':
+        # Replays load their own modifier on the database file, never a running proxy's
+        if not replay_flows(args):
+            sys.exit(1)
+        return
+        
+    db = open_database(args.db, local=args.local)
+    # Errors of calls into a running proxy; a local database raises none of them
+    control_errors = ()
+    if not isinstance(db, TargetDatabase):
+        from mitm_modular.control import ControlError, ControlUnavailable
+        control_errors = (ControlError, ControlUnavailable)
     
     try:
         if args.command == 'list':
@@ -271,14 +784,27 @@ def main():
             delete_target(db, args.id)
         elif args.command == 'delete-all':
             delete_all_targets(db)
+        elif args.command == 'import':
+            import_targets(db, args)
+        elif args.command == 'export':
+            export_targets(db, args)
         elif args.command == 'enable':
             enable_disable_target(db, args.id, enable=True)
         elif args.command == 'disable':
             enable_disable_target(db, args.id, enable=False)
+        elif args.command == 'priority':
+            set_priority(db, args.id, args.priority)
         elif args.command == 'view':
             view_target(db, args.id)
         elif args.command == 'reload':
             reload_targets(db)
+        elif args.command == 'stats':
+            show_stats(db, args)
+        elif args.command == 'log':
+            show_log(db)
+    except control_errors as e:
+        print(f"Error: {e}")
+        sys.exit(1)
     finally:
         db.close()
 
@@ -0,0 +1,114 @@
+import gc
+import json
+import os
+from typing import Any, Callable, Dict, Tuple, Union
+
+# Backend to use: "auto" (default) picks the fastest one installed, or a name from BACKENDS
+CODEC_ENV = 'MITM_MODULAR_JSON'
+
+Loads = Callable[[Union[bytes, str]], Any]
+Dumps = Callable[[Any], bytes]
+
+# Bodies from this size on are decoded with the cyclic garbage collector paused
+GC_PAUSE_SIZE = 64 * 1024
+
+
+def _pausing_gc(parse: Loads) -> Loads:
+    """Wrap a decoder to pause garbage collection while it decodes large documents.
+
+    Decoding allocates one container after another, and each batch triggers a
+    collection that scans them all again although decoded JSON cannot contain
+    reference cycles; on large bodies that is about half of the decode time.
+    """
+
+    def loads(data: Union[bytes, str]) -> Any:
+        if len(data) < GC_PAUSE_SIZE or not gc.isenabled():
+            return parse(data)
+        gc.disable()
+        try:
+            return parse(data)
+        finally:
+            gc.enable()
+
+    return loads
+
+
+_stdlib_loads: Loads = _pausing_gc(json.loads)
+
+
+# Formatted like json.dumps, as bodies were before orjson was supported, but refusing NaN and
+# Infinity, which are not JSON
+_stdlib_encoder = json.JSONEncoder(allow_nan=False)
+# Compact and UTF-8 like orjson, for the values orjson cannot encode; floats may still be written
+# differently (repr instead of the shortest round-trip form in rare cases)
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return _stdlib_encoder.encode(obj).encode('utf-8')
+
+
+def _compact_dumps(obj: Any) -> bytes:
+    return _compact_encoder.encode(obj).encode('utf-8')
+
+
+def _orjson_codec() -> Tuple[Loads, Dumps]:
+    import orjson
+
+    parse = orjson.loads
+    serialize = orjson.dumps
+    option = orjson.OPT_NON_STR_KEYS
+
+    def loads(data: Union[bytes, str]) -> Any:
+        try:
+            return parse(data)
+        except ValueError:
+            # Byte order marks, UTF-16, NaN and lone surrogates are only accepted by json
+            return json.loads(data)
+
+    loads = _pausing_gc(loads)
+
+    def dumps(obj: Any) -> bytes:
+        try:
+            return serialize(obj, option=option)
+        except TypeError:
+            # Integers beyond 64 bits, lone surrogates; json raises if it cannot either
+            return _compact_dumps(obj)
+
+    return loads, dumps
+
+
+# Fastest first; each factory raises ImportError when its library is missing
+BACKENDS: Dict[str, Callable[[], Tuple[Loads, Dumps]]] = {
+    'orjson': _orjson_codec,
+    'stdlib': lambda: (_stdlib_loads, _stdlib_dumps),
+}
+
+backend = 'stdlib'
+loads: Loads = _stdlib_loads
+dumps: Dumps = _stdlib_dumps
+
+
+def set_backend(name: str = 'auto') -> str:
+    """Switch loads/dumps to a backend, or the fastest installed one for "auto"; returns its name.
+
+    Call the functions through the module (codec.loads), not imported names,
+    so that a switch reaches every caller.
+    """
+    global backend, loads, dumps
+    if name == 'auto':
+        for candidate, factory in BACKENDS.items():
+            try:
+                loads, dumps = factory()
+            except ImportError:
+                continue
+            backend = candidate
+            return backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend: {name} (expected auto or one of {', '.join(BACKENDS)})")
+    loads, dumps = BACKENDS[name]()
+    backend = name
+    return backend
+
+
+set_backend(os.environ.get(CODEC_ENV, 'auto').strip().lower() or 'auto')
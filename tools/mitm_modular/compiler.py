@@ -0,0 +1,120 @@
+import abc
+import hashlib
+from types import CodeType
+from typing import Dict, Any, Optional, Iterable, Tuple
+
+from . import codec, compression
+from .headers import HeaderPatch
+from .patch import PatchPlan
+
+
+def source_digest(source: str) -> str:
+    """Return the content hash used to key compiled target artifacts"""
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class TargetCache(abc.ABC):
+    """Per-target artifacts built at load time, keyed by target id and source hash.
+
+    A reload only rebuilds targets whose source actually changed, and a broken
+    target is reported once instead of failing on every response.
+    """
+
+    # Subclasses set the modification type they handle (None for any) and the column holding its source
+    modification_type: Optional[str] = None
+    source_field: Optional[str] = None
+
+    def __init__(self):
+        self._built: Dict[Tuple[int, str], Any] = {}
+
+    def load(self, targets: Iterable[Dict[str, Any]]) -> Tuple[Dict[int, Any], Dict[int, str]]:
+        """Build artifacts for the matching targets.
+
+        Returns the artifacts by target id (None for targets that failed to
+        build) and the build errors by target id.
+        """
+        built = {}
+        by_target = {}
+        errors = {}
+
+        for target in targets:
+            source = target.get(self.source_field)
+            if not source or (self.modification_type is not None
+                              and target.get('modification_type') != self.modification_type):
+                continue
+            key = (target['id'], source_digest(source))
+            if key in self._built:
+                artifact = self._built[key]
+            else:
+                try:
+                    artifact = self._build(target['id'], source)
+                except Exception as e:
+                    artifact = None
+                    errors[target['id']] = str(e)
+            built[key] = artifact
+            by_target[target['id']] = artifact
+
+        # Entries for removed or edited targets are dropped here
+        self._built = built
+        return by_target, errors
+
+    @abc.abstractmethod
+    def _build(self, target_id: int, source: str) -> Any:
+        """Build the artifact for a single target, raising on invalid source"""
+
+
+class CodeCache(TargetCache):
+    """Compiled code objects for dynamic targets"""
+
+    modification_type = 'dynamic'
+    source_field = 'dynamic_code'
+
+    def _build(self, target_id: int, source: str) -> CodeType:
+        return compile(source, f"<target {target_id}>", 'exec')
+
+
+class StaticBody:
+    """A static response encoded once into ready-to-send bytes, and compressed once per Content-Encoding"""
+
+    __slots__ = ('content', 'content_length', 'encoded')
+
+    def __init__(self, static_response: str):
+        # Same serialization as modified responses, see codec
+        self.content = codec.dumps(codec.loads(static_response))
+        self.content_length = str(len(self.content))
+        self.encoded: Dict[str, bytes] = compression.precompress(self.content)
+
+    def uncompressed(self) -> 'StaticBody':
+        """A copy without the compressed variants, for sending to script workers"""
+        body = StaticBody.__new__(StaticBody)
+        body.content, body.content_length, body.encoded = self.content, self.content_length, {}
+        return body
+
+
+class StaticBodyCache(TargetCache):
+    """Pre-encoded response bodies for static targets"""
+
+    modification_type = 'static'
+    source_field = 'static_response'
+
+    def _build(self, target_id: int, source: str) -> StaticBody:
+        return StaticBody(source)
+
+
+class PatchCache(TargetCache):
+    """Compiled operation plans for patch targets"""
+
+    modification_type = 'patch'
+    source_field = 'patch_operations'
+
+    def _build(self, target_id: int, source: str) -> PatchPlan:
+        return PatchPlan(source)
+
+
+class HeaderPatchCache(TargetCache):
+    """Compiled header edits, for targets of any modification type"""
+
+    source_field = 'header_operations'
+
+    def _build(self, target_id: int, source: str) -> HeaderPatch:
+        return HeaderPatch(source)
@@ -0,0 +1,120 @@
+import functools
+import gzip
+import logging
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('mitm_modular.compression')
+
+# How modified bodies are encoded for the client:
+#   preserve   use the Content-Encoding the server sent, if any
+#   negotiate  use the best encoding the request's Accept-Encoding allows
+#   identity   always send them uncompressed
+POLICIES = ('preserve', 'negotiate', 'identity')
+DEFAULT_POLICY = 'preserve'
+
+# Encodings offered to clients, most preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Bodies smaller than this are not worth compressing when the server did not
+MIN_SIZE = 1024
+
+# Static bodies are compressed once per load, modified ones on every response
+STATIC_LEVELS = {'br': 6, 'gzip': 9}
+DYNAMIC_LEVELS = {'br': 4, 'gzip': 6}
+
+
+def compress(data: bytes, encoding: str, levels: Dict[str, int] = DYNAMIC_LEVELS) -> bytes:
+    """Encode data with a Content-Encoding; raises ValueError for unsupported ones"""
+    if encoding == 'gzip':
+        # mtime=0 keeps the output identical for identical bodies
+        return gzip.compress(data, levels['gzip'], mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=levels['br'])
+    # deflate, zstd and whatever else mitmproxy can encode, at its own levels
+    from mitmproxy.net import encoding as mitmproxy_encoding
+    return mitmproxy_encoding.encode(data, encoding)
+
+
+def precompress(data: bytes) -> Dict[str, bytes]:
+    """Every offered encoding of a static body, or none if it is too small to be worth it"""
+    if len(data) < MIN_SIZE:
+        return {}
+    return {encoding: compress(data, encoding, STATIC_LEVELS) for encoding in ENCODINGS}
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """The offered encoding an Accept-Encoding header prefers, or None for identity"""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def encode_body(content: bytes, policy: str, accept_encoding: Optional[str], current: Optional[str],
+                variants: Optional[Dict[str, bytes]] = None) -> Tuple[bytes, Optional[str], bool]:
+    """Choose how to send a modified body: (body, Content-Encoding or None, whether it was negotiated).
+
+    current is the Content-Encoding of the server's response. variants are
+    the precompressed encodings of a static body, which are always chosen by
+    Accept-Encoding since they cost nothing to send.
+    """
+    if policy == 'identity':
+        return content, None, False
+    if variants:
+        encoding = negotiate(accept_encoding)
+        return (variants[encoding], encoding, True) if encoding in variants else (content, None, True)
+    if policy == 'negotiate':
+        encoding = negotiate(accept_encoding) if len(content) >= MIN_SIZE else None
+        negotiated = True
+    else:
+        encoding = current.strip().lower() if current else None
+        negotiated = False
+    if encoding is None or encoding == 'identity':
+        return content, None, negotiated
+    try:
+        return compress(content, encoding), encoding, negotiated
+    except ValueError as e:
+        logger.warning("Cannot encode modified response as %s, sending it uncompressed: %s", encoding, e)
+        return content, None, negotiated
+
+
+def write_body(message, body: bytes, encoding: Optional[str], negotiated: bool = False,
+               content_length: Optional[str] = None) -> None:
+    """Set the raw body of a mitmproxy message with its Content-Encoding and Content-Length headers"""
+    headers = message.headers
+    message.raw_content = body
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    elif 'content-encoding' in headers:
+        del headers['content-encoding']
+    # A message with a Transfer-Encoding must not have a Content-Length
+    if 'transfer-encoding' in headers:
+        headers.pop('content-length', None)
+    else:
+        headers['Content-Length'] = content_length if content_length and not encoding else str(len(body))
+    if negotiated:
+        vary = headers.get('vary', '')
+        if 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+            headers['Vary'] = f"{vary}, Accept-Encoding" if vary.strip() else 'Accept-Encoding'
@@ -0,0 +1,323 @@
+import functools
+import json
+import logging
+import os
+import threading
+from typing import Dict, Any, List, Optional, Callable
+
+from .log import dump_recent
+
+logger = logging.getLogger('mitm_modular.control')
+
+DEFAULT_PORT = 45872
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# TargetDatabase methods callable through POST /rpc/<method>
+DB_METHODS = (
+    'get_all_targets', 'get_all_targets_including_disabled', 'get_target',
+    'add_target', 'update_target', 'delete_target', 'delete_all_targets',
+    'import_targets', 'export_targets',
+)
+
+# All RPC methods: the database methods plus 'touch' (reload now), 'stats', 'dump_log' (the log
+# ring buffer of the serving process) and 'ping'
+RPC_METHODS = DB_METHODS + ('touch', 'stats', 'dump_log', 'ping')
+
+TOKEN_HEADER = 'X-Modular-Token'
+# Token the control server accepts instead of a random one; set by the supervisor for its workers
+TOKEN_ENV = 'MITM_MODULAR_CONTROL_TOKEN'
+
+
+def control_file_path(db_path: str) -> str:
+    """Path of the file announcing the control server of a database"""
+    return db_path + '-control.json'
+
+
+def same_path(a: str, b: str) -> bool:
+    return os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
+
+
+class ControlUnavailable(Exception):
+    """No control server is serving the requested database"""
+
+
+class ControlError(Exception):
+    """The control server failed to run a call; the message is the server's"""
+
+
+class ControlServer:
+    """Loopback HTTP server exposing the running addon's targets and metrics.
+
+    GET /metrics returns the OpenMetrics text format and GET /stats the JSON
+    metrics snapshot; the stats RPC with reset=True clears them. POST /rpc/<method>
+    calls a TargetDatabase method on the addon's own connection with a JSON
+    body of {"args": [...], "kwargs": {...}} and answers {"result": ...}.
+    The database validates what it writes: a target that cannot be stored is
+    answered with 400 and {"error": message, "type": "ValueError"}.
+
+    RPC calls must carry the token written to the control file next to the
+    database, so only local users who can read the database can change targets
+    or clear metrics. The token is random unless given, or set in TOKEN_ENV.
+    Without announce, no control file is written and only /metrics and /stats
+    are of use to callers that do not know the token.
+    """
+
+    def __init__(self, db, metrics, reload: Callable[[], None], host: str = '127.0.0.1',
+                 port: int = DEFAULT_PORT, announce: bool = True, token: Optional[str] = None):
+        self.db = db
+        self.metrics = metrics
+        self.reload = reload
+        self.host = host
+        self.port = port
+        self.announce = announce
+        if token is None:
+            token = os.environ.get(TOKEN_ENV)
+        if not token:
+            import secrets
+            token = secrets.token_urlsafe(24)
+        self.token = token
+        self.control_file = control_file_path(db.db_path)
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start serving in a daemon thread; failures to bind are logged, not raised"""
+        if self._server is not None:
+            return
+        from http.server import ThreadingHTTPServer
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        except OSError as e:
+            logger.warning("Could not serve the control API on %s:%d: %s", self.host, self.port, e)
+            return
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mitm_modular-control', daemon=True)
+        self._thread.start()
+        if self.announce:
+            self._write_control_file()
+        logger.info("Serving control API and metrics on http://%s:%d", self.host, self.port)
+
+    def stop(self):
+        """Stop serving, release the port and withdraw the control file"""
+        if self._server is None:
+            return
+        if self.announce:
+            self._remove_control_file()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def _write_control_file(self):
+        info = {'host': self.host, 'port': self.port, 'token': self.token, 'pid': os.getpid(),
+                'db_path': self.db.db_path}
+        tmp_path = f"{self.control_file}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(info, f)
+            os.replace(tmp_path, self.control_file)
+        except OSError as e:
+            logger.warning("Could not write control file %s: %s", self.control_file, e)
+
+    def _remove_control_file(self):
+        # Leave the file alone if another proxy has taken over the database since
+        try:
+            with open(self.control_file) as f:
+                if json.load(f).get('token') != self.token:
+                    return
+            os.remove(self.control_file)
+        except (OSError, ValueError):
+            pass
+
+    def call(self, method: str, args: List[Any], kwargs: Dict[str, Any]) -> Any:
+        """Run an RPC method"""
+        if method == 'ping':
+            return {'db_path': self.db.db_path, 'pid': os.getpid()}
+        if method == 'touch':
+            # Reload right away instead of waiting for the database watcher
+            self.reload()
+            return None
+        if method == 'stats':
+            snapshot = self.metrics.snapshot()
+            if kwargs.get('reset'):
+                self.metrics.reset()
+            return snapshot
+        if method == 'dump_log':
+            return dump_recent()
+        return getattr(self.db, method)(*args, **kwargs)
+
+    def _handler_class(self):
+        import secrets
+        from http.server import BaseHTTPRequestHandler
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so a client can issue several calls over one connection
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; avoid the delayed-ACK stall
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    self._send(200, OPENMETRICS_CONTENT_TYPE, server.metrics.render_openmetrics())
+                elif self.path == '/stats':
+                    self._send_json(200, server.metrics.snapshot())
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                # Browsers send Origin on cross-site requests; local tools do not
+                if self.headers.get('Origin'):
+                    self._send_json(403, {'error': 'cross-origin requests are not allowed'})
+                elif self.path.startswith('/rpc/'):
+                    self._rpc(self.path[len('/rpc/'):], body)
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def _rpc(self, method: str, body: bytes):
+                if not secrets.compare_digest(self.headers.get(TOKEN_HEADER, ''), server.token):
+                    self._send_json(403, {'error': 'invalid token'})
+                    return
+                if method not in RPC_METHODS:
+                    self._send_json(404, {'error': f'unknown method: {method}'})
+                    return
+                try:
+                    request = json.loads(body or b'{}')
+                    db_path = request.get('db_path')
+                    if db_path and not same_path(db_path, server.db.db_path):
+                        self._send_json(409, {'error': f'serving {server.db.db_path}, not {db_path}'})
+                        return
+                    result = server.call(method, request.get('args', []), request.get('kwargs', {}))
+                except (ValueError, TypeError) as e:
+                    self._send_json(400, {'error': str(e), 'type': type(e).__name__})
+                    return
+                except Exception as e:
+                    logger.exception("Error in control call %s", method)
+                    self._send_json(500, {'error': str(e), 'type': type(e).__name__})
+                    return
+                self._send_json(200, {'result': result})
+
+            def _send_json(self, status: int, payload: Any):
+                self._send(status, 'application/json', json.dumps(payload))
+
+            def _send(self, status: int, content_type: str, body: str):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
+
+
+class ControlClient:
+    """Calls TargetDatabase methods on a running addon through its control server.
+
+    Offers the same methods as TargetDatabase, so callers can use either
+    interchangeably. ValueErrors raised by the server are raised again here,
+    other errors of the call as ControlError.
+    Speaks just enough HTTP/1.1 over a raw socket for the control server,
+    since importing http.client would dominate a short CLI run.
+    """
+
+    def __init__(self, db_path: str, host: str, port: int, token: str, timeout: float = 10.0):
+        self.db_path = db_path
+        self.host = host
+        self.port = port
+        self.token = token
+        self.timeout = timeout
+        self._sock = None
+        self._rfile = None
+
+    @classmethod
+    def discover(cls, db_path: str, timeout: float = 10.0) -> 'ControlClient':
+        """Connect to the control server announced for db_path, raising ControlUnavailable if none"""
+        try:
+            with open(control_file_path(db_path)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            raise ControlUnavailable(f"no control server announced for {db_path}") from None
+        client = cls(db_path, info.get('host', '127.0.0.1'), info['port'], info['token'], timeout)
+        # Verifies both that the server is up and that it serves this database
+        client.call('ping')
+        return client
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """Call an RPC method and return its result"""
+        body = json.dumps({'db_path': self.db_path, 'args': args, 'kwargs': kwargs}).encode('utf-8')
+        try:
+            status, data = self._post(f'/rpc/{method}', body)
+            payload = json.loads(data or b'{}')
+        except (OSError, ValueError) as e:
+            self.close()
+            raise ControlUnavailable(f"control server not reachable: {e}") from None
+        if status == 200:
+            return payload.get('result')
+        if status == 400:
+            raise ValueError(payload.get('error'))
+        if status == 500:
+            raise ControlError(f"{method} failed in the proxy: {payload.get('error')}")
+        raise ControlUnavailable(payload.get('error') or f"HTTP {status}")
+
+    def _post(self, path: str, body: bytes):
+        """Send a POST request on the kept-alive connection and return (status, body)"""
+        if self._sock is None:
+            import socket
+            self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._rfile = self._sock.makefile('rb')
+        head = (f"POST {path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"{TOKEN_HEADER}: {self.token}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n").encode('ascii')
+        self._sock.sendall(head + body)
+
+        status_line = self._rfile.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by the control server")
+        status = int(status_line.split()[1])
+        length = 0
+        while True:
+            line = self._rfile.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+        return status, self._rfile.read(length)
+
+    def __getattr__(self, name: str):
+        if name in RPC_METHODS:
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+
+    def close(self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = None
+            self._rfile = None
+
+
+def fetch_stats(host: str = '127.0.0.1', port: int = DEFAULT_PORT, reset: bool = False,
+                timeout: float = 2.0, token: Optional[str] = None) -> Dict[str, Any]:
+    """Fetch the JSON metrics snapshot from a running addon, clearing it if reset (which needs the token)"""
+    import urllib.request
+    if not reset:
+        return json.loads(urllib.request.urlopen(f'http://{host}:{port}/stats', timeout=timeout).read())
+    if not token:
+        raise ValueError("clearing the metrics needs the control token")
+    request = urllib.request.Request(f'http://{host}:{port}/rpc/stats', method='POST',
+                                     data=json.dumps({'kwargs': {'reset': True}}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json', TOKEN_HEADER: token})
+    return json.loads(urllib.request.urlopen(request, timeout=timeout).read())['result']
@@ -1,127 +1,331 @@
+import contextlib
+import logging
 import sqlite3
 import os
 import json
+import threading
 import time
 import sys
 from typing import Dict, Any, List, Optional, Union
 
+from .headers import HeaderPatch
+from .matching import normalize_headers, normalize_methods
+from .patch import PatchPlan
+
+logger = logging.getLogger('mitm_modular.database')
+
+# Statements are kept as constants so that sqlite3's per-connection statement
+# cache prepares each of them only once
+# Enabled targets in the order they are applied
+SELECT_ENABLED = "SELECT * FROM targets WHERE is_enabled = 1 ORDER BY priority, id"
+SELECT_ALL = "SELECT * FROM targets ORDER BY id"
+SELECT_BY_ID = "SELECT * FROM targets WHERE id = ?"
+INSERT_TARGET = '''
+    INSERT INTO targets (url, status_code, target_status_code, modification_type, dynamic_code, static_response, is_mock,
+                         priority, patch_operations, methods, request_headers, header_operations)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+DELETE_BY_ID = "DELETE FROM targets WHERE id = ?"
+DELETE_ALL = "DELETE FROM targets"
+INSERT_FULL = '''
+    INSERT INTO targets (url, status_code, target_status_code, modification_type, dynamic_code, static_response,
+                         is_enabled, is_mock, priority, patch_operations, methods, request_headers,
+                         header_operations)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+UPDATE_FULL = '''
+    UPDATE targets SET url = ?, status_code = ?, target_status_code = ?, modification_type = ?, dynamic_code = ?,
+                       static_response = ?, is_enabled = ?, is_mock = ?, priority = ?,
+                       patch_operations = ?, methods = ?, request_headers = ?, header_operations = ?
+    WHERE id = ?
+'''
+
+def resolve_db_path(db_path: str) -> str:
+    """Resolve a relative database path against the tools directory"""
+    # Check if the path is absolute or relative
+    if not os.path.isabs(db_path):
+        # Get the directory of this script
+        script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        db_path = os.path.join(script_dir, db_path)
+    return db_path
+
 class TargetDatabase:
+    # Columns added after the original schema, created on older databases when connecting
+    ADDED_COLUMNS = [
+        ('is_mock', 'INTEGER DEFAULT 0'),
+        ('priority', 'INTEGER DEFAULT 0'),
+        ('patch_operations', 'TEXT'),
+        # Comma-separated request methods, NULL for any
+        ('methods', 'TEXT'),
+        # JSON object of request header predicates, NULL for none
+        ('request_headers', 'TEXT'),
+        # JSON list of header edits, NULL for none
+        ('header_operations', 'TEXT'),
+    ]
+
+    # Indexes by name
+    INDEXES = {
+        'idx_targets_order': "CREATE INDEX IF NOT EXISTS idx_targets_order ON targets (is_enabled, priority, id)",
+        'idx_targets_key': "CREATE INDEX IF NOT EXISTS idx_targets_key ON targets (url, status_code)",
+    }
+
+    # Indexes of earlier versions, dropped when found
+    DROPPED_INDEXES = (
+        'idx_targets_enabled',  # Superseded by idx_targets_order
+    )
+
+    # Fields identifying a target across databases, used to upsert imported targets
+    KEY_FIELDS = ('url', 'status_code', 'methods', 'request_headers')
+
+    # Fields written by export_targets and read by import_targets, in column order
+    EXPORT_FIELDS = ('url', 'status_code', 'target_status_code', 'modification_type',
+                     'dynamic_code', 'static_response', 'is_enabled', 'is_mock', 'priority',
+                     'patch_operations', 'methods', 'request_headers', 'header_operations')
+
     def __init__(self, db_path="targets.db"):
         """Initialize the database connection"""
-        print(f"[DEBUG] Initializing database with path: {db_path}")
+        logger.debug("Initializing database with path: %s", db_path)
         
-        # Check if the path is absolute or relative
-        if not os.path.isabs(db_path):
-            # Get the directory of this script
-            script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            db_path = os.path.join(script_dir, db_path)
-            print(f"[DEBUG] Using absolute database path: {db_path}")
-            
-        # Check if the database exists
-        if not os.path.exists(db_path):
-            print(f"[DEBUG] Database file does not exist at: {db_path}")
-            # Try to create the database file
-            try:
-                self._create_db_if_not_exists(db_path)
-                print(f"[DEBUG] Created new database at: {db_path}")
-            except Exception as e:
-                print(f"[DEBUG] Error creating database: {e}")
-        else:
-            print(f"[DEBUG] Database file exists at: {db_path}")
+        db_path = resolve_db_path(db_path)
+        logger.debug("Using absolute database path: %s", db_path)
             
         self.db_path = db_path
         self.conn = None
-        self.cursor = None
+        # Serializes use of the shared connection between threads
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
         
-        # Connect to the database
+        # Connect to the database, creating it if needed
         try:
             self._connect()
-            print(f"[DEBUG] Successfully connected to database")
+            logger.debug("Successfully connected to database")
         except Exception as e:
-            print(f"[DEBUG] Error connecting to database: {e}")
+            logger.warning("Error connecting to database: %s", e)
             
-    def _create_db_if_not_exists(self, db_path):
-        """Create the database file if it doesn't exist"""
-        # Ensure the parent directory exists
-        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
-        
-        # Create the database file and tables
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Create targets table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS targets (
-                id INTEGER PRIMARY KEY,
-                url TEXT NOT NULL,
-                status_code INTEGER,
-                target_status_code INTEGER,
-                modification_type TEXT NOT NULL,
-                dynamic_code TEXT,
-                static_response TEXT,
-                is_enabled INTEGER DEFAULT 1,
-                created_at TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-
     def _connect(self):
-        """Connect to the SQLite database"""
+        """Open the connection that this instance keeps for its lifetime"""
         try:
-            print(f"[DEBUG] Connecting to database at: {self.db_path}")
-            self.conn = sqlite3.connect(self.db_path)
-            self.conn.row_factory = sqlite3.Row  # This enables column access by name
-            self.cursor = self.conn.cursor()
+            logger.debug("Connecting to database at: %s", self.db_path)
+            # Ensure the parent directory exists
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            # Autocommit mode: single writes commit immediately, batches use transaction()
+            conn = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row  # This enables column access by name
+            # WAL lets the proxy read while the CLI writes; NORMAL sync is durable enough under WAL
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn = conn
+            self._ensure_schema()
             return True
         except sqlite3.Error as e:
-            print(f"[DEBUG] Database connection error: {e}")
+            logger.warning("Database connection error: %s", e)
+            self.conn = None
             return False
 
-    def _disconnect(self):
-        """Close the database connection"""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
-            self.cursor = None
+    def _schema_outdated(self) -> bool:
+        """Whether the targets table, one of its columns or indexes is missing, or a dropped index is left"""
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(targets)")}
+        if not columns or any(name not in columns for name, _ in self.ADDED_COLUMNS):
+            return True
+        indexes = {row['name'] for row in self.conn.execute("PRAGMA index_list(targets)")}
+        return (any(name not in indexes for name in self.INDEXES)
+                or any(name in indexes for name in self.DROPPED_INDEXES))
+
+    def _ensure_schema(self):
+        """Create the targets table and indexes, and bring older databases up to date.
+
+        The schema is checked with reads first, so that connections to an
+        up-to-date database never wait for the write lock.
+        """
+        if not self._schema_outdated():
+            return
+        with self.transaction():
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS targets (
+                    id INTEGER PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status_code INTEGER,
+                    target_status_code INTEGER,
+                    modification_type TEXT NOT NULL,
+                    dynamic_code TEXT,
+                    static_response TEXT,
+                    is_enabled INTEGER DEFAULT 1,
+                    created_at TEXT,
+                    is_mock INTEGER DEFAULT 0,
+                    priority INTEGER DEFAULT 0,
+                    patch_operations TEXT,
+                    methods TEXT,
+                    request_headers TEXT,
+                    header_operations TEXT
+                )
+            ''')
+            existing = {row['name'] for row in self.conn.execute("PRAGMA table_info(targets)")}
+            for name, declaration in self.ADDED_COLUMNS:
+                if name not in existing:
+                    logger.info("Adding column %s to targets table", name)
+                    self.conn.execute(f"ALTER TABLE targets ADD COLUMN {name} {declaration}")
+            for name in self.DROPPED_INDEXES:
+                self.conn.execute(f"DROP INDEX IF EXISTS {name}")
+            for statement in self.INDEXES.values():
+                self.conn.execute(statement)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group writes into a single transaction, committed once at the end.
+
+        Nested uses join the outermost transaction; an exception rolls it back.
+        """
+        with self._lock:
+            if self.conn is None and not self._connect():
+                raise sqlite3.OperationalError(f"unable to open database: {self.db_path}")
+            outermost = self._transaction_depth == 0
+            if outermost:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._transaction_depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._transaction_depth -= 1
+                if outermost:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._transaction_depth -= 1
+            if outermost:
+                self.conn.execute("COMMIT")
+
+    def _query(self, sql: str, params=()) -> List[sqlite3.Row]:
+        """Run a read statement on the shared connection"""
+        with self._lock:
+            if self.conn is None and not self._connect():
+                raise sqlite3.OperationalError(f"unable to open database: {self.db_path}")
+            return self.conn.execute(sql, params).fetchall()
 
     def add_target(self, url: str, status_code: int = None, 
                    target_status_code: int = None,
                    modification_type: str = 'dynamic',
                    dynamic_code: str = None, 
-                   static_response: str = None) -> int:
-        """Add a new target to the database"""
-        if modification_type not in ('dynamic', 'static', 'none'):
-            raise ValueError("modification_type must be 'dynamic', 'static', or 'none'")
+                   static_response: str = None,
+                   is_mock: bool = False,
+                   priority: int = 0,
+                   patch_operations: str = None,
+                   methods: Union[str, List[str]] = None,
+                   request_headers: Union[str, Dict[str, Any]] = None,
+                   header_operations: str = None) -> int:
+        """Add a new target to the database.
+
+        Matching targets are applied in ascending priority, then id, order.
+        methods and request_headers restrict the requests a target matches,
+        see matching.normalize_methods and matching.HeaderRule. header_operations
+        edits request and response headers, see headers.HeaderPatch.
+        """
+        self._validate(status_code, modification_type, dynamic_code, static_response, is_mock, patch_operations,
+                       header_operations)
+        methods = normalize_methods(methods)
+        request_headers = normalize_headers(request_headers)
+        
+        with self.transaction() as conn:
+            cursor = conn.execute(INSERT_TARGET, (url, status_code, target_status_code, modification_type,
+                                                  dynamic_code, static_response, 1 if is_mock else 0,
+                                                  int(priority or 0), patch_operations, methods, request_headers,
+                                                  header_operations or None))
+            return cursor.lastrowid
+        
+    @staticmethod
+    def _validate(status_code, modification_type, dynamic_code, static_response, is_mock, patch_operations=None,
+                  header_operations=None):
+        """Raise ValueError for a target definition that cannot be stored"""
+        if modification_type not in ('dynamic', 'static', 'patch', 'none'):
+            raise ValueError("modification_type must be 'dynamic', 'static', 'patch', or 'none'")
             
         if modification_type == 'dynamic' and not dynamic_code:
             raise ValueError("dynamic_code is required for dynamic modification type")
             
         if modification_type == 'static' and not static_response:
             raise ValueError("static_response is required for static modification type")
+            
+        if modification_type == 'patch':
+            if not patch_operations:
+                raise ValueError("patch_operations is required for patch modification type")
+            # Raises ValueError describing the first invalid operation
+            PatchPlan(patch_operations)
+            
+        if is_mock and modification_type != 'static':
+            raise ValueError("only static targets can be mocked")
+            
+        if is_mock and status_code is not None:
+            raise ValueError("mock targets cannot match on the upstream status code")
+            
+        if header_operations:
+            # Raises ValueError describing the first invalid edit
+            header_patch = HeaderPatch(header_operations)
+            if header_patch.request is not None and status_code is not None:
+                raise ValueError("request headers are sent before the status code is known, "
+                                 "targets matching on it can only edit response headers")
         
-        query = '''
-            INSERT INTO targets (url, status_code, target_status_code, modification_type, dynamic_code, static_response)
-            VALUES (?, ?, ?, ?, ?, ?)
-        '''
+    def import_targets(self, targets: List[Dict[str, Any]], replace: bool = False) -> Dict[str, int]:
+        """Insert or update many targets in a single transaction.
+
+        Targets are matched to existing rows by KEY_FIELDS: a match is updated
+        in place (keeping its id), anything else is inserted. With replace=True
+        all existing targets are deleted first. An invalid target raises
+        ValueError and nothing is written.
+        """
+        rows = []
+        for i, target in enumerate(targets):
+            if not isinstance(target, dict):
+                raise ValueError(f"target {i + 1}: expected an object")
+            if not target.get('url'):
+                raise ValueError(f"target {i + 1}: url is required")
+            row = {field: target.get(field) for field in self.EXPORT_FIELDS}
+            row['modification_type'] = row['modification_type'] or 'dynamic'
+            row['is_enabled'] = 1 if target.get('is_enabled', 1) else 0
+            row['is_mock'] = 1 if row['is_mock'] else 0
+            try:
+                row['priority'] = int(row['priority'] or 0)
+            except (TypeError, ValueError):
+                raise ValueError(f"target {i + 1} ({row['url']}): priority must be an integer") from None
+            try:
+                self._validate(row['status_code'], row['modification_type'], row['dynamic_code'],
+                               row['static_response'], row['is_mock'], row['patch_operations'],
+                               row['header_operations'])
+                row['methods'] = normalize_methods(row['methods'])
+                row['request_headers'] = normalize_headers(row['request_headers'])
+            except ValueError as e:
+                raise ValueError(f"target {i + 1} ({row['url']}): {e}") from None
+            rows.append(row)
+            
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        with self.transaction() as conn:
+            existing = {}
+            if replace:
+                counts['deleted'] = conn.execute(DELETE_ALL).rowcount
+            else:
+                for row in conn.execute(SELECT_ALL):
+                    existing.setdefault(tuple(row[field] for field in self.KEY_FIELDS), row['id'])
+                    
+            for row in rows:
+                values = [row[field] for field in self.EXPORT_FIELDS]
+                key = tuple(row[field] for field in self.KEY_FIELDS)
+                target_id = existing.get(key)
+                if target_id is None:
+                    existing[key] = conn.execute(INSERT_FULL, values).lastrowid
+                    counts['inserted'] += 1
+                else:
+                    conn.execute(UPDATE_FULL, values + [target_id])
+                    counts['updated'] += 1
+        return counts
         
-        self.cursor.execute(query, (url, status_code, target_status_code, modification_type, dynamic_code, static_response))
-        self.conn.commit()
-        return self.cursor.lastrowid
+    def export_targets(self, include_disabled: bool = True) -> List[Dict[str, Any]]:
+        """Return targets with the fields import_targets accepts"""
+        rows = self._query(SELECT_ALL if include_disabled else SELECT_ENABLED)
+        return [{field: row[field] for field in self.EXPORT_FIELDS} for row in rows]
         
     def get_all_targets(self) -> List[Dict[str, Any]]:
         """Get all enabled targets from the database"""
         try:
-            print(f"[DEBUG] Getting all enabled targets from database")
-            if not self.cursor:
-                if not self._connect():
-                    print(f"[DEBUG] Failed to connect to database for get_all_targets")
-                    return []
-            
-            self.cursor.execute("SELECT * FROM targets WHERE is_enabled = 1")
-            rows = self.cursor.fetchall()
-            print(f"[DEBUG] Found {len(rows)} enabled targets in database")
+            logger.debug("Getting all enabled targets from database")
+            rows = self._query(SELECT_ENABLED)
+            logger.debug("Found %d enabled targets in database", len(rows))
             
             # Convert rows to dictionaries
             targets = [dict(row) for row in rows]
@@ -132,57 +336,82 @@ class TargetDatabase:
                 t = target.get('modification_type', 'unknown')
                 types[t] = types.get(t, 0) + 1
             
-            print(f"[DEBUG] Target types: {types}")
+            logger.debug("Target types: %s", types)
             return targets
             
         except sqlite3.Error as e:
-            print(f"[DEBUG] Error getting targets: {e}")
+            logger.warning("Error getting targets: %s", e)
             return []
-        finally:
-            self._disconnect()
         
     def get_all_targets_including_disabled(self) -> List[Dict[str, Any]]:
         """Get all targets from the database, including disabled ones"""
-        self.cursor.execute('SELECT * FROM targets')
-        columns = [col[0] for col in self.cursor.description]
-        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+        return [dict(row) for row in self._query(SELECT_ALL)]
         
     def get_target(self, target_id: int) -> Optional[Dict[str, Any]]:
         """Get a specific target by ID"""
-        self.cursor.execute('SELECT * FROM targets WHERE id = ?', (target_id,))
-        row = self.cursor.fetchone()
-        if row:
-            columns = [col[0] for col in self.cursor.description]
-            return dict(zip(columns, row))
+        rows = self._query(SELECT_BY_ID, (target_id,))
+        if rows:
+            return dict(rows[0])
         return None
     
     def update_target(self, target_id: int, **kwargs) -> bool:
-        """Update a target's properties"""
+        """Update a target's properties.
+
+        The updated target is validated like add_target does, raising
+        ValueError and writing nothing if it cannot be stored.
+        """
         allowed_fields = {'url', 'status_code', 'target_status_code', 'modification_type', 
-                          'dynamic_code', 'static_response', 'is_enabled'}
+                          'dynamic_code', 'static_response', 'is_enabled', 'is_mock', 'priority',
+                          'patch_operations', 'methods', 'request_headers', 'header_operations'}
         
         updates = {k: v for k, v in kwargs.items() if k in allowed_fields}
         if not updates:
             return False
+        if 'methods' in updates:
+            updates['methods'] = normalize_methods(updates['methods'])
+        if 'request_headers' in updates:
+            updates['request_headers'] = normalize_headers(updates['request_headers'])
             
         set_clause = ', '.join([f"{key} = ?" for key in updates.keys()])
         values = list(updates.values()) + [target_id]
         
         query = f"UPDATE targets SET {set_clause} WHERE id = ?"
-        self.cursor.execute(query, values)
-        self.conn.commit()
-        return self.cursor.rowcount > 0
+        with self.transaction() as conn:
+            # Read in the same transaction, so the row validated is the row written
+            row = conn.execute(SELECT_BY_ID, (target_id,)).fetchone()
+            if row is None:
+                return False
+            target = dict(row)
+            target.update(updates)
+            self._validate(target['status_code'], target['modification_type'], target['dynamic_code'],
+                           target['static_response'], target['is_mock'], target['patch_operations'],
+                           target['header_operations'])
+            return conn.execute(query, values).rowcount > 0
         
     def delete_target(self, target_id: int) -> bool:
         """Delete a target from the database"""
-        self.cursor.execute('DELETE FROM targets WHERE id = ?', (target_id,))
-        self.conn.commit()
-        return self.cursor.rowcount > 0
+        with self.transaction() as conn:
+            return conn.execute(DELETE_BY_ID, (target_id,)).rowcount > 0
         
+    def delete_all_targets(self) -> int:
+        """Delete every target in a single statement, returning how many were deleted"""
+        with self.transaction() as conn:
+            return conn.execute(DELETE_ALL).rowcount
+        
+    def touch(self):
+        """Record a change without modifying targets, so watching proxies reload"""
+        # user_version serves as a change counter; bumping it changes data_version
+        # for every other connection
+        with self.transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+
     def close(self):
         """Close the database connection"""
-        if self.conn:
-            self.conn.close()
+        with self._lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
             
     def __del__(self):
         """Ensure connection is closed when object is destroyed"""
@@ -0,0 +1,471 @@
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, Callable, Sequence, Iterable
+from mitmproxy import ctx, http
+
+from .database import TargetDatabase
+from .ruleset import RuleSet, RuleSetBuilder, RuleSetWatcher
+from .hostfilter import HostFilter
+from .log import get_logger, dump_recent
+from .matching import MatchCache, DEFAULT_MATCH_CACHE_SIZE
+from .headers import HeaderPatch
+from .metrics import Metrics
+from .compression import (POLICIES as COMPRESSION_POLICIES, DEFAULT_POLICY as COMPRESSION_POLICY,
+                          encode_body, write_body)
+from .capture import (CaptureStore, capture_path, DEFAULT_MAX_ROWS as CAPTURE_MAX_ROWS,
+                      DEFAULT_MAX_AGE as CAPTURE_MAX_AGE, DEFAULT_MAX_MB as CAPTURE_MAX_MB)
+from .transform import ChainResult, Step, apply_chain, build_steps, has_scripts
+from .executor import (ScriptExecutor, create_executor, SCRIPT_MODES,
+                       DEFAULT_WORKERS as SCRIPT_WORKERS, DEFAULT_TIMEOUT as SCRIPT_TIMEOUT)
+from .control import ControlServer, DEFAULT_PORT as CONTROL_PORT
+
+logger = get_logger('addon')
+
+# Flow metadata key holding (rule set generation, candidate target positions)
+CANDIDATES_KEY = 'mitm_modular.candidates'
+# Flow metadata key holding the id of the mock target that answered the request
+MOCKED_KEY = 'mitm_modular.mocked'
+
+class ResponseModifier:
+    # Whether target URLs with regular expression syntax are matched as regular expressions
+    use_regex = False
+
+    def __init__(self, db_path="targets.db"):
+        """Initialize the response modifier with a database connection"""
+        logger.debug("Initializing ResponseModifier with database: %s", db_path)
+        self.db = TargetDatabase(db_path)
+        self.builder = RuleSetBuilder(use_regex=self.use_regex)
+        self._reload_lock = threading.Lock()
+        # Created before the first load so that no change is missed in between
+        self.watcher = RuleSetWatcher(self.db.db_path, self.reload_targets)
+        # Called with no arguments after a new rule set was published
+        self.reload_listeners: List[Callable[[], None]] = []
+        self.metrics = Metrics()
+        # Runs dynamic scripts off the event loop; None runs them inline
+        self.executor: Optional[ScriptExecutor] = None
+        # How modified bodies are compressed, one of COMPRESSION_POLICIES
+        self.compression = COMPRESSION_POLICY
+        # Records modified flows when capturing is enabled
+        self.capture: Optional[CaptureStore] = None
+        # (method, URL, status code) -> matching positions, for the current rule set generation
+        self.match_cache = MatchCache(DEFAULT_MATCH_CACHE_SIZE)
+        self.metrics.register_collector('match_cache', self.match_cache.stats, self.match_cache.reset_counters)
+        self.rules = self.builder.build(self.db.get_all_targets())  # Already only returns enabled targets
+        logger.info("Loaded %d enabled targets from database", len(self.rules))
+        self._log_targets("Target")
+
+    @property
+    def targets(self) -> Tuple[Dict[str, Any], ...]:
+        """The enabled targets of the current rule set"""
+        return self.rules.targets
+                
+    def reload_targets(self):
+        """Reload targets from the database and publish them as a new rule set"""
+        logger.debug("Reloading targets from database")
+        with self._reload_lock:
+            old_count = len(self.rules)
+            
+            # The persistent connection sees every committed change, no reconnect needed
+            rules = self.builder.build(self.db.get_all_targets())
+            # Flows already being processed keep the snapshot they started with
+            self.rules = rules
+        
+        logger.info("Reloaded targets: was %d, now %d (generation %d)", old_count, len(rules), rules.generation)
+        self._log_targets("Reloaded target")
+        for listener in self.reload_listeners:
+            listener()
+
+    def _log_targets(self, label: str):
+        """Log the definition of every loaded target"""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        if not self.rules.targets:
+            logger.debug("No enabled targets found in database")
+        for i, target in enumerate(self.rules.targets):
+            logger.debug("%s %d: ID=%s, URL=%s, Type=%s, Status=%s, Target Status=%s, Enabled=%s",
+                         label, i + 1, target['id'], target['url'], target['modification_type'],
+                         target.get('status_code'), target.get('target_status_code'), target['is_enabled'] == 1)
+
+    def _is_json(self, flow: http.HTTPFlow) -> bool:
+        """Check whether the response declares a JSON content type"""
+        content_type = flow.response.headers.get("Content-Type", "").lower()
+        return "application/json" in content_type or "application/problem+json" in content_type
+
+    def _candidate_positions(self, flow: http.HTTPFlow, rules: RuleSet) -> Sequence[int]:
+        """Positions of the targets matching the flow, reusing what earlier hooks recorded"""
+        status_code = flow.response.status_code if flow.response else None
+        recorded = flow.metadata.get(CANDIDATES_KEY)
+        if recorded is not None and recorded[0] == rules.generation:
+            return rules.index.filter_status(recorded[1], status_code)
+        return self._match_positions(rules, flow, status_code)
+
+    def _match_positions(self, rules: RuleSet, flow: http.HTTPFlow,
+                         status_code: Optional[int] = None) -> Sequence[int]:
+        """Positions of the targets matching the flow's request and status_code, through the match cache"""
+        request = flow.request
+        method, url = request.method, request.url
+        positions = self.match_cache.lookup(rules.generation, method, url, status_code,
+                                            lambda: rules.index.match_positions(url, status_code, method))
+        # Header predicates depend on more than the cache key, so they are checked on every lookup
+        return rules.index.filter_headers(positions, request.headers)
+
+    def _find_matching_targets(self, flow: http.HTTPFlow, rules: Optional[RuleSet] = None) -> List[Dict[str, Any]]:
+        """Find all targets that match the current flow"""
+        if rules is None:
+            rules = self.rules
+        matches = rules.index.targets_at(self._candidate_positions(flow, rules))
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found %d matching targets for %s (status %s): %s", len(matches),
+                         flow.request.url, flow.response.status_code, [target['id'] for target in matches])
+        return matches
+
+    def requestheaders(self, flow: http.HTTPFlow) -> None:
+        """Record which targets could match the flow's request before any body is read"""
+        rules = self.rules
+        start = time.perf_counter()
+        positions = self._match_positions(rules, flow)
+        self.metrics.observe('match', time.perf_counter() - start)
+        flow.metadata[CANDIDATES_KEY] = (rules.generation, positions)
+
+    def _edit_headers(self, flow: http.HTTPFlow, patches: Iterable[Tuple[int, Optional[HeaderPatch]]],
+                      phase: str) -> List[int]:
+        """Apply the request or response edits of (target id, patch) pairs in order; returns the ids that had any"""
+        message = flow.request if phase == 'request' else flow.response
+        edited = []
+        for target_id, patch in patches:
+            edits = getattr(patch, phase) if patch is not None else None
+            if edits is None:
+                continue
+            start = time.perf_counter()
+            edits.apply(message, flow, target_id)
+            self.metrics.observe('headers', time.perf_counter() - start, target_id)
+            edited.append(target_id)
+        return edited
+
+    @staticmethod
+    def _header_patches(rules: RuleSet, positions: Sequence[int]) -> List[Tuple[int, Optional[HeaderPatch]]]:
+        """(target id, header patch) of the targets at positions"""
+        targets = rules.index.targets
+        return [(targets[pos]['id'], rules.header_patches.get(targets[pos]['id'])) for pos in positions]
+
+    def request(self, flow: http.HTTPFlow) -> None:
+        """Edit request headers for the matching targets, and answer mocked requests without contacting the server.
+
+        The first matching mock target stands in for the server; the response
+        hooks then apply every target matching the mocked response, the mock
+        target included, like for any other response.
+        """
+        rules = self.rules
+        positions = self._candidate_positions(flow, rules)
+        if not positions:
+            return
+        if rules.header_patches:
+            self._edit_headers(flow, self._header_patches(rules, positions), 'request')
+        for pos in positions:
+            target = rules.index.targets[pos]
+            if not target.get('is_mock') or target['modification_type'] != 'static':
+                continue
+            static_body = rules.static_body_for(target)
+            if static_body is None:
+                continue
+            flow.response = http.Response.make(
+                target['target_status_code'] or 200,
+                static_body.content,
+                {"Content-Type": "application/json"},
+            )
+            flow.metadata[MOCKED_KEY] = target['id']
+            logger.debug("Mocked %s with target %s", flow.request.url, target['id'])
+            return
+
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
+        """Stream responses that no target can modify instead of buffering them"""
+        rules = self.rules
+        positions = self._candidate_positions(flow, rules)
+        if positions and self._is_json(flow):
+            flow.metadata[CANDIDATES_KEY] = (rules.generation, positions)
+            return
+        if positions and rules.header_patches:
+            # Header edits apply to any matching response, the body is passed through as is
+            for target_id in self._edit_headers(flow, self._header_patches(rules, positions), 'response'):
+                self.metrics.applied(target_id)
+        logger.debug("Streaming non-candidate response for %s", flow.request.url)
+        flow.response.stream = True
+    
+    def set_script_executor(self, executor: Optional[ScriptExecutor]):
+        """Run dynamic scripts in executor from now on, or in the event loop if None"""
+        old, self.executor = self.executor, executor
+        if old is not None:
+            old.close()
+
+    def set_capture(self, capture: Optional[CaptureStore], wait: bool = False):
+        """Record modified flows into capture from now on, or stop recording if None.
+
+        The previous store writes what it has queued in its own thread; wait
+        blocks until it is done, which the event loop only affords at shutdown.
+        """
+        old, self.capture = self.capture, capture
+        if old is not None:
+            if wait:
+                old.stop()
+            else:
+                old.stop(timeout=0)
+        if capture is not None:
+            capture.start()
+            self.metrics.register_collector('capture', capture.stats)
+
+    def _prepare(self, flow: http.HTTPFlow) -> Optional[List[Step]]:
+        """The steps to apply to a response, or None if no target applies"""
+        # Skip if no response or if it was streamed through as a non-candidate
+        if not flow.response or flow.response.stream:
+            return None
+            
+        # Use one rule set snapshot for the whole flow
+        rules = self.rules
+        
+        # Check for JSON responses
+        if not self._is_json(flow):
+            return None
+            
+        # Find matching targets; flows matched in requestheaders were already timed there
+        timed = CANDIDATES_KEY in flow.metadata
+        start = time.perf_counter()
+        matching_targets = self._find_matching_targets(flow, rules)
+        if not timed:
+            self.metrics.observe('match', time.perf_counter() - start)
+        if not matching_targets:
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Applying targets %s", [(t['id'], t['modification_type']) for t in matching_targets])
+        return build_steps(rules, matching_targets)
+    
+    def response(self, flow: http.HTTPFlow) -> None:
+        """Process HTTP responses, running any dynamic scripts in the event loop"""
+        steps = self._prepare(flow)
+        if steps is None:
+            return
+        try:
+            content = flow.response.content
+            self._finish(flow, apply_chain(content, steps), steps, content)
+        except Exception:
+            logger.exception("Error handling response for %s", flow.request.url)
+
+    async def response_async(self, flow: http.HTTPFlow) -> None:
+        """Process HTTP responses, awaiting dynamic scripts from the script executor if there is one"""
+        executor = self.executor
+        if executor is None:
+            self.response(flow)
+            return
+        steps = self._prepare(flow)
+        if steps is None:
+            return
+        try:
+            content = flow.response.content
+            if has_scripts(steps):
+                result = await executor.run(content, steps)
+            else:
+                result = apply_chain(content, steps)
+            self._finish(flow, result, steps, content)
+        except Exception:
+            logger.exception("Error handling response for %s", flow.request.url)
+
+    def _finish(self, flow: http.HTTPFlow, result: ChainResult, steps: List[Step], original: bytes) -> None:
+        """Write the outcome of a chain to the response and record its metrics and capture"""
+        original_status = flow.response.status_code
+        compress_seconds = 0.0
+        if result.status_code is not None:
+            logger.debug("Changing status code from %d to %d", flow.response.status_code, result.status_code)
+            flow.response.status_code = result.status_code
+        if result.content is not None:
+            # A static body that reached the end unchanged brings its precompressed variants
+            variants = steps[result.static_step].artifact.encoded if result.static_step is not None else None
+            start = time.perf_counter()
+            body, encoding, negotiated = encode_body(result.content, self.compression,
+                                                     flow.request.headers.get("Accept-Encoding"),
+                                                     flow.response.headers.get("Content-Encoding"), variants)
+            if encoding is not None and not variants:
+                compress_seconds = time.perf_counter() - start
+                self.metrics.observe('compress', compress_seconds)
+            write_body(flow.response, body, encoding, negotiated, result.content_length)
+            logger.debug("Response replaced, new content length: %d (%s)", len(body), encoding or "identity")
+            
+        # Headers are edited after the body is written, so {response.status} sees the final status
+        for target_id in self._edit_headers(flow, [(step.target_id, step.headers) for step in steps], 'response'):
+            if target_id not in result.applied:
+                result.applied.append(target_id)
+            
+        metrics = self.metrics
+        for stage, seconds, target_id in result.observations:
+            metrics.observe(stage, seconds, target_id)
+        for target_id, stage in result.errors:
+            metrics.error(target_id, stage)
+        for target_id in result.applied:
+            metrics.applied(target_id)
+        for message in result.warnings:
+            logger.warning("%s (%s)", message, flow.request.url)
+
+        capture = self.capture
+        if capture is not None:
+            if MOCKED_KEY in flow.metadata:
+                # There was no upstream response
+                original_status, original = None, None
+            timings = {'compress': compress_seconds * 1e3} if compress_seconds else {}
+            for stage, seconds, _ in result.observations:
+                timings[stage] = timings.get(stage, 0.0) + seconds * 1e3
+            capture.record(flow.request.method, flow.request.url, original_status, flow.response.status_code,
+                           result.applied, original, result.content, timings)
+
+# Mitmproxy addon class
+class MITMAddon:
+    modifier_class = ResponseModifier
+
+    def __init__(self, db_path="targets.db"):
+        logger.debug("Initializing MITMAddon with database: %s", db_path)
+        self.modifier = self.modifier_class(db_path)
+        self.host_filter = HostFilter(lambda: self.modifier.rules)
+        self.modifier.reload_listeners.append(self.host_filter.rules_changed)
+        self.control_server: Optional[ControlServer] = None
+        
+    def load(self, loader) -> None:
+        """Register the addon's options"""
+        self.host_filter.load(loader)
+        loader.add_option(
+            name="modular_control_port",
+            typespec=int,
+            default=CONTROL_PORT,
+            help="Loopback port of the control API and metrics (/rpc, /metrics, /stats), 0 to disable",
+        )
+        loader.add_option(
+            name="modular_control_announce",
+            typespec=bool,
+            default=True,
+            help="Write the control file next to the database so that the CLI finds this proxy "
+                 "(turned off for the workers of a supervisor, which announces itself)",
+        )
+        loader.add_option(
+            name="modular_match_cache_size",
+            typespec=int,
+            default=DEFAULT_MATCH_CACHE_SIZE,
+            help="Number of (method, URL, status code) match results to cache, 0 to disable",
+        )
+
+        loader.add_option(
+            name="modular_script_mode",
+            typespec=str,
+            default="inline",
+            choices=SCRIPT_MODES,
+            help="Where dynamic scripts run: inline (event loop), thread (thread pool, trusted scripts) "
+                 "or process (worker processes)",
+        )
+        loader.add_option(
+            name="modular_script_workers",
+            typespec=int,
+            default=SCRIPT_WORKERS,
+            help="Threads or worker processes running dynamic scripts",
+        )
+        loader.add_option(
+            name="modular_script_timeout_ms",
+            typespec=int,
+            default=int(SCRIPT_TIMEOUT * 1000),
+            help="Wall-clock time each dynamic script may take before the response is passed on unmodified "
+                 "(thread and process modes)",
+        )
+        loader.add_option(
+            name="modular_compression",
+            typespec=str,
+            default=COMPRESSION_POLICY,
+            choices=COMPRESSION_POLICIES,
+            help="Content-Encoding of modified responses: preserve (the server's), negotiate (best allowed by "
+                 "Accept-Encoding) or identity (uncompressed); static bodies are precompressed and always negotiated",
+        )
+        loader.add_option(
+            name="modular_capture",
+            typespec=bool,
+            default=False,
+            help="Record modified and mocked flows (URL, status, original and modified bodies, timings) "
+                 "into a captures database next to the targets database",
+        )
+        loader.add_option(
+            name="modular_capture_max_rows",
+            typespec=int,
+            default=CAPTURE_MAX_ROWS,
+            help="Number of captures to keep, 0 for no limit",
+        )
+        loader.add_option(
+            name="modular_capture_max_age",
+            typespec=int,
+            default=CAPTURE_MAX_AGE,
+            help="Seconds to keep captures for, 0 for no limit",
+        )
+        loader.add_option(
+            name="modular_capture_max_mb",
+            typespec=int,
+            default=CAPTURE_MAX_MB,
+            help="Size in MB the captures database may grow to before the oldest captures are removed, 0 for no limit",
+        )
+
+    def configure(self, updated) -> None:
+        """Apply changed options"""
+        if "modular_match_cache_size" in updated:
+            self.modifier.match_cache.resize(ctx.options.modular_match_cache_size)
+        if "modular_compression" in updated:
+            self.modifier.compression = ctx.options.modular_compression
+        if updated & {"modular_script_mode", "modular_script_workers", "modular_script_timeout_ms"}:
+            self.modifier.set_script_executor(create_executor(
+                ctx.options.modular_script_mode,
+                ctx.options.modular_script_workers,
+                ctx.options.modular_script_timeout_ms / 1000,
+            ))
+        if updated & {"modular_capture", "modular_capture_max_rows", "modular_capture_max_age", "modular_capture_max_mb"}:
+            capture = None
+            if ctx.options.modular_capture:
+                capture = CaptureStore(capture_path(self.modifier.db.db_path), ctx.options.modular_capture_max_rows,
+                                       ctx.options.modular_capture_max_age, ctx.options.modular_capture_max_mb)
+            self.modifier.set_capture(capture)
+        
+    def requestheaders(self, flow: http.HTTPFlow) -> None:
+        """Handle HTTP request headers"""
+        self.modifier.requestheaders(flow)
+        
+    def request(self, flow: http.HTTPFlow) -> None:
+        """Handle HTTP requests"""
+        self.modifier.request(flow)
+        
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
+        """Handle HTTP response headers"""
+        self.modifier.responseheaders(flow)
+        
+    async def response(self, flow: http.HTTPFlow) -> None:
+        """Handle HTTP responses"""
+        await self.modifier.response_async(flow)
+        
+    def running(self) -> None:
+        """Start watching the database for target changes once the proxy is up"""
+        self.host_filter.running()
+        self.modifier.watcher.start()
+        if ctx.options.modular_control_port:
+            self.control_server = ControlServer(self.modifier.db, self.modifier.metrics, self.modifier.reload_targets,
+                                                port=ctx.options.modular_control_port,
+                                                announce=ctx.options.modular_control_announce)
+            self.control_server.start()
+        
+    def done(self) -> None:
+        """Stop the database watcher, control server and script workers on shutdown"""
+        self.modifier.watcher.stop()
+        self.modifier.set_script_executor(None)
+        self.modifier.set_capture(None, wait=True)
+        if self.control_server is not None:
+            self.control_server.stop()
+        
+    def reload(self) -> None:
+        """Reload targets from the database"""
+        self.modifier.reload_targets()
+
+    def dump_log(self) -> None:
+        """Write the recently recorded log records to stderr"""
+        for line in dump_recent():
+            print(line, file=sys.stderr)
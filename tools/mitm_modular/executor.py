@@ -0,0 +1,273 @@
+import abc
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Optional
+
+from .transform import ArtifactCache, ChainResult, Step, apply_chain
+
+logger = logging.getLogger('mitm_modular.executor')
+
+# 'inline' runs scripts in the event loop, the others in a ScriptExecutor
+SCRIPT_MODES = ('inline', 'thread', 'process')
+
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 5.0
+# Time a new worker process gets to import its modules, not charged to scripts
+STARTUP_TIMEOUT = 30.0
+# Seconds between checks whether a chain waiting for a free thread has started
+QUEUE_POLL_INTERVAL = 0.05
+
+
+def _first_script(steps: List[Step]) -> int:
+    return next(step.target_id for step in steps if step.modification_type == 'dynamic')
+
+
+def _timed_out(target_id: int, timeout: float) -> ChainResult:
+    return ChainResult.failed(target_id, 'timeout',
+                              f"Target {target_id} exceeded the {timeout:g}s script timeout, response left unchanged")
+
+
+class _DaemonThreads:
+    """A minimal thread pool whose threads never hold up interpreter exit.
+
+    concurrent.futures joins its threads at exit, which would hang mitmdump
+    on shutdown behind a script that never finishes.
+    """
+
+    def __init__(self, workers: int, name: str):
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._threads = [threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, fn, *args) -> Future:
+        future: Future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def shutdown(self):
+        # Cancel waiting calls, then let each thread finish its current one
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+        for _ in self._threads:
+            self._queue.put(None)
+
+
+class ScriptExecutor(abc.ABC):
+    """Applies target chains that run dynamic scripts away from the event loop.
+
+    Every script gets timeout seconds of wall-clock time from the moment it
+    starts (the first one also covers decoding); waiting for a free worker
+    is not charged. When a script runs over, the response is left unchanged.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+
+    @abc.abstractmethod
+    async def run(self, content: bytes, steps: List[Step]) -> ChainResult:
+        """Apply steps to content, returning the unchanged content if a script times out"""
+
+    def close(self):
+        pass
+
+
+class ThreadScriptExecutor(ScriptExecutor):
+    """Runs chains in a thread pool.
+
+    Threads cannot be stopped, so a script that never finishes keeps its
+    thread busy after the timeout; meant for trusted scripts. Scripts still
+    share the interpreter lock with the event loop.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(workers, timeout)
+        self._pool = _DaemonThreads(self.workers, 'mitm_modular-script')
+
+    async def run(self, content: bytes, steps: List[Step]) -> ChainResult:
+        # [target id of the running script, when it started]; None while waiting for a free thread
+        progress: List[Any] = [_first_script(steps), None]
+
+        def on_script(target_id: int):
+            progress[0], progress[1] = target_id, time.monotonic()
+
+        def chain() -> ChainResult:
+            progress[1] = time.monotonic()
+            return apply_chain(content, steps, on_script)
+
+        submitted = self._pool.submit(chain)
+        future = asyncio.wrap_future(submitted)
+        try:
+            while True:
+                started = progress[1]
+                if started is None:
+                    remaining = QUEUE_POLL_INTERVAL
+                else:
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        return _timed_out(progress[0], self.timeout)
+                done, _ = await asyncio.wait({future}, timeout=remaining)
+                if done:
+                    return future.result()
+        finally:
+            # Drops the chain if it is still waiting for a thread, e.g. when the flow is cancelled
+            submitted.cancel()
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def worker_main(conn):
+    """Entry point of a script worker process: apply chains received on conn until None arrives"""
+    artifacts = ArtifactCache()
+    conn.send(('ready', None))
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        content, steps = request
+        result = apply_chain(content, artifacts.resolve(steps), lambda target_id: conn.send(('script', target_id)))
+        conn.send(('done', result))
+
+
+class _Worker:
+    """A script worker process and the parent's end of its pipe"""
+
+    def __init__(self, context, index: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn,),
+                                       name=f'mitm_modular-script-{index}', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self):
+        """Wait for the worker to finish starting; raises EOFError if it died instead"""
+        if not self.ready:
+            if not self.conn.poll(STARTUP_TIMEOUT):
+                raise EOFError(f"no reply within {STARTUP_TIMEOUT:g}s of starting")
+            self.conn.recv()
+            self.ready = True
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(1.0)
+        self.conn.close()
+
+
+class ProcessScriptExecutor(ScriptExecutor):
+    """Runs chains in a pool of pre-started worker processes.
+
+    A worker whose script runs over the timeout, or that dies, is killed and
+    replaced, so a looping script cannot hold on to CPU time. Workers are
+    started with the 'spawn' method, which needs mitmproxy to run from a
+    regular Python installation rather than a standalone build.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(workers, timeout)
+        import multiprocessing
+        self._context = multiprocessing.get_context('spawn')
+        self._started = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        # Last in, first out: the most recently used workers are warm, new ones may still be starting
+        self._idle: 'queue.LifoQueue[_Worker]' = queue.LifoQueue()
+        for _ in range(self.workers):
+            self._idle.put(self._start_worker())
+        # One thread per worker waits for its replies, keeping the event loop free
+        self._threads = _DaemonThreads(self.workers, 'mitm_modular-script-io')
+
+    def _start_worker(self) -> _Worker:
+        with self._lock:
+            self._started += 1
+            index = self._started
+        return _Worker(self._context, index)
+
+    async def run(self, content: bytes, steps: List[Step]) -> ChainResult:
+        portable = [step.portable() for step in steps]
+        return await asyncio.wrap_future(self._threads.submit(self._call, content, portable))
+
+    def _call(self, content: bytes, steps: List[Step]) -> ChainResult:
+        worker = self._idle.get()
+        current = _first_script(steps)
+        try:
+            worker.wait_ready()
+            worker.conn.send((content, steps))
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not worker.conn.poll(remaining):
+                    worker = self._replace(worker)
+                    return _timed_out(current, self.timeout)
+                kind, payload = worker.conn.recv()
+                if kind == 'script':
+                    current = payload
+                    deadline = time.monotonic() + self.timeout
+                elif kind == 'done':
+                    return payload
+        except (EOFError, OSError) as e:
+            worker = self._replace(worker)
+            return ChainResult.failed(current, 'worker', f"Script worker failed running target {current}: {str(e) or 'worker exited'}")
+        finally:
+            if self._closed:
+                worker.kill()
+            else:
+                self._idle.put(worker)
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        logger.warning("Restarting script worker %s", worker.process.name)
+        worker.kill()
+        return self._start_worker()
+
+    def close(self):
+        self._closed = True
+        self._threads.shutdown()
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(1.0)
+            if worker.process.is_alive():
+                worker.kill()
+
+
+def create_executor(mode: str, workers: int = DEFAULT_WORKERS,
+                    timeout: float = DEFAULT_TIMEOUT) -> Optional[ScriptExecutor]:
+    """The executor for a script mode, or None for 'inline'"""
+    if mode == 'thread':
+        return ThreadScriptExecutor(workers, timeout)
+    if mode == 'process':
+        return ProcessScriptExecutor(workers, timeout)
+    if mode != 'inline':
+        raise ValueError(f"script mode must be one of {', '.join(SCRIPT_MODES)}")
+    return None
@@ -0,0 +1,216 @@
+import re
+import time
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+from . import codec
+
+# Operations of a header edit: add appends a value, set replaces every value (adding the header if
+# missing), replace does the same only if the header is present, remove deletes it
+OPERATIONS = ('add', 'set', 'replace', 'remove')
+PHASES = ('request', 'response')
+
+# Headers the proxy writes itself when it re-encodes a body
+MANAGED_HEADERS = frozenset(('content-length', 'content-encoding', 'transfer-encoding'))
+
+# Characters of a header name (an RFC 9110 token)
+NAME_RE = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+# {variable} in a value, {{ and }} for literal braces
+PLACEHOLDER_RE = re.compile(r"\{\{|\}\}|\{([^{}]*)\}")
+
+# Renders one placeholder of a template for a flow and the id of the target being applied
+Getter = Callable[[Any, int], str]
+
+_GETTERS: Dict[str, Getter] = {
+    'request.method': lambda flow, target_id: flow.request.method,
+    'request.url': lambda flow, target_id: flow.request.url,
+    'request.scheme': lambda flow, target_id: flow.request.scheme,
+    'request.host': lambda flow, target_id: flow.request.pretty_host,
+    'request.path': lambda flow, target_id: flow.request.path,
+    'response.status': lambda flow, target_id: str(flow.response.status_code),
+    'target.id': lambda flow, target_id: str(target_id),
+    'now': lambda flow, target_id: str(int(time.time())),
+}
+
+
+def _header_getter(message: str, name: str) -> Getter:
+    def get(flow, target_id):
+        return getattr(flow, message).headers.get(name, '')
+    return get
+
+
+class Template:
+    """A header value with {placeholders}, split once into literal text and getters.
+
+    Placeholders are the keys of _GETTERS and request.header.NAME /
+    response.header.NAME, which render as the empty string for a missing
+    header. Response placeholders are only available in response edits.
+    """
+
+    __slots__ = ('parts', 'literal')
+
+    def __init__(self, value: str, phase: str):
+        if '\r' in value or '\n' in value:
+            raise ValueError("header values cannot contain line breaks")
+        parts: List[Union[str, Getter]] = []
+        position = 0
+        for placeholder in PLACEHOLDER_RE.finditer(value):
+            parts.append(self._literal(value[position:placeholder.start()], value))
+            position = placeholder.end()
+            text = placeholder.group(0)
+            if text in ('{{', '}}'):
+                parts.append(text[0])
+            else:
+                parts.append(self._getter(placeholder.group(1).strip(), phase))
+        parts.append(self._literal(value[position:], value))
+        # Adjacent literals are joined, so a value without placeholders is a single string
+        merged: List[Union[str, Getter]] = []
+        for part in parts:
+            if isinstance(part, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += part
+            elif part != '':
+                merged.append(part)
+        self.parts = tuple(merged)
+        # Values without placeholders are rendered once, here
+        self.literal: Optional[str] = None
+        if not merged:
+            self.literal = ''
+        elif len(merged) == 1 and isinstance(merged[0], str):
+            self.literal = merged[0]
+
+    @staticmethod
+    def _literal(text: str, value: str) -> str:
+        if '{' in text or '}' in text:
+            raise ValueError(f"unbalanced brace in header value {value!r}, use {{{{ and }}}} for literal braces")
+        return text
+
+    @staticmethod
+    def _getter(name: str, phase: str) -> Getter:
+        if name.startswith('response.') and phase == 'request':
+            raise ValueError(f"{{{name}}} is not available when editing request headers")
+        if name in _GETTERS:
+            return _GETTERS[name]
+        for message in ('request', 'response'):
+            prefix = message + '.header.'
+            if name.startswith(prefix) and NAME_RE.fullmatch(name[len(prefix):]):
+                return _header_getter(message, name[len(prefix):])
+        raise ValueError(f"unknown placeholder {{{name}}}")
+
+    def render(self, flow, target_id: int) -> str:
+        if self.literal is not None:
+            return self.literal
+        value = ''.join(part if isinstance(part, str) else part(flow, target_id) for part in self.parts)
+        # Values of other headers cannot break the header block either
+        return value.replace('\r', ' ').replace('\n', ' ')
+
+
+class HeaderEdits:
+    """The edits of one phase, reduced to headers to drop and fields to append.
+
+    drop holds the lower-case names whose existing fields are removed;
+    additions holds (name, lower-case name, template, conditional) in the
+    order they are appended, conditional ones only if the header was present.
+    """
+
+    __slots__ = ('drop', 'additions')
+
+    def __init__(self, drop: FrozenSet[bytes], additions: Sequence[Tuple[bytes, bytes, Template, bool]]):
+        self.drop = drop
+        self.additions = tuple(additions)
+
+    def apply(self, message, flow, target_id: int):
+        """Rewrite the headers of a mitmproxy request or response in a single pass over its fields"""
+        drop = self.drop
+        fields = []
+        present = set()
+        for field in message.headers.fields:
+            lowered = field[0].lower()
+            if lowered in drop:
+                present.add(lowered)
+            else:
+                fields.append(field)
+        for name, lowered, template, conditional in self.additions:
+            if not conditional or lowered in present:
+                fields.append((name, template.render(flow, target_id).encode('utf-8', 'surrogateescape')))
+        message.headers.fields = tuple(fields)
+
+
+class HeaderPatch:
+    """Compiled header edits of a target, ready to apply to requests and responses.
+
+    Edits are given as a JSON list of {"op", "name", "value", "phase"}
+    objects, with phase "response" by default and no value for remove.
+    Later edits of a header see the result of earlier ones.
+    """
+
+    __slots__ = ('request', 'response')
+
+    def __init__(self, operations: Union[str, List[Dict[str, Any]]]):
+        if isinstance(operations, (str, bytes)):
+            try:
+                operations = codec.loads(operations)
+            except ValueError as e:
+                raise ValueError(f"header operations are not valid JSON: {e}") from None
+        if not isinstance(operations, list) or not operations:
+            raise ValueError("header operations must be a non-empty list of objects")
+        # (number, operation) by phase
+        by_phase: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {phase: [] for phase in PHASES}
+        for i, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                raise ValueError(f"header operation {i + 1}: expected an object")
+            phase = operation.get('phase', 'response')
+            if phase not in PHASES:
+                raise ValueError(f"header operation {i + 1}: phase must be 'request' or 'response'")
+            by_phase[phase].append((i + 1, operation))
+        self.request = self._compile(by_phase['request'], 'request')
+        self.response = self._compile(by_phase['response'], 'response')
+
+    @staticmethod
+    def _compile(operations: List[Tuple[int, Dict[str, Any]]], phase: str) -> Optional[HeaderEdits]:
+        if not operations:
+            return None
+        drop = set()
+        # Appended fields as (name, lower-case name, template, conditional)
+        additions: List[Tuple[bytes, bytes, Template, bool]] = []
+        # Whether each edited header is present after the edits so far; missing means as in the message
+        present: Dict[bytes, bool] = {}
+        for number, operation in operations:
+            op, name = operation.get('op'), operation.get('name')
+            if op not in OPERATIONS:
+                raise ValueError(f"header operation {number}: op must be one of {', '.join(OPERATIONS)}")
+            if not isinstance(name, str) or not NAME_RE.fullmatch(name):
+                raise ValueError(f"header operation {number}: invalid header name {name!r}")
+            if name.lower() in MANAGED_HEADERS:
+                raise ValueError(f"header operation {number}: {name} is managed by the proxy")
+            if op != 'remove' and not isinstance(operation.get('value'), str):
+                raise ValueError(f"header operation {number}: value must be a string")
+            try:
+                template = Template(operation['value'], phase) if op != 'remove' else None
+            except ValueError as e:
+                raise ValueError(f"header operation {number}: {e}") from None
+            raw, lowered = name.encode('ascii'), name.lower().encode('ascii')
+
+            if op == 'add':
+                additions.append((raw, lowered, template, False))
+                present[lowered] = True
+                continue
+            if op == 'replace' and present.get(lowered) is False:
+                continue
+            # As in the message unless an earlier edit decided it
+            conditional = op == 'replace' and lowered not in present
+            additions = [addition for addition in additions if addition[1] != lowered]
+            drop.add(lowered)
+            if op == 'remove':
+                present[lowered] = False
+            else:
+                additions.append((raw, lowered, template, conditional))
+                if not conditional:
+                    present[lowered] = True
+        return HeaderEdits(frozenset(drop), additions)
+
+    def apply_request(self, flow, target_id: int):
+        if self.request is not None:
+            self.request.apply(flow.request, flow, target_id)
+
+    def apply_response(self, flow, target_id: int):
+        if self.response is not None:
+            self.response.apply(flow.response, flow, target_id)
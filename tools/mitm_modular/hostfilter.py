@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Callable, List, Optional
+
+from mitmproxy import ctx
+
+from .ruleset import RuleSet
+
+logger = logging.getLogger('mitm_modular.hostfilter')
+
+OPTION = 'modular_host_filter'
+
+# allow_hosts entry that matches no host, used when there are no targets at all
+NO_HOSTS = '(?!)'
+
+
+class HostFilter:
+    """Keeps mitmproxy's allow_hosts in sync with the hosts the enabled targets can apply to.
+
+    Connections to any other host are tunneled without TLS interception. When
+    some target can apply to any host, or allow_hosts/ignore_hosts were set
+    explicitly, every connection is intercepted as before. The hosts follow
+    every rule set reload, but connections already tunneled stay tunneled
+    until the client opens new ones.
+    """
+
+    def __init__(self, get_rules: Callable[[], RuleSet]):
+        self.get_rules = get_rules
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._managed = False
+
+    def load(self, loader):
+        loader.add_option(
+            name=OPTION,
+            typespec=bool,
+            default=True,
+            help="Only intercept TLS connections to hosts that enabled targets can apply to",
+        )
+
+    def running(self):
+        """Take over allow_hosts unless disabled or configured by the user"""
+        if not getattr(ctx.options, OPTION):
+            return
+        if ctx.options.allow_hosts or ctx.options.ignore_hosts:
+            logger.info("allow_hosts/ignore_hosts set explicitly, not deriving them from targets")
+            return
+        self._loop = asyncio.get_running_loop()
+        self._managed = True
+        self.apply()
+
+    def rules_changed(self):
+        """Schedule an update from any thread after the rule set was replaced"""
+        if self._managed:
+            self._loop.call_soon_threadsafe(self.apply)
+
+    def allow_hosts(self, rules: RuleSet) -> List[str]:
+        """Compute the allow_hosts value for a rule set"""
+        if not rules.targets:
+            return [NO_HOSTS]
+        patterns = rules.index.host_patterns()
+        # An empty allow_hosts makes mitmproxy intercept every connection
+        return patterns if patterns is not None else []
+
+    def apply(self):
+        """Update allow_hosts from the current rule set (on the event loop)"""
+        allow = self.allow_hosts(self.get_rules())
+        if list(ctx.options.allow_hosts) != allow:
+            ctx.options.update(allow_hosts=allow)
+            if allow:
+                logger.info("Intercepting TLS only for: %s", ', '.join(allow))
+            else:
+                logger.info("Intercepting TLS for all hosts")
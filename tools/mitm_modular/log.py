@@ -0,0 +1,166 @@
+import atexit
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict, List, Optional, Tuple
+
+ROOT_LOGGER = 'mitm_modular'
+
+# Output levels, e.g. "WARNING" or "INFO,matching=DEBUG" for per-subsystem levels
+LOG_LEVEL_ENV = 'MITM_MODULAR_LOG_LEVEL'
+# Level recorded into the in-memory ring buffer, which may be below the output level
+TRACE_LEVEL_ENV = 'MITM_MODULAR_TRACE_LEVEL'
+
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_TRACE_LEVEL = 'INFO'
+DEFAULT_RING_CAPACITY = 2000
+DEFAULT_QUEUE_SIZE = 10000
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Return the logger of a subsystem, e.g. get_logger('addon')"""
+    if subsystem == ROOT_LOGGER or subsystem.startswith(ROOT_LOGGER + '.'):
+        return logging.getLogger(subsystem)
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def parse_levels(spec: str) -> Tuple[int, Dict[str, int]]:
+    """Parse a level spec like "WARNING,matching=DEBUG" into (default, overrides)"""
+    default = logging.INFO
+    overrides = {}
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, level = part.rpartition('=')
+        levelno = logging.getLevelName(level.strip().upper())
+        if not isinstance(levelno, int):
+            raise ValueError(f"Unknown log level: {level}")
+        if name:
+            overrides[get_logger(name.strip()).name] = levelno
+        else:
+            default = levelno
+    return default, overrides
+
+
+class SubsystemLevelFilter(logging.Filter):
+    """Applies the output level of the most specific configured subsystem"""
+
+    def __init__(self, default: int, overrides: Dict[str, int]):
+        super().__init__()
+        self.default = default
+        self.overrides = overrides
+
+    def level_for(self, name: str) -> int:
+        while name:
+            if name in self.overrides:
+                return self.overrides[name]
+            name = name.rpartition('.')[0]
+        return self.default
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.level_for(record.name)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without formatting or blocking the caller"""
+
+    def __init__(self, record_queue: queue.Queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a flow on a slow consumer of our output
+            self.dropped += 1
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent records in memory so they can be dumped on demand"""
+
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+    def dump(self) -> List[str]:
+        """Format the buffered records, oldest first"""
+        return [self.format(record) for record in list(self.records)]
+
+
+_ring: Optional[RingBufferHandler] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(level: Optional[str] = None, trace_level: Optional[str] = None,
+                      stream=None, ring_capacity: int = DEFAULT_RING_CAPACITY) -> logging.Logger:
+    """Set up the mitm_modular loggers, the queue-backed output and the ring buffer.
+
+    Levels default to the MITM_MODULAR_LOG_LEVEL / MITM_MODULAR_TRACE_LEVEL
+    environment variables. Calling it again reconfigures the existing handlers.
+    """
+    global _ring, _queue_handler, _listener
+
+    default, overrides = parse_levels(level or os.environ.get(LOG_LEVEL_ENV, DEFAULT_LOG_LEVEL))
+    trace = parse_levels(trace_level or os.environ.get(TRACE_LEVEL_ENV, DEFAULT_TRACE_LEVEL))[0]
+
+    root = logging.getLogger(ROOT_LOGGER)
+    # Loggers only create records that the output or the ring buffer will keep
+    root.setLevel(min(default, trace))
+    for name, levelno in overrides.items():
+        logging.getLogger(name).setLevel(min(levelno, trace))
+    root.propagate = False
+
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    if _listener is not None:
+        _listener.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+    output.addFilter(SubsystemLevelFilter(default, overrides))
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(DEFAULT_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    root.addHandler(_queue_handler)
+
+    _ring = RingBufferHandler(ring_capacity)
+    _ring.setLevel(trace)
+    _ring.setFormatter(formatter)
+    root.addHandler(_ring)
+
+    return root
+
+
+def dump_recent() -> List[str]:
+    """Return the records kept in the ring buffer, oldest first"""
+    if _ring is None:
+        return []
+    lines = _ring.dump()
+    if _queue_handler is not None and _queue_handler.dropped:
+        lines.append(f"({_queue_handler.dropped} log records dropped while the output was busy)")
+    return lines
+
+
+@atexit.register
+def _shutdown():
+    """Flush queued records before the interpreter exits"""
+    if _listener is not None:
+        _listener.stop()
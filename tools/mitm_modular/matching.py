@@ -0,0 +1,586 @@
+import json
+import logging
+import re
+import threading
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Iterable, Tuple, Set, FrozenSet, Callable, Sequence, Union
+
+logger = logging.getLogger('mitm_modular.matching')
+
+# Characters that make mitm_core treat a target URL as a regular expression
+REGEX_CHARS = '.*+?[](){}|'
+
+# Characters of an HTTP method name (an RFC 9110 token)
+METHOD_RE = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+
+
+def host_pattern(target_url: str) -> Optional[str]:
+    """Regex for the "host:port" of flows an absolute target URL can match, or None"""
+    scheme, sep, rest = target_url.partition('://')
+    if not sep or scheme.lower() not in ('http', 'https'):
+        return None
+    netloc, slash, _ = rest.partition('/')
+    if not netloc:
+        return None
+    if not slash:
+        # The URL may continue after the given host text, e.g. "https://api.exa"
+        return '^' + re.escape(netloc)
+    if ':' in netloc.rsplit(']', 1)[-1]:
+        return '^' + re.escape(netloc) + '$'
+    return '^' + re.escape(netloc) + r':\d+$'
+
+
+# Start of a regular expression anchored to a literal scheme and host, e.g. ^https://api\.example\.com/
+ANCHORED_HOST_RE = re.compile(r'\^(https?://(?:[A-Za-z0-9-]|\\\.)+(?::\d+)?/)')
+
+
+def anchored_url_prefix(pattern: str) -> Optional[str]:
+    """The literal "scheme://host/" a regex target is anchored to, or None if it can match any host"""
+    anchored = ANCHORED_HOST_RE.match(pattern)
+    # An alternative could match anywhere
+    if anchored is None or '|' in pattern:
+        return None
+    return anchored.group(1).replace('\\.', '.')
+
+
+def pinned_host(target_url: str) -> Optional[str]:
+    """The "host[:port]" an absolute target URL pins, or None if any host.
+
+    Flows of other hosts can still match it by embedding it in their URL.
+    """
+    scheme, sep, rest = target_url.partition('://')
+    if not sep or scheme.lower() not in ('http', 'https') or '?' in target_url:
+        return None
+    netloc, slash, _ = rest.partition('/')
+    if not netloc or not slash:
+        return None
+    return netloc
+
+
+def url_host(url: str) -> str:
+    """The "host[:port]" of a flow URL as mitmproxy formats it"""
+    return url.partition('://')[2].partition('/')[0].partition('?')[0]
+
+
+def normalize_methods(methods: Union[str, Iterable[str], None]) -> Optional[str]:
+    """Request methods as stored, e.g. "GET,POST", or None for any method.
+
+    Accepts a comma-separated string or a list of them; raises ValueError
+    for names that are not HTTP methods.
+    """
+    if methods is None:
+        return None
+    if isinstance(methods, str):
+        methods = [methods]
+    result: List[str] = []
+    for part in (p for m in methods for p in str(m).split(',')):
+        method = part.strip().upper()
+        if not method:
+            continue
+        if not METHOD_RE.fullmatch(method):
+            raise ValueError(f"invalid HTTP method: {part.strip()!r}")
+        if method not in result:
+            result.append(method)
+    return ','.join(result) or None
+
+
+class HeaderRule:
+    """Request header predicates of a target.
+
+    Given as a JSON object mapping header names (case-insensitive) to true
+    (present), false (absent), a string (the exact value) or
+    {"regex": pattern} (searched for in the value). All must hold.
+    """
+
+    __slots__ = ('predicates',)
+
+    def __init__(self, spec: Union[str, Dict[str, Any]]):
+        if isinstance(spec, str):
+            try:
+                spec = json.loads(spec)
+            except ValueError as e:
+                raise ValueError(f"request_headers is not valid JSON: {e}") from None
+        if not isinstance(spec, dict):
+            raise ValueError("request_headers must be an object of header names to values")
+        predicates = []
+        for name, expected in spec.items():
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError("request_headers: header names must be non-empty strings")
+            if isinstance(expected, (bool, str)):
+                predicates.append((name.strip(), expected))
+            elif isinstance(expected, dict) and list(expected) == ['regex'] and isinstance(expected['regex'], str):
+                try:
+                    predicates.append((name.strip(), re.compile(expected['regex'])))
+                except re.error as e:
+                    raise ValueError(f"request_headers: invalid regex for {name}: {e}") from None
+            else:
+                raise ValueError(f"request_headers: {name} must be true, false, a string or {{\"regex\": ...}}")
+        self.predicates = tuple(predicates)
+
+    def matches(self, headers) -> bool:
+        """Check the predicates against a case-insensitive mapping such as mitmproxy's Headers"""
+        for name, expected in self.predicates:
+            value = headers.get(name)
+            if expected is True or expected is False:
+                if (value is not None) != expected:
+                    return False
+            elif value is None:
+                return False
+            elif isinstance(expected, str):
+                if value != expected:
+                    return False
+            elif not expected.search(value):
+                return False
+        return True
+
+
+def normalize_headers(spec: Union[str, Dict[str, Any], None]) -> Optional[str]:
+    """Request header predicates as stored (compact JSON), or None for none; raises ValueError if invalid"""
+    if spec is None or (isinstance(spec, str) and not spec.strip()):
+        return None
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except ValueError as e:
+            raise ValueError(f"request_headers is not valid JSON: {e}") from None
+    HeaderRule(spec)
+    return json.dumps(spec, separators=(',', ':')) if spec else None
+
+
+class SubstringAutomaton:
+    """Aho-Corasick automaton reporting every pattern contained in a string"""
+
+    def __init__(self, patterns: Iterable[Tuple[str, int]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        # Values of empty patterns, which are contained in every string
+        self._always: Set[int] = set()
+
+        for pattern, value in patterns:
+            if pattern:
+                self._add(pattern, value)
+            else:
+                self._always.add(value)
+        self._build()
+
+    def _add(self, pattern: str, value: int):
+        """Insert a pattern into the trie"""
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._out[state] = self._out[state] + (value,)
+
+    def _build(self):
+        """Compute failure links breadth-first and merge their outputs"""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, next_state in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(ch, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+                queue.append(next_state)
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1 or bool(self._always)
+
+    def search(self, text: str) -> Set[int]:
+        """Return the values of all patterns that occur in text"""
+        found = set(self._always)
+        if len(self._goto) == 1:
+            return found
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class QueryRule:
+    """Pre-parsed components of a target URL containing a query string"""
+
+    def __init__(self, target_url: str):
+        # Components used by the parsed path/query comparison
+        self.path: Optional[str] = None
+        self.query = ''
+        self.params: Dict[str, List[str]] = {}
+        try:
+            if not target_url.startswith(('http://', 'https://')):
+                # Add a dummy scheme for parsing relative URLs
+                target_to_parse = f"http://example.com/{target_url}"
+            else:
+                target_to_parse = target_url
+            parsed_target = urllib.parse.urlparse(target_to_parse)
+
+            path = parsed_target.path.lstrip('/')
+            if path.startswith('example.com/'):
+                path = path[12:]  # Remove the dummy host
+            self.path = path
+            self.query = parsed_target.query
+            self.params = urllib.parse.parse_qs(self.query)
+        except ValueError:
+            self.path = None
+
+        # Components used by the case-insensitive path/query comparison
+        path_part, query_part = target_url.split('?', 1)
+        self.path_part_lower = path_part.lower()
+        self.query_part_lower = query_part.lower()
+
+    def query_matches(self, flow_query: str, flow_params) -> bool:
+        """Check the parsed query against the flow query (substring or parameter subset)"""
+        if not self.query:
+            return True
+        if self.query in flow_query:
+            return True
+        params = flow_params()
+        return all(
+            k in params and any(tv in params[k] for tv in v)
+            for k, v in self.params.items()
+        )
+
+    def query_contains(self, flow_query_lower: str) -> bool:
+        """Case-insensitive check that the raw query part occurs in the flow query"""
+        return bool(self.query_part_lower) and self.query_part_lower in flow_query_lower
+
+
+class RuleIndex:
+    """Compiled lookup structure resolving a flow URL and status code to matching targets.
+
+    Built once per target list so that a lookup costs a hash probe, one automaton
+    pass over the URL (and its path) and a few suffix probes, independent of the
+    number of targets. When the request method is known, the targets are first
+    narrowed to the (method, host) bucket of the request, so that rules pinned
+    to other methods or hosts are never evaluated and a request no bucket
+    target applies to skips URL matching altogether. URLs embedding another
+    URL are only narrowed by method, since absolute targets of any host can
+    occur in them.
+    """
+
+    def __init__(self, targets: Iterable[Dict[str, Any]], use_regex: bool = False):
+        self.targets = [t for t in targets if t.get('is_enabled', 1)]
+        self.use_regex = use_regex
+
+        self._exact: Dict[str, List[int]] = {}
+        self._regexes: List[Tuple[Any, int]] = []
+        self._endpoints: Dict[str, List[int]] = {}
+        self._endpoint_lengths: List[int] = []
+        self._query_rules: Dict[int, QueryRule] = {}
+        # Query rules with an empty path part, which only match paths ending in '/'
+        self._bare_query_rules: List[int] = []
+        self._any_status: Set[int] = set()
+        self._by_status: Dict[int, Set[int]] = {}
+        self._any_method: Set[int] = set()
+        self._by_method: Dict[str, Set[int]] = {}
+        self._any_host: Set[int] = set()
+        self._by_host: Dict[str, Set[int]] = {}
+        # (method, host) -> positions accepting both; methods and hosts no target pins share the '' key,
+        # URLs embedding another URL the None host
+        self._buckets: Dict[Tuple[str, Optional[str]], FrozenSet[int]] = {}
+        # Request header predicates by position; None for predicates that could not be parsed
+        self._header_rules: Dict[int, Optional[HeaderRule]] = {}
+
+        url_patterns = []
+        path_patterns = []
+        path_patterns_lower = []
+
+        for pos, target in enumerate(self.targets):
+            target_url = target['url']
+            status_code = target.get('status_code')
+            if status_code is None:
+                self._any_status.add(pos)
+            else:
+                self._by_status.setdefault(status_code, set()).add(pos)
+
+            methods = target.get('methods')
+            if methods:
+                for method in methods.split(','):
+                    self._by_method.setdefault(method, set()).add(pos)
+            else:
+                self._any_method.add(pos)
+
+            host = pinned_host(target_url)
+            if host is None or (use_regex and (target_url.startswith('^') or any(c in target_url for c in REGEX_CHARS))):
+                self._any_host.add(pos)
+            else:
+                self._by_host.setdefault(host, set()).add(pos)
+
+            if target.get('request_headers'):
+                try:
+                    self._header_rules[pos] = HeaderRule(target['request_headers'])
+                except ValueError as e:
+                    # Never matches rather than matching more requests than intended
+                    logger.warning("Target %s never matches: %s", target.get('id'), e)
+                    self._header_rules[pos] = None
+
+            self._exact.setdefault(target_url, []).append(pos)
+
+            if use_regex:
+                if target_url.startswith('^') or any(c in target_url for c in REGEX_CHARS):
+                    try:
+                        self._regexes.append((re.compile(target_url), pos))
+                        continue
+                    except re.error:
+                        # If regex is invalid, fall back to simple string match
+                        pass
+                url_patterns.append((target_url, pos))
+                continue
+
+            url_patterns.append((target_url, pos))
+
+            if '?' in target_url:
+                rule = QueryRule(target_url)
+                self._query_rules[pos] = rule
+                if rule.path is not None:
+                    path_patterns.append((rule.path, pos))
+                if rule.path_part_lower:
+                    path_patterns_lower.append((rule.path_part_lower, pos))
+                elif rule.query_part_lower:
+                    self._bare_query_rules.append(pos)
+            elif not target_url.startswith('/') and not target_url.startswith('http'):
+                # Simple endpoint, matched as a case-insensitive suffix of the path
+                self._endpoints.setdefault(target_url.lower(), []).append(pos)
+
+        self._endpoint_lengths = sorted({len(e) for e in self._endpoints})
+        self._url_automaton = SubstringAutomaton(url_patterns)
+        self._path_automaton = SubstringAutomaton(path_patterns)
+        self._path_automaton_lower = SubstringAutomaton(path_patterns_lower)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def candidates(self, status_code: int) -> Set[int]:
+        """Positions of targets whose status filter accepts status_code"""
+        return self._any_status | self._by_status.get(status_code, set())
+
+    def request_candidates(self, method: str, url: str) -> FrozenSet[int]:
+        """Positions of targets whose method and host pins accept a request, from its (method, host) bucket.
+
+        An absolute target URL also matches where it occurs inside the URL of
+        another host, e.g. in a redirect parameter, so host pins are ignored
+        for URLs containing '://' after their own scheme.
+        """
+        method = method.upper()
+        if url.find('://', url.find('://') + 3) != -1:
+            host = None
+        else:
+            host = url_host(url)
+            if host not in self._by_host:
+                host = ''
+        key = (method if method in self._by_method else '', host)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            methods = self._any_method | self._by_method.get(key[0], set())
+            if host is None:
+                hosts = set(range(len(self.targets)))
+            else:
+                hosts = self._any_host | self._by_host.get(host, set())
+            bucket = self._buckets[key] = frozenset(methods & hosts)
+        return bucket
+
+    def match_positions(self, url: str, status_code: Optional[int] = None,
+                        method: Optional[str] = None) -> List[int]:
+        """Return the sorted positions of all targets matching url, status_code and method.
+
+        A status_code of None means the status is not known yet (request time),
+        so status filters are not applied; a method of None applies no method
+        filters. Request header predicates are checked by filter_headers.
+        """
+        allowed = None
+        if status_code is not None:
+            allowed = self.candidates(status_code)
+            if not allowed:
+                return []
+        elif not self.targets:
+            return []
+        if method is not None:
+            bucket = self.request_candidates(method, url)
+            allowed = bucket if allowed is None else allowed & bucket
+            if not allowed:
+                return []
+
+        hits = set(self._exact.get(url, ()))
+        hits.update(self._url_automaton.search(url))
+        for pattern, pos in self._regexes:
+            if pos not in hits and (allowed is None or pos in allowed) and pattern.search(url):
+                hits.add(pos)
+
+        if self._query_rules or self._endpoints:
+            self._match_path(url, hits, allowed)
+
+        if allowed is not None:
+            hits &= allowed
+        return sorted(hits)
+
+    def match(self, url: str, status_code: Optional[int] = None, method: Optional[str] = None,
+              headers=None) -> List[Dict[str, Any]]:
+        """Return all targets matching url, status_code, method and request headers, in database order"""
+        positions = self.match_positions(url, status_code, method)
+        if headers is not None:
+            positions = self.filter_headers(positions, headers)
+        return self.targets_at(positions)
+
+    def filter_headers(self, positions: Sequence[int], headers) -> Sequence[int]:
+        """Narrow positions down to the targets whose request header predicates accept headers"""
+        rules = self._header_rules
+        if not rules or not positions:
+            return positions
+        return tuple(pos for pos in positions
+                     if pos not in rules or (rules[pos] is not None and rules[pos].matches(headers)))
+
+    def filter_status(self, positions: Iterable[int], status_code: Optional[int]) -> List[int]:
+        """Narrow positions matched without a status code down to those accepting status_code"""
+        if status_code is None:
+            return list(positions)
+        targets = self.targets
+        return [pos for pos in positions
+                if targets[pos].get('status_code') is None or targets[pos]['status_code'] == status_code]
+
+    def targets_at(self, positions: Iterable[int]) -> List[Dict[str, Any]]:
+        """Return the targets at the given positions"""
+        return [self.targets[pos] for pos in positions]
+
+    def host_patterns(self) -> Optional[List[str]]:
+        """Return regexes for the "host:port" strings the targets can apply to.
+
+        Substring rules, absolute URLs included, also match inside the URL of
+        another host (e.g. in a redirect parameter), so only regex targets
+        anchored to a literal scheme and host pin one. If any target can match
+        a flow to any host, None is returned.
+        """
+        patterns = set()
+        regex_positions = {pos for _, pos in self._regexes}
+        for pos, target in enumerate(self.targets):
+            if pos not in regex_positions:
+                return None
+            prefix = anchored_url_prefix(target['url'])
+            if prefix is None:
+                return None
+            patterns.add(host_pattern(prefix))
+        return sorted(patterns)
+
+    def _match_path(self, url: str, hits: Set[int], allowed: Optional[Set[int]] = None):
+        """Apply the path/query heuristics for endpoint and query-string targets, only checking allowed ones"""
+        parsed_url = urllib.parse.urlparse(url)
+        path = parsed_url.path
+        query = parsed_url.query
+        path_lower = path.lower()
+
+        flow_params_cache = []
+
+        def flow_params():
+            if not flow_params_cache:
+                flow_params_cache.append(urllib.parse.parse_qs(query))
+            return flow_params_cache[0]
+
+        if self._query_rules:
+            query_lower = query.lower()
+
+            for pos in self._path_automaton.search(path):
+                if (pos not in hits and (allowed is None or pos in allowed)
+                        and self._query_rules[pos].query_matches(query, flow_params)):
+                    hits.add(pos)
+
+            for pos in self._path_automaton_lower.search(path_lower):
+                if (pos not in hits and (allowed is None or pos in allowed)
+                        and self._query_rules[pos].query_contains(query_lower)):
+                    hits.add(pos)
+
+            if path.endswith('/'):
+                for pos in self._bare_query_rules:
+                    if (allowed is None or pos in allowed) and self._query_rules[pos].query_contains(query_lower):
+                        hits.add(pos)
+
+        for length in self._endpoint_lengths:
+            if length > len(path_lower):
+                break
+            hits.update(self._endpoints.get(path_lower[len(path_lower) - length:], ()))
+
+
+# Default number of entries kept by MatchCache
+DEFAULT_MATCH_CACHE_SIZE = 4096
+
+
+class MatchCache:
+    """Bounded LRU cache of match results keyed by (method, URL, status code).
+
+    The URL is mitmproxy's normalized request.url (default ports omitted); it
+    is not normalized further because matching is case- and query-sensitive.
+    Values are the matching target positions, which identify targets within
+    one rule set generation. The cache holds entries of a single generation:
+    a lookup with a newer generation empties it, and lookups for an older
+    generation (flows still running on a replaced rule set) bypass it.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Tuple[str, str, Optional[int]], Tuple[int, ...]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, generation: int, method: str, url: str, status_code: Optional[int],
+               compute: Callable[[], Iterable[int]]) -> Tuple[int, ...]:
+        """Return the cached positions for method, url and status_code, calling compute() on a miss"""
+        key = (method, url, status_code)
+        with self._lock:
+            if self.generation is None or generation > self.generation:
+                self._entries.clear()
+                self.generation = generation
+            cacheable = generation == self.generation and self.maxsize > 0
+            if cacheable:
+                positions = self._entries.get(key)
+                if positions is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return positions
+            self.misses += 1
+
+        positions = tuple(compute())
+        if cacheable:
+            with self._lock:
+                if generation == self.generation:
+                    self._entries[key] = positions
+                    if len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+        return positions
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, maxsize: int):
+        """Change the size cap, evicting the least recently used entries if needed"""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Tuple[str, int]]:
+        """Counters and gauges in the form Metrics collectors return"""
+        return {
+            'hits': ('counter', self.hits),
+            'misses': ('counter', self.misses),
+            'size': ('gauge', len(self._entries)),
+            'maxsize': ('gauge', self.maxsize),
+        }
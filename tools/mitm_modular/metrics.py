@@ -0,0 +1,240 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+logger = logging.getLogger('mitm_modular.metrics')
+
+# Upper bounds in seconds, from fast rule lookups up to slow dynamic scripts
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Stages of response processing that are timed
+STAGES = ('match', 'decode', 'transform', 'encode', 'compress', 'headers')
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by interpolating within its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Counters and per-stage latency histograms, keyed by target id.
+
+    Recording takes a single lock, so it is safe from the event loop and from
+    the database watcher or worker threads alike.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # (stage, target id or None) -> Histogram
+        self._histograms: Dict[Tuple[str, Optional[int]], Histogram] = {}
+        # target id -> number of responses the target was applied to
+        self._applied: Dict[int, int] = {}
+        # (target id, stage) -> number of failures
+        self._errors: Dict[Tuple[int, str], int] = {}
+        # name -> callable returning {metric: ('counter' or 'gauge', value)}
+        self._collectors: Dict[str, Callable[[], Dict[str, Tuple[str, float]]]] = {}
+        self._collector_resets: List[Callable[[], None]] = []
+
+    def register_collector(self, name: str, collect: Callable[[], Dict[str, Tuple[str, float]]],
+                           reset: Optional[Callable[[], None]] = None):
+        """Include values kept elsewhere (e.g. cache counters) in snapshots and exports"""
+        self._collectors[name] = collect
+        if reset is not None:
+            self._collector_resets.append(reset)
+
+    def observe(self, stage: str, seconds: float, target_id: Optional[int] = None):
+        """Record the duration of a processing stage"""
+        key = (stage, target_id)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def applied(self, target_id: int):
+        """Count a response handled (or request mocked) by a target"""
+        with self._lock:
+            self._applied[target_id] = self._applied.get(target_id, 0) + 1
+
+    def error(self, target_id: int, stage: str):
+        """Count a failure of a target in a processing stage"""
+        key = (target_id, stage)
+        with self._lock:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    def reset(self):
+        """Discard everything recorded so far"""
+        with self._lock:
+            self._histograms.clear()
+            self._applied.clear()
+            self._errors.clear()
+            self.started = time.time()
+        for reset in self._collector_resets:
+            reset()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a JSON-serializable summary of the recorded metrics"""
+        with self._lock:
+            stages = []
+            for (stage, target_id), h in sorted(self._histograms.items(), key=_histogram_sort_key):
+                stages.append({
+                    'stage': stage,
+                    'target_id': target_id,
+                    'count': h.count,
+                    'sum': h.sum,
+                    'p50': h.quantile(0.5),
+                    'p99': h.quantile(0.99),
+                    'buckets': list(h.buckets),
+                    'counts': list(h.counts),
+                })
+            targets: Dict[int, Dict[str, Any]] = {}
+            for target_id, n in self._applied.items():
+                targets.setdefault(target_id, {'applied': 0, 'errors': {}})['applied'] = n
+            for (target_id, stage), n in self._errors.items():
+                targets.setdefault(target_id, {'applied': 0, 'errors': {}})['errors'][stage] = n
+            collected = {name: collect() for name, collect in self._collectors.items()}
+            return {
+                'started': self.started,
+                'uptime': time.time() - self.started,
+                'stages': stages,
+                'targets': [dict(target_id=target_id, **targets[target_id]) for target_id in sorted(targets)],
+                'collectors': {name: {metric: value for metric, (_, value) in values.items()}
+                               for name, values in collected.items()},
+                'collector_types': {name: {metric: kind for metric, (kind, _) in values.items()}
+                                    for name, values in collected.items()},
+            }
+
+    def render_openmetrics(self) -> str:
+        """Render the metrics in the OpenMetrics text format"""
+        return render_openmetrics(self.snapshot())
+
+
+def _histogram_sort_key(item):
+    (stage, target_id), _ = item
+    stage_order = STAGES.index(stage) if stage in STAGES else len(STAGES)
+    return stage_order, stage, -1 if target_id is None else target_id
+
+
+def merge_snapshots(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine snapshots taken in several processes into one.
+
+    Histograms with the same stage and target are added up bucket by bucket
+    and their quantiles estimated again; counts and collector values are
+    summed.
+    """
+    histograms: Dict[Tuple[str, Optional[int]], Histogram] = {}
+    targets: Dict[int, Dict[str, Any]] = {}
+    collectors: Dict[str, Dict[str, float]] = {}
+    collector_types: Dict[str, Dict[str, str]] = {}
+    for snapshot in snapshots:
+        for s in snapshot['stages']:
+            key = (s['stage'], s['target_id'])
+            h = histograms.get(key)
+            if h is None:
+                h = histograms[key] = Histogram(tuple(s['buckets']))
+            h.counts = [a + b for a, b in zip(h.counts, s['counts'])]
+            h.count += s['count']
+            h.sum += s['sum']
+        for t in snapshot['targets']:
+            merged = targets.setdefault(t['target_id'], {'applied': 0, 'errors': {}})
+            merged['applied'] += t['applied']
+            for stage, n in t['errors'].items():
+                merged['errors'][stage] = merged['errors'].get(stage, 0) + n
+        for name, values in snapshot.get('collectors', {}).items():
+            merged = collectors.setdefault(name, {})
+            for metric, value in values.items():
+                merged[metric] = merged.get(metric, 0) + value
+        for name, kinds in snapshot.get('collector_types', {}).items():
+            collector_types.setdefault(name, {}).update(kinds)
+    return {
+        'started': min((s['started'] for s in snapshots), default=time.time()),
+        'uptime': max((s['uptime'] for s in snapshots), default=0.0),
+        'stages': [{
+            'stage': stage,
+            'target_id': target_id,
+            'count': h.count,
+            'sum': h.sum,
+            'p50': h.quantile(0.5),
+            'p99': h.quantile(0.99),
+            'buckets': list(h.buckets),
+            'counts': list(h.counts),
+        } for (stage, target_id), h in sorted(histograms.items(), key=_histogram_sort_key)],
+        'targets': [dict(target_id=target_id, **targets[target_id]) for target_id in sorted(targets)],
+        'collectors': collectors,
+        'collector_types': collector_types,
+    }
+
+
+def render_openmetrics(snapshot: Dict[str, Any]) -> str:
+    """Render a snapshot, of one Metrics or merged, in the OpenMetrics text format"""
+    lines = [
+        '# TYPE mitm_modular_stage_duration_seconds histogram',
+        '# UNIT mitm_modular_stage_duration_seconds seconds',
+        '# HELP mitm_modular_stage_duration_seconds Time spent per processing stage and target.',
+    ]
+    for s in snapshot['stages']:
+        labels = f'stage="{s["stage"]}",target="{"" if s["target_id"] is None else s["target_id"]}"'
+        cumulative = 0
+        for bound, n in zip(s['buckets'], s['counts']):
+            cumulative += n
+            lines.append(f'mitm_modular_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'mitm_modular_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+        lines.append(f'mitm_modular_stage_duration_seconds_count{{{labels}}} {s["count"]}')
+        lines.append(f'mitm_modular_stage_duration_seconds_sum{{{labels}}} {s["sum"]}')
+
+    lines.append('# TYPE mitm_modular_target_applied counter')
+    lines.append('# HELP mitm_modular_target_applied Responses handled or requests mocked per target.')
+    for t in snapshot['targets']:
+        if t['applied']:
+            lines.append(f'mitm_modular_target_applied_total{{target="{t["target_id"]}"}} {t["applied"]}')
+
+    lines.append('# TYPE mitm_modular_target_errors counter')
+    lines.append('# HELP mitm_modular_target_errors Failures per target and processing stage.')
+    for t in snapshot['targets']:
+        for stage, n in sorted(t['errors'].items()):
+            lines.append(f'mitm_modular_target_errors_total{{target="{t["target_id"]}",stage="{stage}"}} {n}')
+
+    types = snapshot.get('collector_types', {})
+    for name, values in sorted(snapshot.get('collectors', {}).items()):
+        for metric, value in values.items():
+            kind = types.get(name, {}).get(metric, 'gauge')
+            family = f'mitm_modular_{name}_{metric}'
+            lines.append(f'# TYPE {family} {kind}')
+            lines.append(f'{family}{"_total" if kind == "counter" else ""} {value}')
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,410 @@
+import functools
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+from . import codec
+
+# Operations accepted in a patch: those of RFC 6902 plus 'merge' (RFC 7396)
+OPERATIONS = ('add', 'remove', 'replace', 'move', 'copy', 'test', 'merge')
+
+# Path steps, compiled from JSONPath or JSON Pointer syntax
+KEY = 'key'              # object member (JSONPath .name / ['name'])
+INDEX = 'index'          # array element (JSONPath [n], negative counts from the end)
+MEMBER = 'member'        # JSON Pointer token: object member, or array element if numeric
+WILDCARD = 'wildcard'    # every member or element (JSONPath * / [*])
+DESCEND = 'descend'      # the node and all nested objects and arrays (JSONPath ..)
+APPEND = 'append'        # past the last array element (JSON Pointer -), only where a value is added
+
+Step = Tuple[Any, ...]
+
+# Steps that select at most one node
+SINGULAR = (KEY, INDEX, MEMBER)
+
+_MISSING = object()
+
+
+def parse_path(path: str) -> List[Step]:
+    """Compile a JSONPath ($.a.b[0], $..id, $.items[*]) or JSON Pointer (/a/b/0) into steps"""
+    if not isinstance(path, str):
+        raise ValueError(f"path must be a string, not {type(path).__name__}")
+    if path.startswith('$'):
+        return _parse_jsonpath(path)
+    if path == '' or path.startswith('/'):
+        return _parse_pointer(path)
+    raise ValueError(f"invalid path {path!r}: expected a JSONPath starting with '$' or a JSON Pointer starting with '/'")
+
+
+def _parse_pointer(path: str) -> List[Step]:
+    steps = []
+    if not path:
+        return steps
+    for token in path[1:].split('/'):
+        token = token.replace('~1', '/').replace('~0', '~')
+        if token == '-':
+            steps.append((APPEND,))
+        elif token.isdigit() and (token == '0' or not token.startswith('0')):
+            steps.append((MEMBER, token, int(token)))
+        else:
+            steps.append((MEMBER, token, None))
+    return steps
+
+
+def _parse_jsonpath(path: str) -> List[Step]:
+    steps = []
+    i, n = 1, len(path)
+    while i < n:
+        if path.startswith('..', i):
+            steps.append((DESCEND,))
+            i += 2
+            if i < n and path[i] == '[':
+                continue
+        elif path[i] == '.':
+            i += 1
+        elif path[i] != '[':
+            raise ValueError(f"invalid JSONPath {path!r} at position {i}")
+
+        if i >= n:
+            raise ValueError(f"invalid JSONPath {path!r}: ends after a separator")
+        if path[i] == '[':
+            if path[i + 1:i + 2] in ('"', "'"):
+                # Quoted names may contain ']', so find the closing quote first
+                close = path.find(path[i + 1], i + 2)
+                end = close + 1
+                if close < 0 or path[end:end + 1] != ']':
+                    raise ValueError(f"invalid JSONPath {path!r}: bad quoted name")
+                steps.append((KEY, path[i + 2:close]))
+                i = end + 1
+                continue
+            end = path.find(']', i)
+            if end < 0:
+                raise ValueError(f"invalid JSONPath {path!r}: unclosed '['")
+            selector = path[i + 1:end].strip()
+            if selector == '*':
+                steps.append((WILDCARD,))
+            else:
+                try:
+                    steps.append((INDEX, int(selector)))
+                except ValueError:
+                    raise ValueError(f"invalid JSONPath {path!r}: unsupported selector [{selector}]") from None
+            i = end + 1
+        else:
+            end = i
+            while end < n and path[end] not in '.[':
+                end += 1
+            name = path[i:end]
+            if not name:
+                raise ValueError(f"invalid JSONPath {path!r} at position {i}")
+            steps.append((WILDCARD,) if name == '*' else (KEY, name))
+            i = end
+    return steps
+
+
+def _descendants(node: Any, out: List[Any]):
+    out.append(node)
+    children = node.values() if isinstance(node, dict) else node if isinstance(node, list) else ()
+    for child in children:
+        if isinstance(child, (dict, list)):
+            _descendants(child, out)
+
+
+def select(document: Any, steps: List[Step]) -> List[Any]:
+    """Return the nodes of document selected by steps"""
+    nodes = [document]
+    for step in steps:
+        kind = step[0]
+        selected = []
+        for node in nodes:
+            if kind == KEY:
+                if isinstance(node, dict) and step[1] in node:
+                    selected.append(node[step[1]])
+            elif kind == INDEX:
+                if isinstance(node, list) and -len(node) <= step[1] < len(node):
+                    selected.append(node[step[1]])
+            elif kind == MEMBER:
+                if isinstance(node, dict):
+                    if step[1] in node:
+                        selected.append(node[step[1]])
+                elif isinstance(node, list) and step[2] is not None and step[2] < len(node):
+                    selected.append(node[step[2]])
+            elif kind == WILDCARD:
+                if isinstance(node, dict):
+                    selected.extend(node.values())
+                elif isinstance(node, list):
+                    selected.extend(node)
+            elif kind == DESCEND:
+                if isinstance(node, (dict, list)):
+                    _descendants(node, selected)
+        nodes = selected
+    return nodes
+
+
+def _slots(containers: List[Any], step: Step, adding: bool) -> List[Tuple[Any, Any]]:
+    """(container, key or index) pairs addressed by the last step of a path.
+
+    Without adding, only existing members and elements are returned; with
+    it, object members may be new and array positions may be one past the end.
+    """
+    kind = step[0]
+    slots = []
+    for container in containers:
+        if isinstance(container, dict):
+            if kind == WILDCARD:
+                slots.extend((container, key) for key in list(container))
+            elif kind in (KEY, MEMBER) and (adding or step[1] in container):
+                slots.append((container, step[1]))
+        elif isinstance(container, list):
+            size = len(container) + (1 if adding else 0)
+            if kind == WILDCARD:
+                slots.extend((container, i) for i in range(len(container)))
+            elif kind == APPEND and adding:
+                slots.append((container, len(container)))
+            elif kind == INDEX and -size <= step[1] < size:
+                slots.append((container, step[1] % size))
+            elif kind == MEMBER and step[2] is not None and step[2] < size:
+                slots.append((container, step[2]))
+    return slots
+
+
+def _step_key(step: Step) -> Tuple[Optional[str], Any]:
+    """(object member, array index) addressed by a singular or append step, None where not applicable"""
+    if step[0] == KEY:
+        return step[1], None
+    if step[0] == INDEX:
+        return None, step[1]
+    if step[0] == MEMBER:
+        return step[1], step[2]
+    return None, APPEND
+
+
+def _resolve(node: Any, keys: List[Tuple[Optional[str], Any]]) -> Any:
+    """Follow singular steps given as _step_key pairs, returning _MISSING if a node is absent"""
+    for key, index in keys:
+        if isinstance(node, dict):
+            if key is None or key not in node:
+                return _MISSING
+            node = node[key]
+        elif isinstance(node, list):
+            if index is None or not -len(node) <= index < len(node):
+                return _MISSING
+            node = node[index]
+        else:
+            return _MISSING
+    return node
+
+
+def _singular_runner(op: str, path: str, parent_keys: List[Tuple[Optional[str], Any]],
+                     last_key: Tuple[Optional[str], Any], value: Callable[[], Any]) -> Callable[[Any], Any]:
+    """Build the function applying an operation whose path selects at most one node"""
+    key, index = last_key
+    adding = op == 'add'
+
+    def run(document: Any) -> Any:
+        container = _resolve(document, parent_keys) if parent_keys else document
+        # Objects are by far the most common container, so check them first
+        if isinstance(container, dict) and key is not None:
+            slot = key if adding or key in container else _MISSING
+        else:
+            slot = _MISSING if container is _MISSING else _singular_slot(container, key, index, adding)
+        if op == 'test':
+            if slot is _MISSING or not _json_equal(container[slot], value()):
+                raise TestFailed(path)
+        elif slot is _MISSING:
+            pass
+        elif op == 'replace' or (adding and not isinstance(container, list)):
+            container[slot] = value()
+        elif op == 'remove':
+            del container[slot]
+        elif op == 'merge':
+            container[slot] = merge_patch(container[slot], value())
+        else:
+            container.insert(slot, value())
+        return document
+
+    return run
+
+
+def _singular_slot(container: Any, key: Optional[str], index: Any, adding: bool) -> Any:
+    """The member or index of container addressed by a singular step, or _MISSING"""
+    if isinstance(container, dict):
+        if key is not None and (adding or key in container):
+            return key
+    elif isinstance(container, list) and index is not None:
+        if index == APPEND:
+            return len(container) if adding else _MISSING
+        size = len(container) + (1 if adding else 0)
+        if -size <= index < size:
+            return index % size
+    return _MISSING
+
+
+class TestFailed(Exception):
+    """A 'test' operation did not hold; the remaining operations are skipped"""
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """Apply an RFC 7396 merge patch to target, modifying it in place where possible"""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
+
+
+def _json_equal(a: Any, b: Any) -> bool:
+    """JSON value equality, which unlike Python's does not consider true equal to 1"""
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _value_factory(value: Any) -> Callable[[], Any]:
+    """Return a callable producing a fresh copy of value for every response"""
+    if isinstance(value, (dict, list)):
+        # Decoding a pre-encoded copy is cheaper than copy.deepcopy
+        return functools.partial(codec.loads, codec.dumps(value))
+    return lambda: value
+
+
+class PatchOperation:
+    """One compiled operation: its path split into the parent steps and the addressed slot"""
+
+    __slots__ = ('op', 'path', 'steps', 'parent', 'last', 'source', 'value', 'run')
+
+    def __init__(self, op: str, path: str, steps: List[Step],
+                 source: Optional[List[Step]] = None, value: Optional[Callable[[], Any]] = None):
+        self.op = op
+        self.path = path
+        self.steps = steps
+        self.parent = steps[:-1]
+        self.last = steps[-1] if steps else None
+        self.source = source
+        self.value = value
+        # Paths without wildcards or descent get a specialized function that follows
+        # them directly instead of through select(); run is the apply to call
+        self.run = self.apply
+        if (op not in ('copy', 'move') and self.last is not None
+                and all(step[0] in SINGULAR for step in self.parent) and self.last[0] in SINGULAR + (APPEND,)):
+            self.run = _singular_runner(op, path, [_step_key(step) for step in self.parent],
+                                        _step_key(self.last), value)
+
+    def apply(self, document: Any) -> Any:
+        """Apply the operation and return the (possibly replaced) document.
+
+        Raises TestFailed if the operation is a test that does not hold.
+        """
+        op = self.op
+        if op == 'test':
+            nodes = select(document, self.steps)
+            expected = self.value()
+            if not nodes or not all(_json_equal(node, expected) for node in nodes):
+                raise TestFailed(self.path)
+            return document
+
+        if op in ('copy', 'move'):
+            found = select(document, self.source)
+            if not found:
+                return document
+            value = codec.loads(codec.dumps(found[0])) if op == 'copy' else found[0]
+            if op == 'move' and self.source:
+                document = _remove(document, self.source[:-1], self.source[-1])
+            return self._put(document, 'add', lambda: value)
+
+        if op == 'remove':
+            return _remove(document, self.parent, self.last)
+        return self._put(document, op, self.value)
+
+    def _put(self, document: Any, op: str, value: Callable[[], Any]) -> Any:
+        if self.last is None:
+            # The whole document
+            return merge_patch(document, value()) if op == 'merge' else value()
+        adding = op == 'add'
+        for container, key in _slots(select(document, self.parent), self.last, adding):
+            if op == 'merge':
+                container[key] = merge_patch(container[key], value())
+            elif adding and isinstance(container, list):
+                container.insert(key, value())
+            else:
+                container[key] = value()
+        return document
+
+
+def _remove(document: Any, parent: List[Step], last: Optional[Step]) -> Any:
+    if last is None:
+        return None
+    slots = _slots(select(document, parent), last, False)
+    # Delete from the back so that earlier indices of the same array stay valid
+    for container, key in sorted(slots, key=lambda slot: slot[1] if isinstance(slot[1], int) else 0, reverse=True):
+        del container[key]
+    return document
+
+
+class PatchPlan:
+    """A compiled list of patch operations, applied to decoded JSON documents.
+
+    The source is either a JSON array of RFC 6902 style operations, whose
+    'path' and 'from' may be JSON Pointers or JSONPath expressions, or a JSON
+    object used as an RFC 7396 merge patch of the whole document. Unlike RFC
+    6902, operations on paths that select nothing are skipped rather than
+    failing, and a failed 'test' stops the remaining operations.
+    """
+
+    def __init__(self, source: str):
+        try:
+            spec = codec.loads(source)
+        except ValueError as e:
+            raise ValueError(f"patch is not valid JSON: {e}") from None
+        if isinstance(spec, dict):
+            spec = [{'op': 'merge', 'path': '$', 'value': spec}]
+        if not isinstance(spec, list):
+            raise ValueError("patch must be a JSON array of operations or a merge patch object")
+        self.operations = [self._compile(i, operation) for i, operation in enumerate(spec)]
+
+    @staticmethod
+    def _compile(i: int, operation: Dict[str, Any]) -> PatchOperation:
+        if not isinstance(operation, dict):
+            raise ValueError(f"operation {i + 1}: expected an object")
+        op = operation.get('op')
+        if op not in OPERATIONS:
+            raise ValueError(f"operation {i + 1}: op must be one of {', '.join(OPERATIONS)}")
+        if 'path' not in operation:
+            raise ValueError(f"operation {i + 1}: path is required")
+        try:
+            steps = parse_path(operation['path'])
+            source = None
+            if op in ('copy', 'move'):
+                if 'from' not in operation:
+                    raise ValueError("from is required")
+                source = parse_path(operation['from'])
+                if any(step[0] not in SINGULAR for step in source):
+                    raise ValueError("from must select a single value (no wildcards or '..')")
+            if (steps and steps[-1][0] == APPEND and op not in ('add', 'copy', 'move')) or \
+                    any(step[0] == APPEND for step in steps[:-1] + (source or [])):
+                raise ValueError("'-' can only be the last token of an added path")
+        except ValueError as e:
+            raise ValueError(f"operation {i + 1}: {e}") from None
+        value = None
+        if op in ('add', 'replace', 'test', 'merge'):
+            if 'value' not in operation:
+                raise ValueError(f"operation {i + 1}: value is required for {op}")
+            value = _value_factory(operation['value'])
+        return PatchOperation(op, operation['path'], steps, source, value)
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    def apply(self, document: Any) -> Any:
+        """Apply the operations in order, returning the patched document"""
+        try:
+            for operation in self.operations:
+                document = operation.run(document)
+        except TestFailed:
+            pass
+        return document
@@ -0,0 +1,313 @@
+import base64
+import hashlib
+import importlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .compression import POLICIES
+from .metrics import merge_snapshots
+
+logger = logging.getLogger('mitm_modular.replay')
+
+# Addons whose ResponseModifier can be replayed: run_mitm.py (used by the app) or mitm_modular.mitm_core
+ENGINES = {
+    'run_mitm': 'run_mitm',
+    'core': 'mitm_modular.mitm_core',
+}
+DEFAULT_ENGINE = 'run_mitm'
+
+# What is compared against a baseline for every replayed flow
+BASELINE_FIELDS = ('url', 'status_code', 'content_encoding', 'length', 'sha256')
+
+Fields = List[Tuple[bytes, bytes]]
+
+
+class Exchange:
+    """A recorded request and response, in a form that can be sent to worker processes.
+
+    body is the raw body as recorded when encoded is true (flow dumps), or
+    the decoded body that still has to be encoded per Content-Encoding (HAR).
+    """
+
+    __slots__ = ('method', 'url', 'request_headers', 'status_code', 'response_headers', 'body', 'encoded')
+
+    def __init__(self, method: str, url: str, request_headers: Fields, status_code: int,
+                 response_headers: Fields, body: bytes, encoded: bool):
+        self.method = method
+        self.url = url
+        self.request_headers = request_headers
+        self.status_code = status_code
+        self.response_headers = response_headers
+        self.body = body
+        self.encoded = encoded
+
+
+def _har_headers(headers: Optional[List[Dict[str, Any]]]) -> Fields:
+    # HTTP/2 pseudo-headers such as :authority are not headers mitmproxy accepts
+    return [(h['name'].encode('utf-8'), str(h.get('value', '')).encode('utf-8'))
+            for h in headers or () if not h['name'].startswith(':')]
+
+
+def load_har(path: str) -> List[Exchange]:
+    """The completed exchanges of a HAR file"""
+    with open(path, 'rb') as f:
+        try:
+            har = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path} is not a HAR file: {e}")
+    exchanges = []
+    for entry in har.get('log', {}).get('entries', []):
+        request, response = entry.get('request') or {}, entry.get('response') or {}
+        # Aborted requests are recorded with status 0
+        if not request.get('url') or (response.get('status') or 0) <= 0:
+            continue
+        content = response.get('content') or {}
+        text = content.get('text') or ''
+        body = base64.b64decode(text) if content.get('encoding') == 'base64' else text.encode('utf-8')
+        exchanges.append(Exchange(request.get('method', 'GET'), request['url'], _har_headers(request.get('headers')),
+                                  response['status'], _har_headers(response.get('headers')), body, False))
+    return exchanges
+
+
+def load_flow_dump(path: str) -> List[Exchange]:
+    """The HTTP flows with a response of a mitmproxy flow file (mitmdump -w)"""
+    from mitmproxy import http, io
+    from mitmproxy.exceptions import FlowReadException
+
+    exchanges = []
+    with open(path, 'rb') as f:
+        try:
+            for flow in io.FlowReader(f).stream():
+                if not isinstance(flow, http.HTTPFlow) or flow.response is None:
+                    continue
+                request, response = flow.request, flow.response
+                exchanges.append(Exchange(request.method, request.url, list(request.headers.fields),
+                                          response.status_code, list(response.headers.fields),
+                                          response.raw_content or b'', True))
+        except FlowReadException as e:
+            raise ValueError(f"{path} is not a flow file: {e}")
+    return exchanges
+
+
+def load_exchanges(paths: Sequence[str]) -> List[Exchange]:
+    """Load HAR files and mitmproxy flow dumps, in the order given"""
+    exchanges = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            head = f.read(64).lstrip()
+        # HAR is a JSON object, flow dumps start with a tnetstring length
+        if path.lower().endswith('.har') or head.startswith(b'{'):
+            exchanges.extend(load_har(path))
+        else:
+            exchanges.extend(load_flow_dump(path))
+    return exchanges
+
+
+def make_flow(exchange: Exchange):
+    """A fresh completed flow for an exchange; hooks modify flows, so each replay needs its own"""
+    from mitmproxy import http
+    from mitmproxy.test import tflow
+
+    request = http.Request.make(exchange.method, exchange.url, b'', exchange.request_headers)
+    now = time.time()
+    response = http.Response(b'HTTP/1.1', exchange.status_code, b'', http.Headers(exchange.response_headers),
+                             b'', None, now, now)
+    if exchange.encoded:
+        response.raw_content = exchange.body
+    else:
+        response.content = exchange.body
+    return tflow.tflow(req=request, resp=response)
+
+
+def flow_output(index: int, flow) -> Dict[str, Any]:
+    """What a replayed flow sent to the client, as compared against baselines"""
+    response = flow.response
+    body = response.get_content(strict=False) or b''
+    return {
+        'index': index,
+        'url': flow.request.url,
+        'status_code': response.status_code,
+        'content_encoding': response.headers.get('content-encoding'),
+        'length': len(body),
+        'sha256': hashlib.sha256(body).hexdigest(),
+    }
+
+
+class _AppliedTargets:
+    """Takes the place of the capture store to learn which targets each flow applied"""
+
+    def __init__(self):
+        self.target_ids: Tuple[int, ...] = ()
+
+    def record(self, method, url, original_status, status_code, target_ids, original, modified, timings=None):
+        self.target_ids = tuple(target_ids)
+        return True
+
+    def stop(self):
+        pass
+
+
+def load_engine(engine: str, db_path: str):
+    """The ResponseModifier of an addon's module-level instance, on db_path.
+
+    Importing an addon creates that instance, so MITM_MODULAR_DB must point
+    at the database first.
+    """
+    os.environ['MITM_MODULAR_DB'] = db_path
+    os.environ.setdefault('MITM_MODULAR_LOG_LEVEL', 'WARNING')
+    module = importlib.import_module(ENGINES[engine])
+    return module, module.addon.modifier
+
+
+def replay_shard(db_path: str, exchanges: Sequence[Tuple[int, Exchange]], repeat: int = 1,
+                 engine: str = DEFAULT_ENGINE, compression: Optional[str] = None, json_backend: str = 'auto',
+                 record_outputs: bool = False) -> Dict[str, Any]:
+    """Feed (index, exchange) pairs through the hooks repeat times, the work of one process.
+
+    Only the hooks are timed, not building the flows. Outputs are recorded
+    from the first pass.
+    """
+    from . import codec
+    codec.set_backend(json_backend)
+    _, modifier = load_engine(engine, db_path)
+    if compression:
+        modifier.compression = compression
+    applied = _AppliedTargets()
+    modifier.capture = applied
+    modifier.metrics.reset()
+
+    latencies: List[float] = []
+    by_target: Dict[Optional[int], List[float]] = {}
+    outputs: List[Dict[str, Any]] = []
+    for n in range(repeat):
+        for index, exchange in exchanges:
+            flow = make_flow(exchange)
+            applied.target_ids = ()
+            start = time.perf_counter()
+            modifier.requestheaders(flow)
+            modifier.request(flow)
+            modifier.responseheaders(flow)
+            modifier.response(flow)
+            seconds = time.perf_counter() - start
+            latencies.append(seconds)
+            for target_id in applied.target_ids or (None,):
+                by_target.setdefault(target_id, []).append(seconds)
+            if record_outputs and n == 0:
+                outputs.append(flow_output(index, flow))
+    return {
+        'busy': sum(latencies),
+        'latencies': latencies,
+        'by_target': by_target,
+        'outputs': outputs,
+        'metrics': modifier.metrics.snapshot(),
+    }
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted samples"""
+    index = min(len(sorted_samples) - 1, max(0, int(round(q * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    """Distribution of per-flow durations in seconds"""
+    samples = sorted(samples)
+    return {
+        'flows': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 0.50),
+        'p99': percentile(samples, 0.99),
+        'max': samples[-1],
+    }
+
+
+def replay(db_path: str, exchanges: Sequence[Exchange], processes: int = 1, repeat: int = 1,
+           engine: str = DEFAULT_ENGINE, compression: Optional[str] = None, json_backend: str = 'auto',
+           record_outputs: bool = False) -> Dict[str, Any]:
+    """Replay exchanges against the targets in db_path, in this process or spread over several.
+
+    Exchanges are dealt out round-robin so that every process gets a similar
+    mix. Throughput is measured over the busiest process's time in the hooks,
+    leaving out process start-up and flow building.
+    """
+    if not exchanges:
+        raise ValueError("No flows to replay")
+    if repeat < 1:
+        raise ValueError("Flows must be replayed at least once")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine} (expected one of {', '.join(ENGINES)})")
+    if compression and compression not in POLICIES:
+        raise ValueError(f"Unknown compression policy: {compression} (expected one of {', '.join(POLICIES)})")
+    indexed = list(enumerate(exchanges))
+    processes = max(1, min(processes, len(indexed)))
+    options = (repeat, engine, compression, json_backend, record_outputs)
+    if processes == 1:
+        shards = [replay_shard(db_path, indexed, *options)]
+    else:
+        import multiprocessing
+        # Spawned like the script workers, so no thread or lock of this process is inherited
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            shards = pool.starmap(replay_shard, [(db_path, indexed[i::processes]) + options
+                                                 for i in range(processes)])
+
+    latencies: List[float] = []
+    by_target: Dict[Optional[int], List[float]] = {}
+    outputs: List[Dict[str, Any]] = []
+    for shard in shards:
+        latencies.extend(shard['latencies'])
+        for target_id, samples in shard['by_target'].items():
+            by_target.setdefault(target_id, []).extend(samples)
+        outputs.extend(shard['outputs'])
+    seconds = max(shard['busy'] for shard in shards)
+    outputs.sort(key=lambda output: output['index'])
+    logger.debug("Replayed %d flows in %.3fs on %d processes", len(latencies), seconds, processes)
+    return {
+        'exchanges': len(indexed),
+        'repeat': repeat,
+        'processes': processes,
+        'flows': len(latencies),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else None,
+        'latency': summarize(latencies),
+        # Flows no target applied to are listed under target None, after the targets
+        'targets': [dict(target_id=target_id, **summarize(by_target[target_id]))
+                    for target_id in sorted(by_target, key=lambda t: (t is None, t or 0))],
+        'metrics': merge_snapshots([shard['metrics'] for shard in shards]),
+        'outputs': outputs,
+    }
+
+
+def save_baseline(path: str, outputs: List[Dict[str, Any]]):
+    """Write replay outputs as JSON Lines"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for output in outputs:
+            f.write(json.dumps(output) + '\n')
+
+
+def load_baseline(path: str) -> List[Dict[str, Any]]:
+    """Read outputs written by save_baseline"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_outputs(baseline: List[Dict[str, Any]], outputs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Every field in which a replay's outputs differ from a baseline of the same files"""
+    expected = {output['index']: output for output in baseline}
+    differences = []
+    for output in outputs:
+        recorded = expected.pop(output['index'], None)
+        if recorded is None:
+            differences.append({'index': output['index'], 'url': output['url'], 'field': 'flow',
+                                'baseline': None, 'current': output['url']})
+            continue
+        for field in BASELINE_FIELDS:
+            if recorded.get(field) != output.get(field):
+                differences.append({'index': output['index'], 'url': output['url'], 'field': field,
+                                    'baseline': recorded.get(field), 'current': output.get(field)})
+    for index, recorded in sorted(expected.items()):
+        differences.append({'index': index, 'url': recorded['url'], 'field': 'flow',
+                            'baseline': recorded['url'], 'current': None})
+    return differences
@@ -0,0 +1,176 @@
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from types import CodeType
+from typing import Dict, Any, List, Optional, Iterable, Callable
+
+from .compiler import CodeCache, StaticBodyCache, StaticBody, PatchCache, HeaderPatchCache
+from .headers import HeaderPatch
+from .patch import PatchPlan
+from .matching import RuleIndex
+
+logger = logging.getLogger('mitm_modular.ruleset')
+
+
+class RuleSet:
+    """Immutable snapshot of the compiled enabled targets.
+
+    A flow reads the current RuleSet once and uses it throughout, so a reload
+    publishing a new snapshot never changes the rules under an in-flight flow.
+    """
+
+    def __init__(self, targets: Iterable[Dict[str, Any]], index: RuleIndex,
+                 dynamic_code: Dict[int, Optional[CodeType]],
+                 static_bodies: Dict[int, Optional[StaticBody]], generation: int,
+                 patches: Optional[Dict[int, Optional[PatchPlan]]] = None,
+                 header_patches: Optional[Dict[int, Optional[HeaderPatch]]] = None):
+        self.targets = tuple(targets)
+        self.index = index
+        self.dynamic_code = dynamic_code
+        self.static_bodies = static_bodies
+        self.generation = generation
+        self.patches = patches or {}
+        self.header_patches = header_patches or {}
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def match(self, url: str, status_code: Optional[int] = None, method: Optional[str] = None,
+              headers=None) -> List[Dict[str, Any]]:
+        """Return all targets matching url, status_code, method and request headers, in database order"""
+        return self.index.match(url, status_code, method, headers)
+
+    def code_for(self, target: Dict[str, Any]) -> Optional[CodeType]:
+        """Return the compiled code of a dynamic target, or None if it failed to compile"""
+        return self.dynamic_code.get(target['id'])
+
+    def static_body_for(self, target: Dict[str, Any]) -> Optional[StaticBody]:
+        """Return the encoded body of a static target, or None if it is not valid JSON"""
+        return self.static_bodies.get(target['id'])
+
+    def patch_for(self, target: Dict[str, Any]) -> Optional[PatchPlan]:
+        """Return the operation plan of a patch target, or None if its operations are invalid"""
+        return self.patches.get(target['id'])
+
+    def header_patch_for(self, target: Dict[str, Any]) -> Optional[HeaderPatch]:
+        """Return the header edits of a target, or None if it has none or they are invalid"""
+        return self.header_patches.get(target['id'])
+
+
+class RuleSetBuilder:
+    """Compiles target lists into RuleSets, reusing the artifacts of unchanged targets"""
+
+    def __init__(self, use_regex: bool = False):
+        self.use_regex = use_regex
+        self.code_cache = CodeCache()
+        self.static_body_cache = StaticBodyCache()
+        self.patch_cache = PatchCache()
+        self.header_patch_cache = HeaderPatchCache()
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def build(self, targets: Iterable[Dict[str, Any]]) -> RuleSet:
+        """Compile targets into a new RuleSet with the next generation number"""
+        targets = [t for t in targets if t.get('is_enabled', 1)]
+        with self._lock:
+            dynamic_code, errors = self.code_cache.load(targets)
+            for target_id, error in errors.items():
+                logger.warning("Error compiling dynamic code for target %s: %s", target_id, error)
+
+            static_bodies, errors = self.static_body_cache.load(targets)
+            for target_id, error in errors.items():
+                logger.warning("Static response is not valid JSON for target %s: %s", target_id, error)
+
+            patches, errors = self.patch_cache.load(targets)
+            for target_id, error in errors.items():
+                logger.warning("Invalid patch operations for target %s: %s", target_id, error)
+
+            header_patches, errors = self.header_patch_cache.load(targets)
+            for target_id, error in errors.items():
+                logger.warning("Invalid header operations for target %s: %s", target_id, error)
+
+            self.generation += 1
+            return RuleSet(targets, RuleIndex(targets, use_regex=self.use_regex),
+                           dynamic_code, static_bodies, self.generation, patches, header_patches)
+
+
+class RuleSetWatcher:
+    """Background thread that detects database changes and triggers a reload.
+
+    Changes are detected by polling SQLite's PRAGMA data_version on a dedicated
+    read-only connection, which changes whenever another connection commits to
+    the database. A replaced database file is detected by its inode.
+    """
+
+    def __init__(self, db_path: str, on_change: Callable[[], None], interval: float = 0.1):
+        self.db_path = db_path
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._file_id = None
+        self._last = None
+        # Baseline taken at construction, so changes made before start() are not missed
+        self._last = self._poll()
+
+    def start(self):
+        """Start polling in a daemon thread"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mitm_modular-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling and wait for the thread to exit"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _poll(self):
+        """Return a token that changes whenever the database content changes"""
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            self._close()
+            self._file_id = None
+            return self._last
+
+        file_id = (stat.st_dev, stat.st_ino)
+        try:
+            if file_id != self._file_id or self._conn is None:
+                self._close()
+                uri = pathlib.Path(os.path.abspath(self.db_path)).as_uri() + '?mode=ro'
+                self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                self._file_id = file_id
+            return file_id, self._conn.execute('PRAGMA data_version').fetchone()[0]
+        except sqlite3.Error as e:
+            logger.debug("Error polling database for changes: %s", e)
+            self._close()
+            return self._last
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                token = self._poll()
+                if token is None or token == self._last:
+                    continue
+                self._last = token
+
+                logger.info("Database change detected, reloading targets")
+                try:
+                    self.on_change()
+                except Exception:
+                    logger.exception("Error reloading targets after database change")
+        finally:
+            self._close()
@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import ipaddress
+import logging
+import os
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+# Make the mitm_modular package importable when this file is run directly
+tools_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if tools_dir not in sys.path:
+    sys.path.insert(0, tools_dir)
+
+from mitm_modular.control import ControlServer, fetch_stats, DEFAULT_PORT as CONTROL_PORT, TOKEN_ENV
+from mitm_modular.database import TargetDatabase, resolve_db_path
+from mitm_modular.log import configure_logging
+from mitm_modular.metrics import merge_snapshots, render_openmetrics
+
+logger = logging.getLogger('mitm_modular.supervisor')
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# mitmproxy's own default
+DEFAULT_LISTEN_PORT = 8080
+DEFAULT_CONFDIR = '~/.mitmproxy'
+
+# Runs mitmdump in the supervisor's interpreter, which has mitmproxy installed
+MITMDUMP_MAIN = 'import sys; from mitmproxy.tools.main import mitmdump; sys.exit(mitmdump())'
+
+# Seconds between checks for exited workers
+CHECK_INTERVAL = 1.0
+# Seconds a worker is given to start before it is restarted again after exiting
+RESTART_DELAY = 5.0
+# Seconds workers are given to exit on shutdown before they are killed
+STOP_TIMEOUT = 10.0
+# Bytes buffered towards one side of a connection before the other side is no longer read
+HIGH_WATER = 256 * 1024
+
+
+def _free_port() -> int:
+    """A loopback port nothing listens on right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ensure_ca(confdir: str):
+    """Create mitmproxy's CA in confdir unless it exists, so that every worker loads the same one"""
+    from mitmproxy import certs
+    certs.CertStore.from_store(os.path.expanduser(confdir), 'mitmproxy', 2048)
+
+
+class Worker:
+    """One mitmdump process serving proxy and control ports on the loopback interface"""
+
+    def __init__(self, index: int, command: List[str], env: Dict[str, str]):
+        self.index = index
+        self.command = command
+        self.env = env
+        self.port = _free_port()
+        self.control_port = _free_port()
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.restarts = 0
+        # Client connections currently handed to this worker
+        self.connections = 0
+
+    def start(self):
+        self.process = subprocess.Popen(self.command + [
+            '--listen-host', '127.0.0.1',
+            '--listen-port', str(self.port),
+            '--set', f'modular_control_port={self.control_port}',
+            '--set', 'modular_control_announce=false',
+        ], env=self.env)
+        self.started = time.monotonic()
+        logger.info("Started worker %d (pid %d) on port %d", self.index, self.process.pid, self.port)
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'index': self.index,
+            'pid': self.process.pid if self.process else None,
+            'port': self.port,
+            'alive': self.alive,
+            'connections': self.connections,
+            'restarts': self.restarts,
+        }
+
+
+class _Pipe(asyncio.Protocol):
+    """One side of a spliced connection, writing whatever arrives to the other side"""
+
+    def __init__(self, peer: Optional['_Pipe'] = None, worker: Optional[Worker] = None):
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer = peer
+        self.worker = worker
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(HIGH_WATER)
+        if self.worker is not None:
+            self.worker.connections += 1
+
+    def data_received(self, data: bytes):
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        self.eof = True
+        # Pass the half-close on; once both sides are done, close
+        if self.peer.eof or not self.peer.transport.can_write_eof():
+            self.peer.transport.close()
+            return False
+        self.peer.transport.write_eof()
+        return True
+
+    def connection_lost(self, exc):
+        if self.worker is not None:
+            self.worker.connections -= 1
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+
+    # Flow control: while this side cannot keep up, stop reading the other
+
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.transport.resume_reading()
+
+
+class _ClientPipe(_Pipe):
+    """The client side, which is held until a worker has accepted the connection"""
+
+    def __init__(self, distributor: 'Distributor'):
+        super().__init__()
+        self.distributor = distributor
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if not self.distributor.admit(transport.get_extra_info('peername')):
+            transport.close()
+            return
+        transport.pause_reading()
+        self.distributor.connect(self)
+
+
+class Distributor:
+    """Accepts client connections on the public port and splices each one to a worker.
+
+    The worker with the fewest open connections gets the next one, going
+    round the workers on ties. Workers that are down or refuse the
+    connection are skipped.
+    """
+
+    def __init__(self, workers: List[Worker], host: str, port: int, block_global: bool = True):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        # Workers see every client as the supervisor, so mitmproxy's block_global is enforced here
+        self.block_global = block_global
+        self._next = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks = set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: _ClientPipe(self), self.host or None, self.port)
+        logger.info("Distributing connections on %s:%d over %d workers", self.host or '*', self.port,
+                    len(self.workers))
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def admit(self, peername) -> bool:
+        if not self.block_global or not peername:
+            return True
+        address = ipaddress.ip_address(peername[0].split('%')[0])
+        address = getattr(address, 'ipv4_mapped', None) or address
+        if address.is_global:
+            logger.warning("Refused connection from %s: block_global is set", peername[0])
+            return False
+        return True
+
+    def candidates(self) -> List[Worker]:
+        """Running workers, fewest connections first"""
+        workers = [w for w in self.workers if w.alive]
+        if not workers:
+            return []
+        self._next = (self._next + 1) % len(workers)
+        return sorted(workers[self._next:] + workers[:self._next], key=lambda w: w.connections)
+
+    def connect(self, client: _ClientPipe):
+        task = asyncio.get_running_loop().create_task(self._connect(client))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connect(self, client: _ClientPipe):
+        loop = asyncio.get_running_loop()
+        for worker in self.candidates():
+            upstream = _Pipe(client, worker)
+            try:
+                await loop.create_connection(lambda: upstream, '127.0.0.1', worker.port)
+            except OSError as e:
+                logger.debug("Worker %d refused a connection: %s", worker.index, e)
+                continue
+            if client.transport.is_closing():
+                upstream.transport.close()
+                return
+            client.peer = upstream
+            client.transport.resume_reading()
+            return
+        logger.warning("No worker accepted a connection, closing it")
+        client.transport.close()
+
+
+class WorkerMetrics:
+    """The combined metrics of all workers, served by the supervisor's control server"""
+
+    def __init__(self, workers: List[Worker]):
+        self.workers = workers
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshots = []
+        for worker in self.workers:
+            try:
+                snapshots.append(fetch_stats(port=worker.control_port))
+            except (OSError, ValueError) as e:
+                logger.debug("No metrics from worker %d: %s", worker.index, e)
+        snapshot = merge_snapshots(snapshots)
+        statuses = [worker.status() for worker in self.workers]
+        snapshot['collectors']['workers'] = {
+            'alive': sum(s['alive'] for s in statuses),
+            'connections': sum(s['connections'] for s in statuses),
+            'restarts': sum(s['restarts'] for s in statuses),
+        }
+        snapshot['collector_types']['workers'] = {'alive': 'gauge', 'connections': 'gauge', 'restarts': 'counter'}
+        snapshot['workers'] = statuses
+        return snapshot
+
+    def render_openmetrics(self) -> str:
+        return render_openmetrics(self.snapshot())
+
+    def reset(self):
+        for worker in self.workers:
+            try:
+                fetch_stats(port=worker.control_port, reset=True, token=worker.env[TOKEN_ENV])
+            except (OSError, ValueError):
+                pass
+
+
+class Supervisor:
+    """Runs several mitmdump workers with the addon behind one listening port.
+
+    The distributor accepts the client connections and hands each one to a
+    worker, so TLS, JSON and script work spread over as many cores as there
+    are workers. Workers that exit are restarted. The control API on the
+    usual port announces the supervisor for the database and serves the
+    combined metrics of all workers.
+    """
+
+    def __init__(self, command: List[str], workers: int, listen_host: str, listen_port: int, db_path: str,
+                 control_port: int = CONTROL_PORT, block_global: bool = True):
+        env = dict(os.environ, MITM_MODULAR_DB=db_path)
+        # Lets the supervisor clear the workers' metrics; in the environment, which other users cannot read
+        env[TOKEN_ENV] = secrets.token_urlsafe(24)
+        self.workers = [Worker(i, command, env) for i in range(workers)]
+        self.distributor = Distributor(self.workers, listen_host, listen_port, block_global)
+        self.db_path = db_path
+        self.control_port = control_port
+        self._stopping: Optional[asyncio.Event] = None
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+
+    async def _main(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: Ctrl+C raises KeyboardInterrupt instead
+                pass
+
+        control = None
+        try:
+            for worker in self.workers:
+                worker.start()
+            await self.distributor.start()
+            if self.control_port:
+                # Writes go to the database, which every worker watches
+                db = TargetDatabase(self.db_path)
+                control = ControlServer(db, WorkerMetrics(self.workers), db.touch, port=self.control_port)
+                control.start()
+            while not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    self._check_workers()
+        finally:
+            self.distributor.close()
+            if control is not None:
+                control.stop()
+                control.db.close()
+            self._stop_workers()
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if worker.process is None or worker.alive:
+                continue
+            if time.monotonic() - worker.started < RESTART_DELAY:
+                continue
+            logger.warning("Worker %d exited with code %s, restarting it", worker.index, worker.process.returncode)
+            worker.restarts += 1
+            worker.start()
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning("Worker %d did not exit, killing it", worker.index)
+                worker.process.kill()
+                worker.process.wait()
+
+
+def _set_options(args: List[str]) -> Dict[str, str]:
+    """The name=value pairs of the --set arguments meant for mitmdump"""
+    options = {}
+    for i, arg in enumerate(args):
+        if arg == '--set' and i + 1 < len(args):
+            value = args[i + 1]
+        elif arg.startswith('--set='):
+            value = arg[len('--set='):]
+        else:
+            continue
+        name, _, option = value.partition('=')
+        options[name.strip()] = option.strip()
+    return options
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Run several mitmdump workers with the MITM addon behind one listening port',
+        epilog='Other arguments, such as --set block_global=false, are passed on to every worker.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of mitmdump workers (default: one per CPU core)')
+    parser.add_argument('--listen-host', default='', help='Address to listen on (default: all interfaces)')
+    parser.add_argument('-p', '--listen-port', type=int, default=DEFAULT_LISTEN_PORT, help='Proxy port')
+    parser.add_argument('--db', default='targets.db', help='Target database file path')
+    parser.add_argument('--script', default=os.path.join(tools_dir, 'run_mitm.py'),
+                        help='Addon script the workers load (default: run_mitm.py)')
+    parser.add_argument('--mitmdump', help='mitmdump executable (default: mitmproxy of this Python)')
+    parser.add_argument('--confdir', default=DEFAULT_CONFDIR, help="mitmproxy's configuration and CA directory")
+    parser.add_argument('--control-port', type=int, default=CONTROL_PORT,
+                        help='Loopback port of the combined control API and metrics, 0 to disable')
+    args, extra = parser.parse_known_args(argv)
+
+    configure_logging()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    db_path = resolve_db_path(args.db)
+    ensure_ca(args.confdir)
+
+    command = [args.mitmdump] if args.mitmdump else [sys.executable, '-c', MITMDUMP_MAIN]
+    command += ['-s', args.script, '--set', f'confdir={args.confdir}'] + extra
+    block_global = _set_options(extra).get('block_global', 'true').lower() not in ('false', '0', 'no', 'off')
+    Supervisor(command, args.workers, args.listen_host, args.listen_port, db_path, args.control_port,
+               block_global).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import time
+from types import CodeType
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+from . import codec
+from .compiler import StaticBody
+from .headers import HeaderPatch
+from .patch import PatchPlan
+
+
+class Step:
+    """One matching target, reduced to what applying it needs.
+
+    artifact is the target's StaticBody, compiled code or PatchPlan, or None
+    if it failed to build. source is the text it was built from, so that a
+    script worker process, which cannot receive code objects, can build it.
+    headers is the target's HeaderPatch, applied by the proxy after the chain.
+    """
+
+    __slots__ = ('target_id', 'modification_type', 'target_status_code', 'artifact', 'source', 'headers')
+
+    def __init__(self, target_id: int, modification_type: str, target_status_code: Optional[int],
+                 artifact: Any = None, source: Optional[str] = None, headers: Optional[HeaderPatch] = None):
+        self.target_id = target_id
+        self.modification_type = modification_type
+        self.target_status_code = target_status_code
+        self.artifact = artifact
+        self.source = source
+        self.headers = headers
+
+    def portable(self) -> 'Step':
+        """A copy that can be pickled: compiled code and patch plans are left for the receiver to build,
+        header edits out, since the proxy applies them"""
+        if self.modification_type == 'static':
+            artifact = self.artifact.uncompressed() if self.artifact is not None else None
+            return Step(self.target_id, self.modification_type, self.target_status_code, artifact)
+        return Step(self.target_id, self.modification_type, self.target_status_code, None, self.source)
+
+
+def build_steps(rules, targets: List[Dict[str, Any]]) -> List[Step]:
+    """Steps for the matching targets of a RuleSet, in the order they apply"""
+    steps = []
+    for target in targets:
+        kind = target['modification_type']
+        if kind == 'static':
+            artifact, source = rules.static_body_for(target), None
+        elif kind == 'dynamic':
+            artifact, source = rules.code_for(target), target.get('dynamic_code')
+        elif kind == 'patch':
+            artifact, source = rules.patch_for(target), target.get('patch_operations')
+        else:
+            artifact, source = None, None
+        steps.append(Step(target['id'], kind, target['target_status_code'], artifact, source,
+                          rules.header_patch_for(target)))
+    return steps
+
+
+def has_scripts(steps: List[Step]) -> bool:
+    """Whether any step runs user code"""
+    return any(step.modification_type == 'dynamic' for step in steps)
+
+
+class ChainResult:
+    """Outcome of applying a chain of targets, with its metrics recorded as data.
+
+    content and status_code are None where the response stays unchanged.
+    static_step is the position of the static step whose body content is,
+    if it is one. observations holds (stage, seconds, target id), errors (target id, stage)
+    and warnings messages for the caller to log.
+    """
+
+    __slots__ = ('content', 'content_length', 'static_step', 'status_code', 'observations', 'errors', 'applied',
+                 'warnings')
+
+    def __init__(self):
+        self.content: Optional[bytes] = None
+        self.content_length: Optional[str] = None
+        self.static_step: Optional[int] = None
+        self.status_code: Optional[int] = None
+        self.observations: List[Tuple[str, float, int]] = []
+        self.errors: List[Tuple[int, str]] = []
+        self.applied: List[int] = []
+        self.warnings: List[str] = []
+
+    @classmethod
+    def failed(cls, target_id: int, stage: str, message: str) -> 'ChainResult':
+        """A result leaving the response unchanged because a target could not be run"""
+        result = cls()
+        result.errors.append((target_id, stage))
+        result.warnings.append(message)
+        return result
+
+
+def run_script(code: CodeType, response_data: Any) -> Any:
+    """Run compiled dynamic code with response_data in its namespace and return the result"""
+    local_namespace = {"response_data": response_data}
+    exec(code, {}, local_namespace)
+    return local_namespace["response_data"]
+
+
+class _StepFailed(Exception):
+    """A dynamic or patch step raised while modifying the shared document"""
+
+    def __init__(self, position: int, message: str):
+        super().__init__(message)
+        self.position = position
+        self.message = message
+
+
+def apply_chain(content: bytes, steps: List[Step],
+                on_script: Optional[Callable[[int], None]] = None) -> ChainResult:
+    """Apply every step to a JSON response body, in order.
+
+    The body is decoded at most once, when the first dynamic or patch step
+    needs it, and every such step modifies that same document, which is
+    encoded once at the end. A static step replaces the body, including
+    whatever earlier steps did to it. on_script is called with the target
+    id before each dynamic script runs.
+
+    A target that fails is skipped as if it had not matched. Since a failing
+    step may have changed the document partway, the chain is then run again
+    without it, which only chains with failures pay for.
+    """
+    failed: Dict[int, str] = {}
+    while True:
+        try:
+            return _run_chain(content, steps, on_script, failed)
+        except _StepFailed as e:
+            failed[e.position] = e.message
+
+
+def _run_chain(content: bytes, steps: List[Step], on_script: Optional[Callable[[int], None]],
+               failed: Dict[int, str]) -> ChainResult:
+    """One pass of apply_chain, skipping the steps at the positions in failed and raising _StepFailed on a new failure"""
+    result = ChainResult()
+    observe = result.observations.append
+    error = result.errors.append
+    # Replacement body set by the last static step, its Content-Length and position
+    body: Optional[bytes] = None
+    body_length: Optional[str] = None
+    static_step: Optional[int] = None
+    # Document shared by the dynamic and patch steps, once decoded
+    response_data: Any = None
+    decoded = False
+    undecodable = False
+    # Last dynamic or patch step that ran; the encode is attributed to it
+    encode_target: Optional[int] = None
+
+    for position, step in enumerate(steps):
+        target_id = step.target_id
+        if position in failed:
+            error((target_id, 'transform'))
+            result.warnings.append(failed[position])
+            continue
+
+        if step.modification_type == 'static':
+            start = time.perf_counter()
+            static_body: Optional[StaticBody] = step.artifact
+            if static_body is None:
+                error((target_id, 'transform'))
+                continue
+            body, body_length, static_step = static_body.content, static_body.content_length, position
+            response_data, decoded, undecodable, encode_target = None, False, False, None
+            observe(('transform', time.perf_counter() - start, target_id))
+            result.applied.append(target_id)
+
+        elif step.modification_type in ('dynamic', 'patch'):
+            if step.artifact is None:
+                # Failed to compile at load time, already reported then
+                error((target_id, 'transform'))
+                continue
+            if not decoded:
+                if undecodable:
+                    error((target_id, 'decode'))
+                    continue
+                # Parse the JSON body, or the static body that replaced it
+                start = time.perf_counter()
+                try:
+                    response_data = codec.loads(content if body is None else body)
+                except ValueError as e:
+                    undecodable = True
+                    error((target_id, 'decode'))
+                    result.warnings.append(f"Response is not valid JSON: {e}")
+                    continue
+                observe(('decode', time.perf_counter() - start, target_id))
+                decoded = True
+
+            start = time.perf_counter()
+            try:
+                if step.modification_type == 'dynamic':
+                    if on_script is not None:
+                        on_script(target_id)
+                    response_data = run_script(step.artifact, response_data)
+                else:
+                    response_data = step.artifact.apply(response_data)
+            except Exception as e:
+                raise _StepFailed(position, f"Error applying target {target_id}: {e}") from None
+            observe(('transform', time.perf_counter() - start, target_id))
+            result.applied.append(target_id)
+            encode_target = target_id
+
+        if step.target_status_code is not None:
+            result.status_code = step.target_status_code
+
+    if encode_target is not None:
+        start = time.perf_counter()
+        try:
+            body = codec.dumps(response_data)
+            body_length = str(len(body))
+            static_step = None
+            observe(('encode', time.perf_counter() - start, encode_target))
+        except (TypeError, ValueError) as e:
+            # Fall back to the last static body, if any
+            error((encode_target, 'encode'))
+            result.warnings.append(f"Error encoding modified response: {e}")
+
+    result.content, result.content_length, result.static_step = body, body_length, static_step
+    return result
+
+
+class ArtifactCache:
+    """Builds the artifacts of portable steps, reusing them across calls; used by script workers"""
+
+    # Entries are never invalidated, only dropped wholesale past this size
+    max_entries = 1024
+
+    def __init__(self):
+        self._built: Dict[Tuple[int, str, str], Any] = {}
+
+    def resolve(self, steps: List[Step]) -> List[Step]:
+        for step in steps:
+            if step.artifact is not None or not step.source or step.modification_type not in ('dynamic', 'patch'):
+                continue
+            key = (step.target_id, step.modification_type, step.source)
+            if key not in self._built:
+                if len(self._built) >= self.max_entries:
+                    self._built.clear()
+                try:
+                    if step.modification_type == 'dynamic':
+                        self._built[key] = compile(step.source, f"<target {step.target_id}>", 'exec')
+                    else:
+                        self._built[key] = PatchPlan(step.source)
+                except Exception:
+                    self._built[key] = None
+            step.artifact = self._built[key]
+        return steps
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOLS_DIR)
+
+from mitmproxy import http
+from mitmproxy.test import tflow
+
+from mitm_modular.database import TargetDatabase
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'targets.db')
+
+
+@pytest.fixture
+def db(db_path):
+    database = TargetDatabase(db_path)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def make_modifier(db_path):
+    """Create a ResponseModifier over the test database, once its targets are added"""
+    from mitm_modular.engine import ResponseModifier
+    modifiers = []
+
+    def make(modifier_class=ResponseModifier):
+        modifier = modifier_class(db_path)
+        modifiers.append(modifier)
+        return modifier
+
+    yield make
+    for modifier in modifiers:
+        modifier.watcher.stop()
+        modifier.set_script_executor(None)
+        modifier.set_capture(None)
+        modifier.db.close()
+
+
+def request_flow(url: str, method: str = 'GET'):
+    """A flow that has not received a response yet"""
+    return tflow.tflow(req=http.Request.make(method, url))
+
+
+def make_response(content: bytes = b'{}', status_code: int = 200, content_type: str = 'application/json'):
+    """A response from the server"""
+    return http.Response.make(status_code, content, {'Content-Type': content_type})
+
+
+def response_flow(url: str, content: bytes = b'{}', status_code: int = 200,
+                  content_type: str = 'application/json', method: str = 'GET'):
+    """A flow with a complete response"""
+    flow = request_flow(url, method)
+    flow.response = make_response(content, status_code, content_type)
+    return flow
+
+
+def run_hooks(modifier, flow, response=None):
+    """Pass a flow through the hooks in the order mitmproxy calls them.
+
+    response is what the server answers unless a mock target answers first.
+    """
+    modifier.requestheaders(flow)
+    modifier.request(flow)
+    if flow.response is None:
+        flow.response = response if response is not None else make_response()
+    modifier.responseheaders(flow)
+    modifier.response(flow)
+    return flow
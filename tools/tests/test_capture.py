@@ -0,0 +1,33 @@
+from mitm_modular.capture import CaptureStore, list_captures
+
+
+def record(store, n):
+    for i in range(n):
+        assert store.record('GET', f'https://api.test/items/{i}', 200, 200, (1,), b'{}', b'{"n": 1}',
+                            {'transform': 0.1})
+
+
+def test_stop_without_waiting_still_writes_queue(tmp_path):
+    store = CaptureStore(str(tmp_path / 'captures.db'))
+    store.start()
+    writer = store._thread
+    record(store, 50)
+
+    store.stop(timeout=0)
+
+    assert not store.record('GET', 'https://api.test/late', 200, 200, (1,), None, b'{}')
+    writer.join(5)
+    assert not writer.is_alive()
+    assert store.written == 50
+    assert len(list_captures(store.path, limit=100)) == 50
+
+
+def test_row_limit_keeps_newest(tmp_path):
+    store = CaptureStore(str(tmp_path / 'captures.db'), max_rows=10)
+    store.start()
+    record(store, 30)
+    store.stop()
+
+    captures = list_captures(store.path, limit=100)
+    assert len(captures) == 10
+    assert captures[0]['url'] == 'https://api.test/items/29'
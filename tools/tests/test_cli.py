@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from conftest import TOOLS_DIR
+from mitm_modular import replay
+
+CLI = os.path.join(TOOLS_DIR, 'mitm_modular', 'cli.py')
+
+# Runs the CLI in a fresh interpreter and prints the heavy modules it ended up importing
+PROBE = """
+import runpy, sys
+sys.argv = [{cli!r}] + {argv!r}
+try:
+    runpy.run_path({cli!r}, run_name='__main__')
+except SystemExit:
+    pass
+heavy = ('mitmproxy', 'brotli', 'mitm_modular.replay', 'mitm_modular.control', 'mitm_modular.capture')
+print('LOADED', sorted(m for m in heavy if m in sys.modules))
+"""
+
+
+def loaded_modules(argv):
+    code = PROBE.format(cli=CLI, argv=argv)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    line = next(line for line in output.splitlines() if line.startswith('LOADED'))
+    return line[len('LOADED '):]
+
+
+def test_list_imports_nothing_heavy(db, db_path):
+    db.add_target('https://api.example.com/users', modification_type='static', static_response='{}')
+    assert loaded_modules(['--db', db_path, 'list']) == '[]'
+
+
+def test_replay_engine_choices_match_replay_engines():
+    output = subprocess.run([sys.executable, CLI, 'replay', '--help'], capture_output=True, text=True,
+                            check=True).stdout
+    assert '{' + ','.join(replay.ENGINES) + '}' in output
+    assert 'mitmproxy' not in loaded_modules(['replay', '--help'])
@@ -0,0 +1,29 @@
+import pytest
+
+from mitm_modular import codec
+
+
+@pytest.fixture
+def backend():
+    """Restore the configured backend after a test switches it"""
+    configured = codec.backend
+    yield codec.set_backend
+    codec.set_backend(configured)
+
+
+def test_stdlib_keeps_json_dumps_format(backend):
+    backend('stdlib')
+    assert codec.dumps({'name': 'café', 'n': [1, 2]}) == b'{"name": "caf\\u00e9", "n": [1, 2]}'
+
+
+def test_stdlib_refuses_nan(backend):
+    backend('stdlib')
+    with pytest.raises(ValueError):
+        codec.dumps({'n': float('nan')})
+
+
+def test_orjson_is_compact_utf8(backend):
+    pytest.importorskip('orjson')
+    backend('orjson')
+    assert codec.dumps({'name': 'café', 'big': 2 ** 70}) == '{"name":"café","big":1180591620717411303424}'.encode()
+    assert codec.dumps({'name': 'café'}) == '{"name":"café"}'.encode()
@@ -0,0 +1,72 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mitm_modular.control import TOKEN_HEADER, ControlClient, ControlError, ControlServer, fetch_stats
+from mitm_modular.metrics import Metrics
+
+
+@pytest.fixture
+def server(db):
+    metrics = Metrics()
+    control = ControlServer(db, metrics, db.touch, port=0, announce=False)
+    control.start()
+    yield control
+    control.stop()
+
+
+def post(server, path, body=b'{}', token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers[TOKEN_HEADER] = token
+    request = urllib.request.Request(f'http://127.0.0.1:{server.port}{path}', data=body, headers=headers,
+                                     method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_rpc_needs_token(server):
+    assert post(server, '/rpc/delete_all_targets')[0] == 403
+    assert post(server, '/rpc/delete_all_targets', token='wrong')[0] == 403
+    assert post(server, '/rpc/get_all_targets', token=server.token) == (200, {'result': []})
+
+
+def test_metrics_are_only_cleared_with_token(server):
+    server.metrics.observe('match', 0.001)
+
+    assert post(server, '/reset')[0] == 404
+    with pytest.raises(ValueError):
+        fetch_stats(port=server.port, reset=True)
+    assert post(server, '/rpc/stats', b'{"kwargs": {"reset": true}}')[0] == 403
+    assert fetch_stats(port=server.port)['stages']
+
+    assert fetch_stats(port=server.port, reset=True, token=server.token)['stages']
+    assert not fetch_stats(port=server.port)['stages']
+
+
+def test_client_raises_validation_errors(server, db):
+    client = ControlClient(db.db_path, '127.0.0.1', server.port, server.token)
+    try:
+        with pytest.raises(ValueError, match='only static targets can be mocked'):
+            client.add_target('https://api.test/', modification_type='dynamic', dynamic_code='pass', is_mock=True)
+        assert client.get_all_targets() == []
+    finally:
+        client.close()
+
+
+def test_client_raises_server_errors(server, db, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(db, 'export_targets', broken)
+    client = ControlClient(db.db_path, '127.0.0.1', server.port, server.token)
+    try:
+        with pytest.raises(ControlError, match='disk I/O error'):
+            client.export_targets()
+    finally:
+        client.close()
@@ -0,0 +1,110 @@
+import json
+
+from conftest import make_response, request_flow, run_hooks
+
+from mitm_modular.engine import MOCKED_KEY
+
+
+def body(flow):
+    return json.loads(flow.response.get_content())
+
+
+def applied(modifier):
+    """Number of responses each target was applied to, by target id"""
+    return {target['target_id']: target['applied'] for target in modifier.metrics.snapshot()['targets']}
+
+
+def test_targets_apply_in_priority_order(db, make_modifier):
+    db.add_target('https://api.test/items', modification_type='patch', priority=2,
+                  patch_operations='[{"op": "replace", "path": "/n", "value": 3}]')
+    db.add_target('https://api.test/items', modification_type='dynamic', priority=1,
+                  dynamic_code="response_data['n'] = response_data['n'] * 10")
+    modifier = make_modifier()
+
+    flow = run_hooks(modifier, request_flow('https://api.test/items'), make_response(b'{"n": 1}'))
+
+    assert body(flow) == {'n': 3}
+
+
+def test_mock_is_modified_by_other_matching_targets(db, make_modifier):
+    mock_id = db.add_target('https://api.test/user', modification_type='static', is_mock=True,
+                            static_response='{"plan": "free", "id": 7}', target_status_code=201)
+    patch_id = db.add_target('https://api.test/user', modification_type='patch', priority=1,
+                             patch_operations='{"plan": "premium"}')
+    modifier = make_modifier()
+
+    flow = run_hooks(modifier, request_flow('https://api.test/user'))
+
+    assert flow.metadata[MOCKED_KEY] == mock_id
+    assert flow.response.status_code == 201
+    assert body(flow) == {'plan': 'premium', 'id': 7}
+    assert applied(modifier) == {mock_id: 1, patch_id: 1}
+
+
+def test_status_filtered_target_does_not_hide_mock(db, make_modifier):
+    db.add_target('https://api.test/user', status_code=500, modification_type='static',
+                  static_response='{"error": true}')
+    mock_id = db.add_target('https://api.test/user', modification_type='static', is_mock=True,
+                            static_response='{"ok": true}', priority=1)
+    status_id = db.add_target('https://api.test/user', status_code=200, modification_type='dynamic', priority=2,
+                              dynamic_code="response_data['seen'] = True")
+    modifier = make_modifier()
+
+    flow = run_hooks(modifier, request_flow('https://api.test/user'))
+
+    assert flow.metadata[MOCKED_KEY] == mock_id
+    assert body(flow) == {'ok': True, 'seen': True}
+    assert applied(modifier) == {mock_id: 1, status_id: 1}
+
+
+def test_non_candidate_response_is_streamed(db, make_modifier):
+    db.add_target('https://api.test/items', modification_type='static', static_response='{}')
+    modifier = make_modifier()
+
+    flow = run_hooks(modifier, request_flow('https://other.test/file.bin'), make_response(b'x' * 10))
+
+    assert flow.response.stream
+    assert flow.response.content == b'x' * 10
+
+
+def match_count(modifier):
+    return sum(stage['count'] for stage in modifier.metrics.snapshot()['stages'] if stage['stage'] == 'match')
+
+
+def test_match_is_timed_once_per_flow(db, make_modifier):
+    db.add_target('https://api.test/items', modification_type='patch', patch_operations='{"n": 2}')
+    modifier = make_modifier()
+
+    flow = run_hooks(modifier, request_flow('https://api.test/items'), make_response(b'{"n": 1}'))
+
+    assert body(flow) == {'n': 2}
+    assert match_count(modifier) == 1
+
+
+def test_request_bodies_are_not_streamed(db, make_modifier):
+    db.add_target('https://api.test/items', modification_type='static', static_response='{}')
+    modifier = make_modifier()
+
+    flow = request_flow('https://other.test/upload', method='POST')
+    modifier.requestheaders(flow)
+
+    assert not flow.request.stream
+
+
+
+def test_disabling_capture_does_not_wait_for_writer(make_modifier, tmp_path):
+    from mitm_modular.capture import CaptureStore
+
+    class Store(CaptureStore):
+        timeouts = []
+
+        def stop(self, timeout=10.0):
+            self.timeouts.append(timeout)
+            super().stop(timeout)
+
+    modifier = make_modifier()
+    modifier.set_capture(Store(str(tmp_path / 'captures.db')))
+
+    modifier.set_capture(None)
+
+    assert Store.timeouts == [0]
@@ -0,0 +1,63 @@
+import asyncio
+
+from mitmproxy.test import taddons
+
+from mitm_modular import engine
+from mitm_modular.hostfilter import NO_HOSTS, HostFilter
+from mitm_modular.ruleset import RuleSetBuilder
+
+
+class RegexModifier(engine.ResponseModifier):
+    use_regex = True
+
+
+def allow_hosts(urls, use_regex=False):
+    rules = RuleSetBuilder(use_regex=use_regex).build([{'id': i, 'url': url, 'modification_type': 'none'}
+                                                       for i, url in enumerate(urls, 1)])
+    return HostFilter(lambda: rules).allow_hosts(rules)
+
+
+def test_no_targets_intercepts_nothing():
+    assert allow_hosts([]) == [NO_HOSTS]
+
+
+def test_absolute_url_can_match_inside_other_hosts():
+    # https://proxy.example/?u=https://api.example.com/v1/users matches the target, so every host is intercepted
+    assert allow_hosts(['https://api.example.com/v1/users']) == []
+    assert allow_hosts(['https://api.example.com/v1/users'], use_regex=True) == []
+
+
+def test_anchored_regex_pins_host():
+    assert allow_hosts([r'^https://api\.example\.com/v1/', r'^http://local\.test:8080/'], use_regex=True) == [
+        r'^api\.example\.com:\d+$',
+        r'^local\.test:8080$',
+    ]
+
+
+def test_unanchored_targets_intercept_every_host():
+    assert allow_hosts([r'^https://api\.example\.com/', 'users'], use_regex=True) == []
+    assert allow_hosts([r'^https://api\.example\.com/|.*'], use_regex=True) == []
+    assert allow_hosts([r'^https?://api\.example\.com/'], use_regex=True) == []
+
+
+def test_allow_hosts_follows_reloads(db, make_modifier):
+    modifier = make_modifier(RegexModifier)
+    host_filter = HostFilter(lambda: modifier.rules)
+    modifier.reload_listeners.append(host_filter.rules_changed)
+
+    async def run():
+        with taddons.context(host_filter) as tctx:
+            host_filter.running()
+            assert tctx.options.allow_hosts == [NO_HOSTS]
+
+            db.add_target(r'^https://api\.example\.com/', modification_type='static', static_response='{}')
+            modifier.reload_targets()
+            await asyncio.sleep(0)
+            assert tctx.options.allow_hosts == [r'^api\.example\.com:\d+$']
+
+            db.add_target('users', modification_type='static', static_response='{}')
+            modifier.reload_targets()
+            await asyncio.sleep(0)
+            assert tctx.options.allow_hosts == []
+
+    asyncio.run(run())
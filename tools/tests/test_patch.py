@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from mitm_modular.patch import PatchPlan
+
+
+def apply(operations, document):
+    source = operations if isinstance(operations, str) else json.dumps(operations)
+    return PatchPlan(source).apply(document)
+
+
+def test_add_remove_replace_with_pointers():
+    document = {'items': [1, 3], 'old': True, 'name': 'a'}
+    result = apply([
+        {'op': 'add', 'path': '/items/1', 'value': 2},
+        {'op': 'add', 'path': '/items/-', 'value': 4},
+        {'op': 'remove', 'path': '/old'},
+        {'op': 'replace', 'path': '/name', 'value': 'b'},
+    ], document)
+    assert result == {'items': [1, 2, 3, 4], 'name': 'b'}
+
+
+def test_move_and_copy():
+    result = apply([
+        {'op': 'copy', 'from': '/user/id', 'path': '/id'},
+        {'op': 'move', 'from': '/user/name', 'path': '/name'},
+    ], {'user': {'id': 7, 'name': 'a'}})
+    assert result == {'user': {'id': 7}, 'id': 7, 'name': 'a'}
+
+
+def test_copied_values_are_independent():
+    result = apply([{'op': 'copy', 'from': '/a', 'path': '/b'}], {'a': {'x': 1}})
+    result['b']['x'] = 2
+    assert result['a'] == {'x': 1}
+
+
+def test_failed_test_stops_remaining_operations():
+    operations = [
+        {'op': 'replace', 'path': '/a', 'value': 1},
+        {'op': 'test', 'path': '/flag', 'value': True},
+        {'op': 'replace', 'path': '/b', 'value': 1},
+    ]
+    assert apply(operations, {'a': 0, 'b': 0, 'flag': True}) == {'a': 1, 'b': 1, 'flag': True}
+    # true is not equal to 1 in JSON
+    assert apply(operations, {'a': 0, 'b': 0, 'flag': 1}) == {'a': 1, 'b': 0, 'flag': 1}
+
+
+def test_merge_patch_object():
+    result = apply('{"user": {"name": "b", "email": null}, "extra": [1]}',
+                   {'user': {'name': 'a', 'email': 'a@x', 'id': 1}})
+    assert result == {'user': {'name': 'b', 'id': 1}, 'extra': [1]}
+
+
+def test_jsonpath_wildcards_and_descent():
+    document = {'items': [{'price': 1, 'meta': {'price': 5}}, {'price': 2}]}
+    assert apply([{'op': 'replace', 'path': '$.items[*].price', 'value': 0}], document) == \
+        {'items': [{'price': 0, 'meta': {'price': 5}}, {'price': 0}]}
+    assert apply([{'op': 'remove', 'path': '$..price'}], document) == {'items': [{'meta': {}}, {}]}
+
+
+def test_missing_paths_are_skipped():
+    document = {'a': 1}
+    assert apply([
+        {'op': 'replace', 'path': '/missing/x', 'value': 1},
+        {'op': 'remove', 'path': '$.nothing[*]'},
+        {'op': 'move', 'from': '/gone', 'path': '/b'},
+    ], document) == {'a': 1}
+
+
+@pytest.mark.parametrize('operations, message', [
+    ('not json', 'not valid JSON'),
+    ('[{"op": "bogus", "path": "/a"}]', 'op must be one of'),
+    ('[{"op": "add", "path": "/a"}]', 'value is required'),
+    ('[{"op": "copy", "from": "$..a", "path": "/b"}]', 'single value'),
+    ('[{"op": "replace", "path": "/a/-", "value": 1}]', "'-' can only"),
+])
+def test_invalid_patches_are_rejected(operations, message):
+    with pytest.raises(ValueError, match=message):
+        PatchPlan(operations)
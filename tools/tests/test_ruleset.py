@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+from conftest import request_flow, run_hooks
+
+from mitm_modular.database import TargetDatabase
+from mitm_modular.ruleset import RuleSetWatcher
+
+URL = 'https://api.example.com/v1/users'
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_watcher_reloads_changed_targets(db, make_modifier):
+    modifier = make_modifier()
+    modifier.watcher.start()
+    generation = modifier.rules.generation
+    assert modifier.targets == ()
+
+    target_id = db.add_target(URL, modification_type='static', static_response='{"a": 1}')
+    assert wait_for(lambda: modifier.rules.generation != generation)
+    flow = request_flow(URL)
+    run_hooks(modifier, flow)
+    assert json.loads(flow.response.content) == {'a': 1}
+
+    generation = modifier.rules.generation
+    db.update_target(target_id, is_enabled=0)
+    assert wait_for(lambda: modifier.rules.generation != generation)
+    assert modifier.targets == ()
+
+
+def test_watcher_notices_a_replaced_database_file(db_path, tmp_path):
+    TargetDatabase(db_path).close()
+    replacement_path = str(tmp_path / 'replacement.db')
+    replacement = TargetDatabase(replacement_path)
+    replacement.add_target(URL, modification_type='static', static_response='{}')
+    replacement.close()
+
+    changed = threading.Event()
+    watcher = RuleSetWatcher(db_path, changed.set, interval=0.01)
+    watcher.start()
+    try:
+        shutil.copyfile(replacement_path, db_path + '.tmp')
+        os.replace(db_path + '.tmp', db_path)
+        assert changed.wait(5)
+    finally:
+        watcher.stop()
@@ -0,0 +1,47 @@
+import json
+
+from mitm_modular.patch import PatchPlan
+from mitm_modular.transform import Step, apply_chain
+
+
+def dynamic(target_id, source, target_status_code=None):
+    return Step(target_id, 'dynamic', target_status_code, compile(source, f'<target {target_id}>', 'exec'), source)
+
+
+def patch(target_id, operations, target_status_code=None):
+    return Step(target_id, 'patch', target_status_code, PatchPlan(operations), operations)
+
+
+def test_chain_decodes_and_encodes_once():
+    result = apply_chain(b'{"n": 1}', [dynamic(1, "response_data['n'] += 1"),
+                                        patch(2, '{"m": 2}')])
+
+    assert json.loads(result.content) == {'n': 2, 'm': 2}
+    assert result.applied == [1, 2]
+    stages = [stage for stage, _, _ in result.observations]
+    assert stages.count('decode') == 1
+    assert stages.count('encode') == 1
+
+
+def test_failing_script_leaves_body_untouched():
+    result = apply_chain(b'{"items": [1, 2]}', [
+        dynamic(1, "response_data['items'].append(3)\nraise RuntimeError('boom')", target_status_code=500),
+    ])
+
+    assert result.content is None
+    assert result.status_code is None
+    assert result.applied == []
+    assert result.errors == [(1, 'transform')]
+    assert 'boom' in result.warnings[0]
+
+
+def test_failing_step_is_rolled_back_between_others():
+    result = apply_chain(b'{"items": [1]}', [
+        dynamic(1, "response_data['items'].append(2)"),
+        dynamic(2, "response_data['items'].append(99)\nresponse_data['broken'] = True\n1 / 0"),
+        patch(3, '[{"op": "add", "path": "/items/-", "value": 3}]'),
+    ])
+
+    assert json.loads(result.content) == {'items': [1, 2, 3]}
+    assert result.applied == [1, 3]
+    assert result.errors == [(2, 'transform')]